@@ -1,16 +1,25 @@
 import streamlit as st
-from bs4 import BeautifulSoup
 import pandas as pd
-import requests
-import lxml
+import math
+import os
 import re
-from lxml.html.soupparser import fromstring
+import time
+from zillow.cache import ResultCache, get_result_cache
+from zillow.fetcher import COLUMNS, get_fetcher
+from zillow.scoring import read_listings, score_listings, to_numeric
+from zillow.spatial import GridIndex
+from zillow.utils import zpid_from_url
 # Configure logging
 import logging
 
 # Define constants
 SALE_OR_RENT_OPTIONS = ["For Sale", "For Rent"]
 HOME_TYPE_OPTIONS = ["Homes", "Apartments", "Townhomes"]
+# Crawler export the comparables search runs on
+LISTINGS_PATH = os.environ.get('ZILLOW_LISTINGS_PATH', 'output.csv')
+# Larger results are shown in a paginated, virtualized table instead of HTML
+HTML_TABLE_MAX_ROWS = 50
+TABLE_PAGE_SIZE = 100
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
@@ -35,17 +44,82 @@ def main():
     home_type = st.selectbox("Select Home Type", HOME_TYPE_OPTIONS,index=0)
 
     # Select box for choosing the number of listings
-    num_listings = st.selectbox("Select Number of Listings", [5, 10, 50, 100],index=0)
+    num_listings = st.selectbox("Select Number of Listings", [5, 10, 50, 100, 250, 500],index=0)
+
+    # Checkbox for ranking the results by deal score
+    rank_by_deal = st.checkbox("Rank by deal score")
 
     # Button to fetch data
     if st.button('Fetch Zillow Data'):
-        zillow_df = fetch_zillow_data(location, sale_or_rent.lower(), home_type.lower(), num_listings)
+        # Show the listings page by page as they arrive
+        progress = st.progress(0.0, text="Fetching listings...")
+        table = st.empty()
+        zillow_df = pd.DataFrame()
+        for zillow_df, done in stream_zillow_data(location, sale_or_rent.lower(), home_type.lower(), num_listings):
+            progress.progress(done, text=f"Fetched {len(zillow_df)} listings")
+            with table.container():
+                render_results(prepare_results(zillow_df, rank_by_deal), paginate=False)
+        progress.empty()
+        table.empty()
+
+        # Keep the results for reruns, e.g. when the table page changes
+        st.session_state['results'] = zillow_df
         if zillow_df.empty:
             st.warning("No data available. Please refine your search criteria.")
+
+    results = st.session_state.get('results')
+    if results is not None and not results.empty:
+        render_results(prepare_results(results, rank_by_deal))
+
+    show_comparables()
+
+
+# Section listing the crawled listings around a given one
+def show_comparables():
+    if not os.path.exists(LISTINGS_PATH):
+        return
+    with st.expander("Nearby comparables"):
+        listing = st.text_input("Listing link or zpid")
+        miles = st.slider("Radius (miles)", 0.1, 3.0, 0.5, step=0.1)
+        months = st.slider("Sold or listed within (months, 0 = any time)", 0, 24, 6)
+        if not listing:
+            return
+        index, listings = load_comparables(LISTINGS_PATH, os.path.getmtime(LISTINGS_PATH))
+        comparables = find_comparables(index, listings, zpid_from_url(listing) or listing.strip(), miles, months)
+        if comparables is None:
+            st.warning("That listing is not in the crawled data.")
+        elif comparables.empty:
+            st.info("No comparables found within that radius.")
         else:
-            # Format HTML for display
-            html = zillow_df.to_html(escape=False, index=False)
-            st.write(html, unsafe_allow_html=True)
+            st.dataframe(comparables)
+
+
+# Function to load the crawled listings and their spatial index, once per export file version
+@st.cache_resource
+def load_comparables(path, mtime):
+    listings = read_listings(path)
+    listings = listings[pd.to_numeric(listings['zpid'], errors='coerce').notna()]
+    listings.index = pd.to_numeric(listings['zpid']).astype('int64')
+    listings = listings[~listings.index.duplicated(keep='last')]
+    return GridIndex.from_frame(listings), listings
+
+
+# Function to find the crawled listings within a radius of a listing
+def find_comparables(index, listings, zpid, miles=0.5, months=6):
+    if not str(zpid).isdigit():
+        return None
+    location = index.locate(int(zpid))
+    if location is None:
+        return None
+    since = time.time() - months * 30.4 * 86400 if months else None
+    ids, distances = index.radius(*location, miles, since=since, exclude=int(zpid))
+    columns = [c for c in ('street_address', 'price_cents', 'floor_size', 'date_sold', 'url') if c in listings]
+    comparables = listings.loc[ids, columns]
+    # The export carries money as integer cents; show dollars
+    if 'price_cents' in comparables:
+        comparables.insert(columns.index('price_cents'), 'price', to_numeric(comparables.pop('price_cents')) / 100)
+    comparables.insert(0, 'Miles', distances.round(2))
+    return comparables
 
 # Function to validate location input
 def validate_location(location):
@@ -61,86 +135,96 @@ def format_search_parameter(user_input):
     return formatted_parameter
  
 
-# Function to fetch data from Zillow
-@st.cache(show_spinner=False)
-def fetch_zillow_data(location, sale_or_rent='', home_type='', max_properties=None):
+# Function to score and order the results for display
+def prepare_results(df, rank_by_deal=False):
+    df = score_results(df)
+    if rank_by_deal:
+        df = df.sort_values('Deal Score', ascending=False, na_position='last')
+    return df
+
+
+# Function to render the results: small ones as HTML, large ones as a paginated table
+def render_results(df, paginate=True):
+    if len(df) <= HTML_TABLE_MAX_ROWS:
+        html = df.to_html(escape=False, index=False)
+        st.write(html, unsafe_allow_html=True)
+        return
+
+    if paginate and len(df) > TABLE_PAGE_SIZE:
+        pages = math.ceil(len(df) / TABLE_PAGE_SIZE)
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1)
+        df = df.iloc[(page - 1) * TABLE_PAGE_SIZE:page * TABLE_PAGE_SIZE]
+    st.dataframe(df, hide_index=True, use_container_width=True,
+                 column_config={'Link': st.column_config.LinkColumn('Link')})
+
+
+# Function to score the fetched listings as deals against each other
+def score_results(df):
+    # The cards only carry text, so pull the scorer's inputs out of it
+    listings = pd.DataFrame({
+        'price': df['Price'],
+        'floor_size': df['Beds'].str.extract(r'([\d,]+)\s*sqft', expand=False),
+        'postal_code': df['Address'].str.extract(r'(\d{5})\s*$', expand=False),
+        'address_locality': df['Address'].str.extract(r',\s*([^,]+),\s*[A-Z]{2}\b', expand=False),
+    })
+    scored = score_listings(listings, min_group_size=3)
+    return df.assign(**{'$/sqft': scored['price_per_sqft'].round(), 'Deal Score': scored['deal_score'].round(2)})
+
+
+# Function to fetch data from Zillow page by page
+def stream_zillow_data(location, sale_or_rent='', home_type='', max_properties=None):
+    """Yield ``(DataFrame of the listings so far, fraction done)`` as pages arrive."""
     try:
         # Define the base URL
         base_url = f'https://www.zillow.com/{home_type}/{location}/{sale_or_rent}/'
 
-        # Define request headers
-        request_headers = {
-            'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
-            'accept-encoding': 'gzip, deflate, br',
-            'accept-language': 'en-US,en;q=0.8',
-            'upgrade-insecure-requests': '1',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/61.0.3163.100 Safari/537.36'
-        }
-
-        # List to store property details
-        all_addresses = []
-        all_prices = []
-        all_beds = []
-        all_links = []
-
-        # Iterate through pages
-        page_num = 1
-        properties_fetched = 0
-        while True:
-            url = f'{base_url}{page_num}_p/' if page_num > 1 else base_url
-            with requests.Session() as session:
-                response = session.get(url, headers=request_headers)
-
-            # Check if page exists
-            if response.status_code != 200:
-                break
-
-            # Parse HTML content
-            soup = BeautifulSoup(response.content, 'html.parser')
-
-            # Extract property details
-            addresses = [address.get_text(strip=True) for address in soup.find_all(class_='list-card-addr')]
-            prices = [price.get_text(strip=True) for price in soup.find_all(class_='list-card-price')]
-            beds = [bed.get_text(strip=True) for bed in soup.find_all('ul', class_='list-card-details')]
-            links = [link['href'] for link in soup.find_all(class_='list-card-link')]
-
-            # Calculate the number of new properties fetched
-            num_new_properties = len(addresses)
-
-            # If the number of properties fetched exceeds the maximum or if max_properties is specified
-            if max_properties is not None and properties_fetched + num_new_properties > max_properties:
-                num_new_properties = max_properties - properties_fetched
-                addresses = addresses[:num_new_properties]
-                prices = prices[:num_new_properties]
-                beds = beds[:num_new_properties]
-                links = links[:num_new_properties]
-
-            # Append details to the lists
-            all_addresses.extend(addresses)
-            all_prices.extend(prices)
-            all_beds.extend(beds)
-            all_links.extend(links)
-
-            # Update the total number of properties fetched
-            properties_fetched += num_new_properties
-
-            # Check if the maximum number of properties has been reached
-            if max_properties is not None and properties_fetched >= max_properties:
-                break
-
-            page_num += 1
-
-        # Create DataFrame
-        df = pd.DataFrame({'Address': all_addresses,
-                           'Price': all_prices,
-                           'Beds': all_beds,
-                           'Link': all_links})
-
-        return df
+        # Serve from the shared result cache; stale entries are returned while
+        # they refresh in the background
+        key = ResultCache.make_key(location, sale_or_rent, home_type, max_properties)
+        cache = get_result_cache()
+        cached = cache.get(key)
+        if cached is not None:
+            listings, fresh = cached
+            if not fresh:
+                cache.revalidate(key, lambda: fetch_listings(base_url, max_properties))
+            yield listings_frame(listings), 1.0
+            return
+
+        listings = {column: [] for column in COLUMNS}
+        for page in get_fetcher().iter_pages(base_url, max_properties):
+            for column in COLUMNS:
+                listings[column].extend(page[column])
+            done = len(listings['Address']) / max_properties if max_properties else 0.0
+            yield listings_frame(listings), min(done, 1.0)
+
+        # Only complete, successful fetches are cached; a search that found
+        # nothing may have been served a captcha instead of its results
+        if listings['Address']:
+            cache.set(key, listings)
 
     except Exception as e:
         logging.error(f"An error occurred while fetching data: {str(e)}")
-        return pd.DataFrame()
+
+
+# Function to refresh a cached search; raising keeps the cached listings
+def fetch_listings(base_url, max_properties=None):
+    listings = get_fetcher().fetch(base_url, max_properties)
+    if not listings['Address']:
+        raise LookupError(f"No listings found at {base_url}")
+    return listings
+
+
+# Function to fetch data from Zillow
+def fetch_zillow_data(location, sale_or_rent='', home_type='', max_properties=None):
+    df = pd.DataFrame()
+    for df, _ in stream_zillow_data(location, sale_or_rent, home_type, max_properties):
+        pass
+    return df
+
+
+# Function to build the results DataFrame
+def listings_frame(listings):
+    return pd.DataFrame({column: listings[column] for column in COLUMNS})
 
 if __name__ == "__main__":
     main()
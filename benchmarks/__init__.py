@@ -0,0 +1,3 @@
+# Offline benchmarks for the zillow crawler.
+#
+# Run from the repository root, e.g. ``python -m benchmarks.bench_jsonld``.
@@ -0,0 +1,123 @@
+"""Time saved-search matching as the number of saved searches grows.
+
+Usage:
+    python -m benchmarks.bench_alerts [--searches N,N,...] [--listings N]
+
+Generates saved searches and listings: most searches name postal codes,
+some a locality, and a fixed ``UNLOCATED`` few a home type only or no
+criteria but the price. The
+number of postal codes grows with the number of searches, as more users
+means more areas watched, so every listing matches about as many searches
+at every size. The script times ``SearchIndex.match`` per listing against
+testing every search, then the full ``AlertMatcher`` path (listing state
+and outbox writes included) with the largest index.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from zillow.alerts import NEW, PRICE_DROP, AlertMatcher, AlertStore, SavedSearch, SearchIndex
+from zillow.records import HomeType
+
+SEARCHES_PER_POSTAL_CODE = 25
+UNLOCATED = 100
+HOME_TYPES = [home_type.value for home_type in HomeType]
+
+
+def areas(searches):
+    postal_codes = [str(10001 + i) for i in range(max(searches // SEARCHES_PER_POSTAL_CODE, 10))]
+    localities = [f"city {i}" for i in range(max(len(postal_codes) // 20, 1))]
+    return postal_codes, localities
+
+
+def make_searches(count, rng):
+    postal_codes, localities = areas(count)
+    searches = []
+    for i in range(count):
+        data = {'id': f"search-{i}"}
+        if i >= UNLOCATED:
+            if rng.random() < 0.9:
+                data['postal_codes'] = rng.sample(postal_codes, rng.randint(1, 3))
+            else:
+                data['localities'] = [rng.choice(localities)]
+        if rng.random() < 0.5 or UNLOCATED // 2 <= i < UNLOCATED:
+            data['home_types'] = [rng.choice(HOME_TYPES)]
+        if rng.random() < 0.9:
+            low = rng.choice((None, rng.randint(1, 10) * 100_000))
+            data['max_price'] = (low or 0) + rng.randint(2, 15) * 100_000
+            if low:
+                data['min_price'] = low
+        if rng.random() < 0.6:
+            data['min_beds'] = rng.randint(1, 4)
+        if rng.random() < 0.3:
+            data['events'] = [PRICE_DROP]
+        searches.append(SavedSearch.from_dict(data))
+    return searches
+
+
+def make_listings(count, searches, rng):
+    postal_codes, localities = areas(searches)
+    return [
+        {
+            'zpid': 1_000_000 + i,
+            'postal_code': rng.choice(postal_codes),
+            'address_locality': rng.choice(localities),
+            'real_estate_type': rng.choice(HOME_TYPES),
+            'price_cents': rng.randint(10, 300) * 10_000_00,
+            'bedrooms': rng.randint(0, 6),
+            'bathrooms': rng.randint(1, 4),
+            'floor_size': rng.randint(400, 4000),
+        }
+        for i in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--searches', default='1000,10000,100000', help='Comma-separated saved search counts')
+    parser.add_argument('--listings', type=int, default=20_000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    counts = [int(count) for count in args.searches.split(',')]
+    for count in counts:
+        searches = make_searches(count, rng)
+        listings = make_listings(args.listings, count, rng)
+        started = time.perf_counter()
+        index = SearchIndex(searches)
+        built = time.perf_counter() - started
+
+        started = time.perf_counter()
+        candidates = matched = 0
+        for listing in listings:
+            candidates += len(index.candidates(listing))
+            matched += len(index.match(listing, NEW))
+        indexed = (time.perf_counter() - started) / len(listings)
+
+        sample = listings[:max(1, min(len(listings), 500_000 // count))]
+        started = time.perf_counter()
+        for listing in sample:
+            [search for search in searches if search.matches(listing, NEW)]
+        scanned = (time.perf_counter() - started) / len(sample)
+
+        print(f"{count:>7,} searches (index built in {built:.2f} s): {matched / len(listings):.1f} matches and"
+              f" {candidates / len(listings):.1f} candidates per listing; index {indexed * 1e6:,.0f} us,"
+              f" scan {scanned * 1e6:,.0f} us per listing")
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = AlertStore(os.path.join(directory, 'alerts.sqlite3'))
+        matcher = AlertMatcher(store, index)
+        started = time.perf_counter()
+        for listing in listings:
+            matcher.process(listing)
+        matcher.flush()
+        elapsed = time.perf_counter() - started
+        print(f"AlertMatcher with {len(index):,} searches: {len(listings) / elapsed:,.0f} listings/s,"
+              f" {matcher.queued:,} alerts queued")
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Compare the listing card parser backends used by the Streamlit app.
+
+Usage:
+    python -m benchmarks.bench_card_parsers [saved_page.html ...] [--repeat N]
+
+Reports parse time per page and the peak RSS growth of parsing the page set,
+measured in a fresh interpreter per backend. Without arguments the benchmark
+runs on synthetic pages.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import timeit
+
+from benchmarks.fixtures import make_card_page
+from zillow.fetcher import PARSERS
+
+
+def load_pages(paths):
+    if not paths:
+        return [make_card_page(seed=seed) for seed in range(5)]
+    pages = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+    return pages
+
+
+def measure_memory(backend, paths):
+    """Peak RSS growth in MB of parsing the pages once, in a child process."""
+    code = (
+        'import json, resource, sys\n'
+        'from benchmarks.bench_card_parsers import load_pages\n'
+        'from zillow.fetcher import PARSERS\n'
+        'pages = load_pages(sys.argv[2:])\n'
+        'parse = PARSERS[sys.argv[1]]\n'
+        'before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n'
+        'results = [parse(page) for page in pages]\n'
+        'after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n'
+        'print(json.dumps((after - before) / 1024))\n'
+    )
+    output = subprocess.check_output([sys.executable, '-c', code, backend, *paths], text=True)
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pages', nargs='*', help='Saved search result pages')
+    parser.add_argument('--repeat', type=int, default=10, help='Passes over the page set')
+    args = parser.parse_args()
+
+    pages = load_pages(args.pages)
+    print(f"{len(pages)} pages, backends: {', '.join(PARSERS)}")
+
+    reference_name = 'bs4' if 'bs4' in PARSERS else next(iter(PARSERS))
+    reference = [PARSERS[reference_name](page) for page in pages]
+    reference_time = None
+    for name in ['bs4'] + [name for name in PARSERS if name != 'bs4']:
+        if name not in PARSERS:
+            continue
+        parse = PARSERS[name]
+        if [parse(page) for page in pages] != reference:
+            print(f"warning: {name} output differs from {reference_name}")
+        elapsed = min(timeit.repeat(lambda: [parse(page) for page in pages], number=1, repeat=args.repeat))
+        reference_time = reference_time or elapsed
+        print(f"{name:<12} {elapsed / len(pages) * 1000:8.3f} ms/page  {reference_time / elapsed:6.2f}x  "
+              f"peak RSS +{measure_memory(name, args.pages):.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
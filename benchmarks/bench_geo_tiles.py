@@ -0,0 +1,76 @@
+"""Compare quadtree tiling with fixed grids on synthetic listing distributions.
+
+Usage:
+    python -m benchmarks.bench_geo_tiles [--listings N] [--cap N] [--page-size N] [--seed N]
+
+For a dense metro (a few Gaussian clusters over a uniform background) the
+benchmark reports, per tiling strategy, the search requests needed and the
+share of listings reachable under the per-query result cap. Every listing
+must be owned by exactly one quadtree leaf; the benchmark fails otherwise.
+"""
+import argparse
+import math
+import random
+
+from zillow.geo import QuadtreePartitioner, Tile
+
+CITY = Tile(-74.26, -73.70, 40.49, 40.92)
+
+
+def make_listings(count, seed=0):
+    rng = random.Random(seed)
+    clusters = [(rng.uniform(CITY.south, CITY.north), rng.uniform(CITY.west, CITY.east), rng.uniform(0.005, 0.03))
+                for _ in range(6)]
+    points = []
+    for _ in range(count):
+        if rng.random() < 0.2:
+            points.append((rng.uniform(CITY.south, CITY.north), rng.uniform(CITY.west, CITY.east)))
+        else:
+            lat, lon, spread = rng.choice(clusters)
+            points.append((rng.gauss(lat, spread), rng.gauss(lon, spread)))
+    return points
+
+
+def count_in(tile, points):
+    return sum(1 for lat, lon in points if tile.contains(lat, lon))
+
+
+def cost(counts, cap, page_size):
+    """Requests and reachable listings of searching tiles with these result counts."""
+    requests = sum(max(1, math.ceil(min(count, cap) / page_size)) for count in counts)
+    reachable = sum(min(count, cap) for count in counts)
+    return requests, reachable
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--listings', type=int, default=20000)
+    parser.add_argument('--cap', type=int, default=500, help='Results one query returns')
+    parser.add_argument('--page-size', type=int, default=40, help='Results per API page')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    points = make_listings(args.listings, args.seed)
+    print(f"{len(points)} listings, cap {args.cap}, {args.page_size} per page")
+
+    for rows in (1, 4, 8, 16):
+        counts = [count_in(tile, points) for tile in CITY.grid(rows)]
+        requests, reachable = cost(counts, args.cap, args.page_size)
+        print(f"grid {rows:>2}x{rows:<2}   {requests:6d} requests  {reachable / len(points):7.1%} coverage")
+
+    partitioner = QuadtreePartitioner(args.cap)
+    probes = []
+    leaves = partitioner.partition(CITY, lambda tile: probes.append(tile) or count_in(tile, points))
+    # Split tiles cost their first page; leaves are paginated, their first page included
+    split_requests = len(probes) - len(leaves)
+    requests, reachable = cost([count for _, count in leaves], args.cap, args.page_size)
+    print(f"quadtree     {requests + split_requests:6d} requests  {reachable / len(points):7.1%} coverage  "
+          f"({len(leaves)} leaves, depth {max(tile.depth for tile, _ in leaves)})")
+
+    owners = [sum(1 for tile, _ in leaves if tile.contains(lat, lon)) for lat, lon in points]
+    if any(owner != 1 for owner in owners):
+        raise SystemExit('quadtree leaves do not partition the listings')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Compare the raw-bytes JSON-LD extractor with the CSS selector path.
+
+Usage:
+    python -m benchmarks.bench_jsonld [saved_page.html ...] [--repeat N]
+
+Without arguments the benchmark runs on synthetic search pages.
+"""
+import argparse
+import json
+import timeit
+
+from scrapy.http import HtmlResponse
+
+from zillow import jsonld
+from benchmarks.fixtures import make_search_page
+
+
+def selector_path(response):
+    """The original ``ZillowSpider.parse`` extraction, kept as the baseline."""
+    listings = []
+    for script_content in response.css('script[type="application/ld+json"]::text').getall():
+        try:
+            json_data = json.loads(script_content)
+        except json.JSONDecodeError:
+            continue
+        if json_data.get('@type', ''):
+            listings.append({
+                'real_estate_type': json_data.get('@type', ''),
+                'name': json_data.get('name', ''),
+                'floor_size': json_data.get('floorSize', {}).get('value', ''),
+                'street_address': json_data.get('address', {}).get('streetAddress', ''),
+                'address_locality': json_data.get('address', {}).get('addressLocality', ''),
+                'address_region': json_data.get('address', {}).get('addressRegion', ''),
+                'postal_code': json_data.get('address', {}).get('postalCode', ''),
+                'latitude': json_data.get('geo', {}).get('latitude', ''),
+                'longitude': json_data.get('geo', {}).get('longitude', ''),
+                'url': json_data.get('url', ''),
+            })
+    return listings
+
+
+def fast_path(response, loads):
+    """The streaming extractor used by ``ZillowSpider.parse``."""
+    listings = []
+    for script_content in jsonld.iter_ld_json_blocks(response.body):
+        try:
+            json_data = loads(jsonld.decode_block(script_content, response.encoding))
+        except json.JSONDecodeError:
+            continue
+        fields = jsonld.map_listing(json_data) if isinstance(json_data, dict) else None
+        if fields:
+            listings.append(fields)
+    return listings
+
+
+def load_pages(paths):
+    if not paths:
+        return [make_search_page(page=page) for page in range(1, 6)]
+    pages = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+    return pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pages', nargs='*', help='Saved search result pages')
+    parser.add_argument('--repeat', type=int, default=20, help='Passes over the page set')
+    args = parser.parse_args()
+
+    bodies = load_pages(args.pages)
+
+    def fresh_responses():
+        # A new response per run, so the selector path pays for the DOM build
+        return [HtmlResponse(url='https://www.zillow.com/new-york-ny/', body=body, encoding='utf-8') for body in bodies]
+
+    baseline = [selector_path(r) for r in fresh_responses()]
+    candidates = {'selector+json': lambda r: selector_path(r)}
+    for name in jsonld.JSON_BACKENDS:
+        loads = jsonld.get_loads(name)
+        candidates[f'bytes-scan+{name}'] = lambda r, loads=loads: fast_path(r, loads)
+        # The fast path must produce exactly the same listings
+        assert [fast_path(r, loads) for r in fresh_responses()] == baseline, name
+
+    total_listings = sum(len(listings) for listings in baseline)
+    print(f"{len(bodies)} pages, {total_listings} listings, {args.repeat} passes")
+    reference = None
+    for name, func in candidates.items():
+        elapsed = min(timeit.repeat(
+            lambda: [func(r) for r in fresh_responses()],
+            number=1, repeat=args.repeat,
+        ))
+        per_page = elapsed / len(bodies) * 1000
+        reference = reference or elapsed
+        print(f"{name:<22} {per_page:8.3f} ms/page  {reference / elapsed:6.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Measure search page parsing throughput inline and in worker processes.
+
+Usage:
+    python -m benchmarks.bench_parse_executor [--count N] [--workers 1,2,4,...] [saved_page.html ...]
+
+Parses synthetic search pages (or saved ones) with ``parsing.search_page``,
+the function the spider's ``parse`` callback runs, first inline and then in
+process pools of growing size, as ``ParseExecutor`` does with
+PARSE_WORKERS. Pool throughput includes sending every body to a worker and
+the parsed listings back. The reactor side of the executor is not involved.
+"""
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.fixtures import make_search_page
+from zillow import parsing
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pages', nargs='*', help='Saved search pages; synthetic pages by default')
+    parser.add_argument('--count', type=int, default=2000, help='Pages to parse per run')
+    parser.add_argument('--workers', default=','.join(str(n) for n in (1, 2, 4, 8) if n <= (os.cpu_count() or 1)))
+    parser.add_argument('--start-method', default='spawn')
+    args = parser.parse_args()
+
+    if args.pages:
+        bodies = []
+        for path in args.pages:
+            with open(path, 'rb') as f:
+                bodies.append(f.read())
+    else:
+        bodies = [make_search_page(f"city-{i % 10}", i % 20 + 1, seed=i) for i in range(100)]
+    bodies = [bodies[i % len(bodies)] for i in range(args.count)]
+    print(f"{len(bodies)} pages, {sum(map(len, bodies)) / len(bodies) / 1024:.0f} KiB each, {os.cpu_count()} CPUs")
+
+    started = time.perf_counter()
+    listings = sum(len(parsing.search_page(body, 'utf-8', None, True)['listings']) for body in bodies)
+    inline = time.perf_counter() - started
+    print(f"inline:       {len(bodies) / inline:8,.0f} pages/s ({listings:,} listings)")
+
+    context = multiprocessing.get_context(args.start_method)
+    for workers in (int(n) for n in args.workers.split(',')):
+        with ProcessPoolExecutor(workers, mp_context=context) as pool:
+            # Start the workers before timing
+            list(pool.map(parsing.search_page, bodies[:workers]))
+            started = time.perf_counter()
+            pages = list(pool.map(parsing.search_page, bodies, ['utf-8'] * len(bodies), [None] * len(bodies),
+                                  [True] * len(bodies), chunksize=1))
+            elapsed = time.perf_counter() - started
+        assert sum(len(page['listings']) for page in pages) == listings
+        print(f"{workers:>2} workers:   {len(bodies) / elapsed:8,.0f} pages/s ({inline / elapsed:.1f}x inline)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Time price-cut queries on a price history holding years of daily crawls.
+
+Usage:
+    python -m benchmarks.bench_price_history [--listings N] [--days N] [--change-rate F]
+
+Fills a ``PriceHistory`` with the changes ``--days`` daily crawls of
+``--listings`` listings would have recorded: every day, a fraction of the
+listings gets a new price (mostly cuts) or Zestimate. The rows are written
+straight into the store's tables, since recording every observation of
+every day would take much longer than the queries being measured. The
+script then times one day's crawl through ``record`` and the "price cut of
+at least 5% in the last 14 days" query, overall and for one postal code.
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from zillow.history import DAY, PriceHistory
+
+
+def fill(history, listings, days, change_rate, seed=0):
+    """Write ``days`` of synthetic changes; return the end of the last day."""
+    rng = np.random.default_rng(seed)
+    start = int(time.time()) - days * DAY
+    zpids = np.arange(10_000_000, 10_000_000 + listings)
+    postal = rng.integers(10000, 13000, listings).astype(str)
+    price = rng.integers(2_000, 30_000, listings) * 10_000
+    zestimate = (price * rng.normal(1.0, 0.08, listings)).astype('int64')
+
+    rows = [(int(z), start, int(p), int(e), 'FOR_SALE') for z, p, e in zip(zpids, price, zestimate)]
+    for day in range(1, days):
+        observed_at = start + day * DAY
+        changed = np.flatnonzero(rng.random(listings) < change_rate)
+        price_delta = (price[changed] * rng.normal(-0.04, 0.03, len(changed))).astype('int64')
+        zestimate_changed = rng.random(len(changed)) < 0.5
+        zestimate_delta = (zestimate[changed] * rng.normal(0, 0.02, len(changed))).astype('int64')
+        price[changed] += price_delta
+        zestimate[changed] += np.where(zestimate_changed, zestimate_delta, 0)
+        rows.extend(
+            (int(z), observed_at, int(dp), int(dz) if zc else None, None)
+            for z, dp, dz, zc in zip(zpids[changed], price_delta, zestimate_delta, zestimate_changed)
+        )
+
+    history.conn.executemany(
+        'INSERT INTO changes (zpid, observed_at, price_delta, zestimate_delta, status) VALUES (?, ?, ?, ?, ?)', rows)
+    history.conn.executemany(
+        'INSERT INTO listings (zpid, postal_code, price_cents, zestimate_cents, status, first_seen, last_seen)'
+        ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+        [(int(z), pc, int(p), int(e), 'FOR_SALE', start, start + (days - 1) * DAY)
+         for z, pc, p, e in zip(zpids, postal, price, zestimate)],
+    )
+    history.commit()
+    return start + (days - 1) * DAY, postal, len(rows)
+
+
+def timed(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return result, statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--listings', type=int, default=100_000)
+    parser.add_argument('--days', type=int, default=730)
+    parser.add_argument('--change-rate', type=float, default=0.02, help='Share of listings changing per day')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'history.sqlite3')
+        history = PriceHistory(path)
+        started = time.perf_counter()
+        now, postal, changes = fill(history, args.listings, args.days, args.change_rate)
+        print(f"{changes:,} changes of {args.listings:,} listings over {args.days} days"
+              f" written in {time.perf_counter() - started:.1f} s; {os.path.getsize(path) / 1e6:.1f} MB")
+
+        # One more daily crawl through the pipeline's code path
+        listings = history.conn.execute('SELECT zpid, price_cents FROM listings').fetchall()
+        started = time.perf_counter()
+        for zpid, price in listings:
+            history.record(zpid, price - 100_000 if zpid % 50 == 0 else price, None, 'FOR_SALE', None, now + DAY)
+        history.commit()
+        elapsed = time.perf_counter() - started
+        print(f"record: {len(listings) / elapsed:,.0f} observations/s")
+
+        cuts, elapsed = timed(lambda: history.price_cuts(0.05, 14, now=now + DAY), args.repeat)
+        print(f"price_cuts(5%, 14 days): {len(cuts):,} listings in {elapsed * 1000:.1f} ms")
+        cuts, elapsed = timed(lambda: history.price_cuts(0.05, 14, postal_code=postal[0], now=now + DAY), args.repeat)
+        print(f"price_cuts(5%, 14 days, postal code {postal[0]}): {len(cuts):,} listings in {elapsed * 1000:.1f} ms")
+        rows, elapsed = timed(lambda: history.history(10_000_000), args.repeat)
+        print(f"history(zpid): {len(rows)} changes in {elapsed * 1000:.2f} ms")
+        history.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Measure the size and speed of the response store over simulated daily crawls.
+
+Usage:
+    python -m benchmarks.bench_response_store [--days N] [--cities N] [--pages N] [--changed F]
+
+Every simulated day crawls the same search pages, with fresh listings, and
+the details pages of their listings, of which a fraction ``--changed`` got
+a new Zestimate since the day before. Each crawl is stored in a
+``ResponseStore``, first with zlib and then with zstd (when installed).
+The script reports the stored size against the raw size and against gzip
+files per response, then times writes and lookups. The synthetic pages
+repeat more markup than real ones, so real pages compress less well.
+Saved pages (``--pages-dir``) give representative numbers.
+"""
+import argparse
+import glob
+import gzip
+import os
+import random
+import re
+import tempfile
+import time
+
+from benchmarks.fixtures import make_detail_page, make_search_page
+from zillow import httpcache
+from zillow.httpcache import ResponseStore
+
+
+def simulated_crawls(days, cities, pages, changed, saved_pages=()):
+    """Yield ``(crawl date, fingerprint, url, body)`` for every response of every day."""
+    rng = random.Random(0)
+    zestimates = {}
+    for day in range(days):
+        crawl_date = f"2024-05-{day + 1:02d}"
+        for city in range(cities):
+            for page in range(1, pages + 1):
+                url = f"https://www.zillow.com/city-{city}/{page}_p/"
+                body = make_search_page(f"city-{city}", page, seed=f"{city}/{page}/{day}")
+                yield crawl_date, url, url, body
+                for zpid in re.findall(rb'/(\d+)_zpid/', body)[:10]:
+                    zpid = int(zpid)
+                    if zpid not in zestimates or rng.random() < changed:
+                        zestimates[zpid] = rng.randint(200, 3000) * 1000
+                    detail_url = f"https://www.zillow.com/homedetails/{zpid}_zpid/"
+                    yield crawl_date, detail_url, detail_url, make_detail_page(zpid, zestimates[zpid])
+        for path in saved_pages:
+            with open(path, 'rb') as f:
+                yield crawl_date, path, path, f.read()
+
+
+def measure(label, responses, level):
+    with tempfile.TemporaryDirectory() as directory:
+        store = ResponseStore(os.path.join(directory, 'responses.sqlite3'), level=level)
+        started = time.perf_counter()
+        raw = gzipped = 0
+        for crawl_date, fingerprint, url, body in responses:
+            store.store(fingerprint, url, 200, {'Content-Type': ['text/html']}, body, crawl_date=crawl_date)
+            raw += len(body)
+            gzipped += len(gzip.compress(body, 6))
+        store.commit()
+        write = time.perf_counter() - started
+
+        fingerprints = [fingerprint for _, fingerprint, _, _ in responses]
+        started = time.perf_counter()
+        for fingerprint in fingerprints:
+            store.lookup(fingerprint)
+        read = time.perf_counter() - started
+        summary = store.summary()
+        store.close()
+        file_size = sum(os.path.getsize(path) for path in glob.glob(os.path.join(directory, '*')))
+
+    count = len(responses)
+    print(f"{label:<6} {count} responses, {summary['bodies']} distinct bodies:"
+          f" {raw / 1e6:.1f} MB raw, {gzipped / 1e6:.1f} MB as gzip files,"
+          f" {summary['stored_bytes'] / 1e6:.2f} MB of bodies ({raw / max(summary['stored_bytes'], 1):.0f}x),"
+          f" {file_size / 1e6:.2f} MB on disk")
+    print(f"{'':<6} write {count / write:,.0f} responses/s, lookup {count / read:,.0f} responses/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--cities', type=int, default=3)
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--changed', type=float, default=0.1, help='Share of details pages changing daily')
+    parser.add_argument('--level', type=int, default=9, help='Compression level')
+    parser.add_argument('--pages-dir', help='Also store the saved .html pages of this directory every day')
+    args = parser.parse_args()
+
+    saved_pages = sorted(glob.glob(os.path.join(args.pages_dir, '*.html'))) if args.pages_dir else ()
+    responses = list(simulated_crawls(args.days, args.cities, args.pages, args.changed, saved_pages))
+
+    zstandard = httpcache.zstandard
+    httpcache.zstandard = None
+    try:
+        measure('zlib', responses, args.level)
+    finally:
+        httpcache.zstandard = zstandard
+    if zstandard is not None:
+        measure('zstd', responses, args.level)
+    else:
+        print('zstandard is not installed; skipping zstd')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Time the deal scorer on synthetic listings.
+
+Usage:
+    python -m benchmarks.bench_scoring [--rows N] [--strings] [--repeat N]
+
+Builds N listings spread over a few hundred localities and a few thousand
+postal codes, then reports the time to score them. ``--strings`` stores the
+numbers as scraped text ('$1,250,000'), which adds the vectorized parsing
+to the measurement.
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from zillow.scoring import score_listings
+
+
+def make_listings(rows, strings=False, seed=0):
+    rng = np.random.default_rng(seed)
+    postal = rng.integers(10000, 13000, rows)
+    locality = postal // 10
+    base_ppsf = 200 + (locality % 50) * 20
+    floor_size = rng.integers(400, 4000, rows).astype('float64')
+    price = floor_size * base_ppsf * rng.lognormal(0, 0.25, rows)
+    zestimate = price * rng.normal(1.0, 0.08, rows)
+    tax = price * rng.normal(0.8, 0.1, rows)
+    # Some listings lack a Zestimate or tax record
+    zestimate[rng.random(rows) < 0.1] = np.nan
+    tax[rng.random(rows) < 0.3] = np.nan
+
+    frame = pd.DataFrame({
+        'postal_code': postal.astype(str),
+        'address_locality': 'city-' + pd.Series(locality).astype(str),
+        'price': price.round(),
+        'floor_size': floor_size,
+        'zestimate_value': zestimate.round(),
+        'tax_assessed_value': tax.round(),
+    })
+    if strings:
+        frame['price'] = frame['price'].map('${:,.0f}'.format)
+        frame['floor_size'] = frame['floor_size'].map('{:,.0f} sqft'.format)
+    return frame
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--strings', action='store_true', help='Store prices and sizes as scraped text')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    listings = make_listings(args.rows, args.strings)
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        scored = score_listings(listings)
+        timings.append(time.perf_counter() - started)
+
+    best = min(timings)
+    print(f"{args.rows} rows: {best:.2f} s best of {args.repeat}, {args.rows / best / 1e6:.2f} M rows/s")
+    print(f"scored: {scored['deal_score'].notna().mean():.1%}, "
+          f"postal codes: {listings['postal_code'].nunique()}, localities: {listings['address_locality'].nunique()}")
+
+
+if __name__ == '__main__':
+    main()
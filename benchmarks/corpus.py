@@ -0,0 +1,232 @@
+"""Record and replay Zillow responses for offline benchmarks.
+
+A corpus is a directory holding ``index.jsonl`` (one line per response) and
+the response bodies under ``bodies/``, named by the SHA-1 of their content.
+
+Record a corpus once against the live site::
+
+    scrapy crawl zillowspider -a city_names="new york ny" \\
+        -s BENCHMARK_RECORD_DIR=benchmarks/corpus \\
+        -s DOWNLOADER_MIDDLEWARES='{"benchmarks.corpus.RecordResponsesMiddleware": 100}'
+
+or build a synthetic one without any network access::
+
+    python -m benchmarks.corpus synth benchmarks/corpus --cities 3 --pages 5
+
+``ReplayDownloadHandler`` then serves the corpus to Scrapy in place of the
+HTTP download handlers, see ``benchmarks.crawl_benchmark``.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+
+from w3lib.url import canonicalize_url
+
+from benchmarks.fixtures import make_detail_page, make_search_page
+
+
+class Corpus:
+    """A directory of recorded responses keyed by canonical URL."""
+
+    def __init__(self, path):
+        self.path = path
+        self.bodies_dir = os.path.join(path, 'bodies')
+        self.index_path = os.path.join(path, 'index.jsonl')
+        self.meta_path = os.path.join(path, 'corpus.json')
+        self.entries = {}
+        self.start_urls = []
+
+    @classmethod
+    def load(cls, path):
+        corpus = cls(path)
+        if os.path.exists(corpus.meta_path):
+            with open(corpus.meta_path) as f:
+                corpus.start_urls = json.load(f).get('start_urls', [])
+        if os.path.exists(corpus.index_path):
+            with open(corpus.index_path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        corpus.entries[canonicalize_url(entry['url'])] = entry
+        return corpus
+
+    def add(self, url, body, status=200, headers=None, callback=None, start=False):
+        """Store a response body and append it to the index."""
+        os.makedirs(self.bodies_dir, exist_ok=True)
+        digest = hashlib.sha1(body).hexdigest()
+        body_path = os.path.join(self.bodies_dir, digest)
+        if not os.path.exists(body_path):
+            with open(body_path, 'wb') as f:
+                f.write(body)
+
+        entry = {'url': url, 'status': status, 'headers': headers or {}, 'body': digest, 'callback': callback}
+        self.entries[canonicalize_url(url)] = entry
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+        if start and url not in self.start_urls:
+            self.start_urls.append(url)
+            self.save_meta()
+
+    def save_meta(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.meta_path, 'w') as f:
+            json.dump({'start_urls': self.start_urls}, f, indent=2)
+
+    def get(self, url):
+        return self.entries.get(canonicalize_url(url))
+
+    def read_body(self, entry):
+        with open(os.path.join(self.bodies_dir, entry['body']), 'rb') as f:
+            return f.read()
+
+
+class RecordResponsesMiddleware:
+    """Downloader middleware copying every final response into a corpus.
+
+    Install it with a low order number (e.g. 100) so it sees responses after
+    decompression and redirects.
+    """
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        from scrapy.exceptions import NotConfigured
+
+        path = crawler.settings.get('BENCHMARK_RECORD_DIR')
+        if not path:
+            raise NotConfigured('BENCHMARK_RECORD_DIR is not set')
+        return cls(Corpus.load(path))
+
+    def process_response(self, request, response, spider):
+        headers = {
+            key.decode('latin-1'): [value.decode('latin-1') for value in values]
+            for key, values in response.headers.items()
+            # The body is stored decoded, so these no longer apply
+            if key.lower() not in (b'content-encoding', b'content-length', b'transfer-encoding')
+        }
+        callback = getattr(request.callback, '__name__', None)
+        self.corpus.add(
+            response.url, response.body, status=response.status, headers=headers,
+            callback=callback, start=request.meta.get('depth', 0) == 0 and callback is None,
+        )
+        return response
+
+
+class ReplayDownloadHandler:
+    """Download handler answering requests from a recorded corpus.
+
+    URLs missing from the corpus get an empty 404 response, so the crawl
+    never touches the network.
+    """
+
+    lazy = False
+
+    def __init__(self, settings):
+        from scrapy.exceptions import NotConfigured
+
+        path = settings.get('BENCHMARK_CORPUS_DIR')
+        if not path:
+            raise NotConfigured('BENCHMARK_CORPUS_DIR is not set')
+        self.corpus = Corpus.load(path)
+        self._bodies = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def download_request(self, request, spider):
+        from scrapy.http import Headers
+        from scrapy.responsetypes import responsetypes
+        from twisted.internet import defer
+
+        entry = self.corpus.get(request.url)
+        if entry is None:
+            return defer.succeed(responsetypes.from_args(url=request.url)(url=request.url, status=404, request=request))
+
+        # Bodies are read once and kept, so disk I/O does not skew the timings
+        body = self._bodies.get(entry['body'])
+        if body is None:
+            body = self._bodies[entry['body']] = self.corpus.read_body(entry)
+        headers = Headers(entry['headers'])
+        respcls = responsetypes.from_args(headers=headers, url=request.url, body=body)
+        return defer.succeed(respcls(url=request.url, status=entry['status'], headers=headers, body=body, request=request))
+
+    def close(self):
+        pass
+
+
+def build_synthetic_corpus(path, cities=3, pages=5, listings=40):
+    """Write a synthetic corpus of search, detail and search-state pages."""
+    corpus = Corpus(path)
+    html_headers = {'Content-Type': ['text/html; charset=utf-8']}
+    json_headers = {'Content-Type': ['application/json']}
+    for city_index in range(cities):
+        city = f"city-{city_index}"
+        for page in range(1, pages + 1):
+            url = f"https://www.zillow.com/{city}/{page}_p/"
+            body = make_search_page(city=city, page=page, listings=listings)
+            corpus.add(url, body, headers=html_headers, start=True)
+            for detail_url in set(re.findall(rb'"url": "([^"]+/(\d+)_zpid/)"', body)):
+                corpus.add(detail_url[0].decode(), make_detail_page(int(detail_url[1])), headers=html_headers, callback='parse_home_details')
+
+        state_url = f"https://www.zillow.com/search/GetSearchPageState.htm?city={city}"
+        corpus.add(state_url, json.dumps(make_page_state(city, listings)).encode(), headers=json_headers, callback='parse_page_state')
+    return corpus
+
+
+def make_page_state(city, listings=40):
+    """Return a synthetic search page state payload for ``parse_page_state``."""
+    rng = random.Random(city)
+    results = []
+    for _ in range(listings):
+        results.append({'hdpData': {'homeInfo': {
+            'zpid': rng.randint(10_000_000, 99_999_999),
+            'streetAddress': f"{rng.randint(1, 9999)} Main St",
+            'zipcode': str(rng.randint(10001, 11697)),
+            'city': city,
+            'state': 'NY',
+            'latitude': 40.5 + rng.random() * 0.4,
+            'longitude': -74.2 + rng.random() * 0.5,
+            'price': rng.randint(200, 3000) * 1000,
+            'dateSold': 0,
+            'bathrooms': rng.randint(1, 4),
+            'bedrooms': rng.randint(1, 6),
+            'livingArea': rng.randint(400, 4000),
+            'homeType': 'SINGLE_FAMILY',
+            'taxAssessedValue': rng.randint(100, 2000) * 1000,
+            'lotAreaValue': rng.randint(1000, 9000),
+            'lotAreaUnit': 'sqft',
+        }}})
+    return {'cat1': {'searchResults': {'listResults': results}}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage benchmark corpora')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    synth = subparsers.add_parser('synth', help='Build a synthetic corpus')
+    synth.add_argument('path')
+    synth.add_argument('--cities', type=int, default=3)
+    synth.add_argument('--pages', type=int, default=5)
+    synth.add_argument('--listings', type=int, default=40)
+    info = subparsers.add_parser('info', help='Summarize a corpus')
+    info.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'synth':
+        corpus = build_synthetic_corpus(args.path, args.cities, args.pages, args.listings)
+    else:
+        corpus = Corpus.load(args.path)
+    callbacks = {}
+    for entry in corpus.entries.values():
+        callbacks[entry['callback'] or 'parse'] = callbacks.get(entry['callback'] or 'parse', 0) + 1
+    print(f"{corpus.path}: {len(corpus.entries)} responses, {len(corpus.start_urls)} start URLs, {callbacks}")
+
+
+if __name__ == '__main__':
+    main()
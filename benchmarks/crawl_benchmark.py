@@ -0,0 +1,240 @@
+"""Replay a recorded corpus through the full Scrapy stack and report throughput.
+
+Usage:
+    python -m benchmarks.crawl_benchmark run benchmarks/corpus -o results.json
+    python -m benchmarks.crawl_benchmark compare before.json after.json
+
+The real ``ZillowSpider`` runs with the project settings and its configured
+``ITEM_PIPELINES``; only the HTTP download handlers are swapped for
+``benchmarks.corpus.ReplayDownloadHandler``. The results file holds overall
+throughput, peak RSS and CPU time, plus latency percentiles and CPU time for
+every spider callback and pipeline stage.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from zillow.metrics import instrument_callbacks, instrument_methods, timed_call, timed_callback
+
+CALLBACKS = ('parse', 'parse_home_details', 'parse_page_state')
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class StageTimer:
+    """Collects wall-clock latencies and CPU time for one named stage."""
+
+    def __init__(self):
+        self.latencies = []
+        self.cpu = 0.0
+
+    def add(self, wall, cpu):
+        self.latencies.append(wall)
+        self.cpu += cpu
+
+    def summary(self):
+        values = sorted(self.latencies)
+        total = sum(values)
+        return {
+            'calls': len(values),
+            'total_s': total,
+            'cpu_s': self.cpu,
+            'per_sec': len(values) / total if total else 0.0,
+            'p50_ms': percentile(values, 0.50) * 1000,
+            'p90_ms': percentile(values, 0.90) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+            'max_ms': (values[-1] if values else 0.0) * 1000,
+        }
+
+
+class BenchmarkExtension:
+    """Times spider callbacks and pipeline stages during a benchmark crawl."""
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.callbacks = defaultdict(StageTimer)
+        self.pipelines = defaultdict(StageTimer)
+        self.started = None
+        self.finished = None
+        self.cpu_started = None
+        self.cpu_finished = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        from scrapy import signals
+
+        ext = cls(crawler)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.benchmark = ext
+        return ext
+
+    def spider_opened(self, spider):
+        instrument_callbacks(spider, CALLBACKS, self._time_callback)
+        instrument_methods(self.crawler.engine.scraper.itemproc, 'process_item', self._time_pipeline)
+
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+
+    def spider_closed(self, spider):
+        self.finished = time.perf_counter()
+        self.cpu_finished = time.process_time()
+
+    def _time_callback(self, name, callback):
+        timer = self.callbacks[name]
+        return timed_callback(name, callback, lambda call: timer.add(call.wall, call.cpu))
+
+    def _time_pipeline(self, method):
+        return timed_call(method, self.pipelines[type(method.__self__).__name__].add)
+
+    def report(self):
+        stats = self.crawler.stats.get_stats()
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        pages = stats.get('response_received_count', 0)
+        items = stats.get('item_scraped_count', 0)
+        return {
+            'elapsed_s': elapsed,
+            'cpu_s': (self.cpu_finished or time.process_time()) - self.cpu_started,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'pages': pages,
+            'items': items,
+            'items_dropped': stats.get('item_dropped_count', 0),
+            'pages_per_sec': pages / elapsed if elapsed else 0.0,
+            'items_per_sec': items / elapsed if elapsed else 0.0,
+            'callbacks': {name: timer.summary() for name, timer in self.callbacks.items()},
+            'pipelines': {name: timer.summary() for name, timer in self.pipelines.items()},
+        }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(corpus_path, output=None, concurrency=32, spider_args=None, log_level='WARNING', overrides=None):
+    """Crawl ``corpus_path`` with the replay handler and return the report."""
+    from scrapy import Request
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    from benchmarks.corpus import Corpus
+    from zillow.spiders.zillowspider import ZillowSpider
+
+    corpus = Corpus.load(corpus_path)
+    seeds = [entry for entry in corpus.entries.values() if entry['callback'] == 'parse_page_state']
+
+    class ReplaySpider(ZillowSpider):
+        # Start from the recorded start pages, plus any recorded search-state
+        # payloads since nothing in the spider links to them yet
+        async def start(self):
+            for request in self.start_requests():
+                yield request
+
+        def start_requests(self):
+            for url in corpus.start_urls:
+                yield Request(url, dont_filter=True)
+            for entry in seeds:
+                yield Request(entry['url'], callback=self.parse_page_state, dont_filter=True)
+
+    settings = get_project_settings()
+    settings.set('BENCHMARK_CORPUS_DIR', corpus_path)
+    settings.set('DOWNLOAD_HANDLERS', {
+        'http': 'benchmarks.corpus.ReplayDownloadHandler',
+        'https': 'benchmarks.corpus.ReplayDownloadHandler',
+    })
+    settings.set('DOWNLOAD_DELAY', 0)
+    settings.set('AUTOTHROTTLE_ENABLED', False)
+    settings.set('CONCURRENT_REQUESTS', concurrency)
+    settings.set('CONCURRENT_REQUESTS_PER_DOMAIN', concurrency)
+    settings.set('LOG_LEVEL', log_level)
+    settings.set('TELNETCONSOLE_ENABLED', False)
+    settings.setdict(overrides or {})
+    extensions = dict(settings.getdict('EXTENSIONS'))
+    extensions['benchmarks.crawl_benchmark.BenchmarkExtension'] = 0
+    settings.set('EXTENSIONS', extensions)
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(ReplaySpider)
+    process.crawl(crawler, **(spider_args or {}))
+    process.start()
+
+    report = crawler.benchmark.report()
+    if not report['pages'] or not report['items']:
+        # Numbers from a crawl that did nothing would only look like a speedup
+        raise RuntimeError(f"The benchmark crawl of {corpus_path} received {report['pages']} responses and"
+                           f" scraped {report['items']} items; check the corpus and the log")
+    report.update({
+        'revision': git_revision(),
+        'corpus': os.path.abspath(corpus_path),
+        'corpus_responses': len(corpus.entries),
+        'concurrency': concurrency,
+        'item_pipelines': sorted(settings.getdict('ITEM_PIPELINES')),
+        'settings': overrides or {},
+    })
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def compare(before, after):
+    """Print the relative change of the headline numbers between two reports."""
+    rows = [('pages_per_sec', before['pages_per_sec'], after['pages_per_sec']),
+            ('items_per_sec', before['items_per_sec'], after['items_per_sec']),
+            ('cpu_s', before['cpu_s'], after['cpu_s']),
+            ('peak_rss_mb', before['peak_rss_mb'], after['peak_rss_mb'])]
+    for group in ('callbacks', 'pipelines'):
+        for name in sorted(set(before[group]) | set(after[group])):
+            for key in ('p50_ms', 'p99_ms', 'cpu_s'):
+                rows.append((f"{group}.{name}.{key}",
+                             before[group].get(name, {}).get(key, 0.0),
+                             after[group].get(name, {}).get(key, 0.0)))
+    print(f"{'metric':<48} {before.get('revision') or 'before':>12} {after.get('revision') or 'after':>12} {'change':>9}")
+    for name, old, new in rows:
+        change = f"{(new - old) / old * 100:+8.1f}%" if old else '      n/a'
+        print(f"{name:<48} {old:12.3f} {new:12.3f} {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='Replay a corpus through the spider')
+    run_parser.add_argument('corpus')
+    run_parser.add_argument('-o', '--output', help='Write the JSON report here')
+    run_parser.add_argument('-c', '--concurrency', type=int, default=32)
+    run_parser.add_argument('-a', dest='spider_args', action='append', default=[], metavar='NAME=VALUE',
+                            help='Spider argument, as with scrapy crawl -a')
+    run_parser.add_argument('-s', dest='settings', action='append', default=[], metavar='NAME=VALUE',
+                            help='Setting, as with scrapy crawl -s, e.g. PARSE_WORKERS=4')
+    run_parser.add_argument('--log-level', default='WARNING')
+    compare_parser = subparsers.add_parser('compare', help='Compare two JSON reports')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.before) as f, open(args.after) as g:
+            compare(json.load(f), json.load(g))
+        return
+
+    spider_args = dict(arg.split('=', 1) for arg in args.spider_args)
+    overrides = dict(setting.split('=', 1) for setting in args.settings)
+    report = run(args.corpus, args.output, args.concurrency, spider_args, args.log_level, overrides)
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# Synthetic Zillow pages used by the benchmarks when no saved pages are given.
+#
+# The markup mimics the parts of a real search page that the spider cares
+# about (one ld+json block per listing) plus a realistic amount of filler so
+# that DOM construction costs are representative.
+
+import json
+import random
+
+FILLER_CARD = (
+    '<li class="ListItem"><article class="property-card" data-test="property-card">'
+    '<div class="property-card-data"><a class="property-card-link" href="{url}">'
+    '<address>{address}</address></a><div class="price-row"><span data-test="property-card-price">'
+    '${price:,}</span></div><ul class="property-card-details"><li><b>{beds}</b> bds</li>'
+    '<li><b>{baths}</b> ba</li><li><b>{sqft:,}</b> sqft</li></ul></div>'
+    '<picture><img src="https://photos.zillowstatic.com/fp/{zpid}-p_e.jpg" alt=""/></picture>'
+    '</article></li>'
+)
+
+
+def make_listing(rng, zpid, city='New York', region='NY'):
+    """Return a JSON-LD listing shaped like the ones on Zillow search pages."""
+    street = f"{rng.randint(1, 9999)} {rng.choice(['Main', 'Oak', 'Pine', 'Maple', 'Cedar'])} St"
+    postal_code = f"{rng.randint(10001, 11697)}"
+    slug = '-'.join(f"{street} {city} {region} {postal_code}".split())
+    return {
+        '@type': rng.choice(['SingleFamilyResidence', 'Apartment', 'House']),
+        '@context': 'http://schema.org',
+        'name': f"{street}, {city}, {region} {postal_code}",
+        'floorSize': {'@type': 'QuantitativeValue', '@context': 'http://schema.org', 'value': f"{rng.randint(400, 4000):,}"},
+        'address': {
+            '@type': 'PostalAddress',
+            '@context': 'http://schema.org',
+            'streetAddress': street,
+            'addressLocality': city,
+            'addressRegion': region,
+            'postalCode': postal_code,
+        },
+        'geo': {
+            '@type': 'GeoCoordinates',
+            '@context': 'http://schema.org',
+            'latitude': round(40.5 + rng.random() * 0.4, 6),
+            'longitude': round(-74.2 + rng.random() * 0.5, 6),
+        },
+        'url': f"https://www.zillow.com/homedetails/{slug}/{zpid}_zpid/",
+    }
+
+
+def make_search_page(city='new-york-ny', page=1, listings=40, seed=None):
+    """Build a synthetic search results page.
+
+    Args:
+        city (str): City slug, only used to seed the generator.
+        page (int): Page number, only used to seed the generator.
+        listings (int): Number of listings on the page.
+        seed (int): Optional explicit random seed.
+
+    Returns:
+        bytes: The page HTML.
+    """
+    rng = random.Random(seed if seed is not None else f"{city}/{page}")
+    scripts = []
+    cards = []
+    for _ in range(listings):
+        zpid = rng.randint(10_000_000, 99_999_999)
+        listing = make_listing(rng, zpid)
+        scripts.append(f'<script type="application/ld+json">{json.dumps(listing)}</script>')
+        cards.append(FILLER_CARD.format(
+            url=listing['url'], address=listing['name'], price=rng.randint(200, 3000) * 1000,
+            beds=rng.randint(1, 6), baths=rng.randint(1, 4), sqft=rng.randint(400, 4000), zpid=zpid,
+        ))
+    return (
+        '<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"/><title>Zillow</title>'
+        + '<script>window.__config = {"filler": "' + 'x' * 20_000 + '"};</script>'
+        + '</head><body><div id="grid-search-results"><ul class="photo-cards">'
+        + ''.join(cards)
+        + '</ul></div>'
+        + ''.join(scripts)
+        + '</body></html>'
+    ).encode('utf-8')
+
+
+def make_detail_page(zpid=None, zestimate=None, seed=None):
+    """Build a synthetic home details page carrying a Zestimate chip."""
+    rng = random.Random(seed if seed is not None else zpid)
+    zestimate = zestimate if zestimate is not None else rng.randint(200, 3000) * 1000
+    chip = json.dumps({'homeValue': {'amount': zestimate, 'currency': 'USD'}})
+    return (
+        '<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"/><title>Home details</title></head><body>'
+        + '<div class="summary">' + '<p>Lorem ipsum dolor sit amet.</p>' * 200 + '</div>'
+        + f'<div data-testid="home-details-chip-container"><script>{chip}</script></div>'
+        + '</body></html>'
+    ).encode('utf-8')
+
+
+def make_card_page(listings=40, seed=0):
+    """Build a synthetic search page with the list-card markup ``app.py`` scrapes."""
+    rng = random.Random(seed)
+    cards = []
+    for _ in range(listings):
+        zpid = rng.randint(10_000_000, 99_999_999)
+        cards.append(
+            '<li><article class="list-card list-card_not-saved"><div class="list-card-info">'
+            f'<a class="list-card-link list-card-link-top-margin" href="https://www.zillow.com/homedetails/{zpid}_zpid/">'
+            f'<address class="list-card-addr">{rng.randint(1, 9999)} Main St, Brooklyn, NY {rng.randint(11201, 11256)}</address></a>'
+            '<div class="list-card-heading">'
+            f'<div class="list-card-price">${rng.randint(200, 3000) * 1000:,}</div>'
+            f'<ul class="list-card-details"><li>{rng.randint(1, 6)}<abbr class="list-card-label"> <!-- -->bds</abbr></li>'
+            f'<li>{rng.randint(1, 4)}<abbr class="list-card-label"> <!-- -->ba</abbr></li>'
+            f'<li>{rng.randint(400, 4000):,}<abbr class="list-card-label"> <!-- -->sqft</abbr></li></ul>'
+            '</div></div>'
+            f'<div class="list-card-top"><img src="https://photos.zillowstatic.com/fp/{zpid}-p_e.jpg" alt=""/></div>'
+            '</article></li>'
+        )
+    return (
+        '<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"/><title>Zillow</title></head><body>'
+        + '<nav>' + '<a href="#">Link</a>' * 300 + '</nav>'
+        + '<div id="grid-search-results"><ul class="photo-cards">' + ''.join(cards) + '</ul></div>'
+        + '<footer>' + '<p>Lorem ipsum dolor sit amet.</p>' * 300 + '</footer>'
+        + '</body></html>'
+    ).encode('utf-8')
@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+import pytest
+from scrapy import Spider
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+
+from benchmarks.fixtures import make_search_page
+from zillow.middlewares import ZillowDownloaderMiddleware, block_reason
+
+SEARCH_URL = 'https://www.zillow.com/brooklyn-ny/4_p/'
+EMPTY_SEARCH_PAGE = (
+    b'<!DOCTYPE html><html><head><script id="__NEXT_DATA__" type="application/json">'
+    b'{"props":{"pageProps":{"searchPageState":{"queryState":{},"cat1":{"searchResults":{"listResults":[]}}}}}}'
+    b'</script></head><body><div id="grid-search-results"><h5>No matching results</h5></div></body></html>'
+)
+DECOY_PAGE = b'<!DOCTYPE html><html><head><title>Zillow</title></head><body><div id="root"></div></body></html>'
+CAPTCHA_PAGE = b'<html><body><div id="px-captcha"></div>Please verify you\'re a human</body></html>'
+
+
+def search_response(body, status=200):
+    request = Request(SEARCH_URL, cb_kwargs={'city': 'brooklyn-ny', 'page': 4}, meta={'download_slot': 'www.zillow.com'})
+    return HtmlResponse(SEARCH_URL, status=status, body=body, request=request)
+
+
+@pytest.mark.parametrize('body, status, reason', [
+    (make_search_page(listings=3), 200, None),
+    (EMPTY_SEARCH_PAGE, 200, None),
+    (DECOY_PAGE, 200, 'no_search_markup'),
+    (CAPTCHA_PAGE, 200, 'captcha'),
+    (make_search_page(listings=3), 403, '403'),
+    (b'', 429, '429'),
+])
+def test_block_reason(body, status, reason):
+    response = search_response(body, status)
+    assert block_reason(response.request, response, None) == reason
+
+
+def test_block_reason_only_checks_search_pages_for_markup():
+    request = Request('https://www.zillow.com/homedetails/1_zpid/')
+    response = HtmlResponse(request.url, body=DECOY_PAGE, request=request)
+    assert block_reason(request, response, None) is None
+
+
+@pytest.fixture
+def middleware():
+    crawler = get_crawler(Spider, {'ADAPTIVE_START_CONCURRENCY': 8, 'ADAPTIVE_BLOCK_RETRIES': 5})
+    spider = Spider.from_crawler(crawler, name='zillowspider')
+    slot = SimpleNamespace(concurrency=8, delay=0.5)
+    engine = SimpleNamespace(downloader=SimpleNamespace(slots={'www.zillow.com': slot}))
+    stand_in = SimpleNamespace(settings=crawler.settings, stats=crawler.stats, engine=engine)
+    return ZillowDownloaderMiddleware(stand_in), spider, slot
+
+
+def test_empty_last_page_is_not_retried(middleware):
+    middleware, spider, slot = middleware
+    response = search_response(EMPTY_SEARCH_PAGE)
+
+    assert middleware.process_response(response.request, response, spider) is response
+    assert slot.concurrency == 8
+    assert not middleware.stats.get_value('adaptive/blocked')
+
+
+def test_decoy_page_is_retried_and_backs_off(middleware):
+    middleware, spider, slot = middleware
+    response = search_response(DECOY_PAGE)
+
+    retry = middleware.process_response(response.request, response, spider)
+    assert isinstance(retry, Request)
+    assert retry.meta['retry_times'] == 1
+    assert slot.concurrency == 4
+    assert slot.delay == 1.0
+    assert middleware.stats.get_value('adaptive/blocked/no_search_markup') == 1
@@ -0,0 +1,166 @@
+import time
+
+import pytest
+
+from zillow.distributed import Frontier, merge_outputs
+from zillow.scoring import pd, read_listings
+
+
+@pytest.fixture
+def frontier(tmp_path):
+    frontier = Frontier(str(tmp_path / 'frontier.sqlite3'), lease_timeout=60, max_attempts=3)
+    yield frontier
+    frontier.close()
+
+
+def test_pop_highest_priority_first(frontier):
+    frontier.push(b'low', priority=0)
+    frontier.push(b'high', priority=10)
+    frontier.push(b'mid', priority=5)
+
+    assert [payload for _, payload in frontier.pop('w1', limit=2)] == [b'high', b'mid']
+    assert [payload for _, payload in frontier.pop('w2', limit=2)] == [b'low']
+    assert frontier.pop('w2') == []
+
+
+def test_push_filters_seen_fingerprints(frontier):
+    assert frontier.push(b'a', fingerprint='f1')
+    assert not frontier.push(b'again', fingerprint='f1')
+    assert frontier.push(b'unfiltered')
+    assert frontier.push(b'unfiltered')
+
+    assert frontier.pending() == 3
+    assert frontier.seen() == 1
+
+
+def test_ack_removes_leased_request(frontier):
+    frontier.push(b'a')
+    frontier.push(b'b')
+    (request_id, _), = frontier.pop('w1')
+
+    assert (frontier.pending(), frontier.in_flight()) == (1, 1)
+    frontier.ack(request_id)
+    assert (frontier.pending(), frontier.in_flight()) == (1, 0)
+    assert [payload for _, payload in frontier.pop('w1')] == [b'b']
+
+
+def test_replaces_acks_in_same_push(frontier):
+    frontier.push(b'a', fingerprint='f1')
+    (request_id, _), = frontier.pop('w1')
+
+    assert frontier.push(b'retry of a', replaces=request_id)
+    assert (frontier.pending(), frontier.in_flight()) == (1, 0)
+
+
+def test_expired_lease_goes_to_another_worker(tmp_path):
+    frontier = Frontier(str(tmp_path / 'frontier.sqlite3'), lease_timeout=0.05)
+    frontier.push(b'a')
+    (request_id, _), = frontier.pop('w1')
+    assert frontier.pop('w2') == []
+
+    time.sleep(0.1)
+    assert frontier.pending() == 1
+    assert frontier.pop('w2') == [(request_id, b'a')]
+    frontier.close()
+
+
+def test_renew_keeps_lease(tmp_path):
+    frontier = Frontier(str(tmp_path / 'frontier.sqlite3'), lease_timeout=0.2)
+    frontier.push(b'a')
+    frontier.pop('w1')
+
+    for _ in range(3):
+        time.sleep(0.1)
+        frontier.renew('w1')
+    assert frontier.pop('w2') == []
+    assert frontier.in_flight() == 1
+    frontier.close()
+
+
+def test_release_hands_back_without_counting_attempt(frontier):
+    frontier.push(b'a')
+    frontier.push(b'b')
+    leased = frontier.pop('w1', limit=2)
+
+    frontier.release('w1', [leased[0][0]])
+    assert (frontier.pending(), frontier.in_flight()) == (1, 1)
+    frontier.release('w1')
+    assert (frontier.pending(), frontier.in_flight()) == (2, 0)
+
+    row = frontier.conn.execute('SELECT attempts FROM requests WHERE id = ?', (leased[0][0],)).fetchone()
+    assert row == (0,)
+
+
+def test_request_abandoned_after_max_attempts(tmp_path):
+    frontier = Frontier(str(tmp_path / 'frontier.sqlite3'), lease_timeout=0.01, max_attempts=2)
+    frontier.push(b'poison')
+
+    for worker in ('w1', 'w2'):
+        assert len(frontier.pop(worker)) == 1
+        time.sleep(0.02)
+    assert frontier.pop('w3') == []
+    assert frontier.abandoned == 1
+    assert frontier.pending() == frontier.in_flight() == 0
+    frontier.close()
+
+
+def test_shards_and_buckets(frontier):
+    frontier.push(b'brooklyn', shard='brooklyn')
+    frontier.push(b'queens', shard='queens')
+
+    assert [payload for _, payload in frontier.pop('w1', limit=5, shards=['queens'])] == [b'queens']
+    frontier.release('w1')
+    taken = [payload for index in range(2) for _, payload in frontier.pop('w1', limit=5, bucket=(index, 2))]
+    assert sorted(taken) == [b'brooklyn', b'queens']
+
+
+def test_ack_worker_removes_only_live_leases(frontier):
+    frontier.push(b'a')
+    frontier.push(b'b')
+    frontier.pop('w1')
+
+    assert frontier.ack_worker('w1') == 1
+    assert (frontier.pending(), frontier.in_flight()) == (1, 0)
+
+
+def test_merge_outputs_keeps_last_copy(tmp_path):
+    first = tmp_path / 'listings-w1.jsonl'
+    second = tmp_path / 'listings-w2.jsonl'
+    pd.DataFrame([
+        {'zpid': '1', 'url': 'https://example.com/1', 'price': '100'},
+        {'zpid': '2', 'url': 'https://example.com/2', 'price': '200'},
+        {'zpid': None, 'url': 'https://example.com/x', 'price': '50'},
+    ]).to_json(first, orient='records', lines=True)
+    pd.DataFrame([
+        {'zpid': '1', 'url': 'https://example.com/1', 'price': '90'},
+        {'zpid': None, 'url': 'https://example.com/x', 'price': '55'},
+        {'zpid': '3', 'url': 'https://example.com/3', 'price': '300'},
+    ]).to_json(second, orient='records', lines=True)
+    output = tmp_path / 'listings.csv'
+
+    assert merge_outputs([str(tmp_path / 'listings-*.jsonl')], str(output)) == 4
+    merged = read_listings(str(output)).set_index('url')['price'].to_dict()
+    assert merged == {
+        'https://example.com/2': '200',
+        'https://example.com/1': '90',
+        'https://example.com/x': '55',
+        'https://example.com/3': '300',
+    }
+
+
+def test_merge_outputs_skips_its_own_output(tmp_path):
+    part = tmp_path / 'listings-w1.csv'
+    pd.DataFrame([{'zpid': '1', 'price': '100'}]).to_csv(part, index=False)
+    output = tmp_path / 'listings-all.csv'
+    pd.DataFrame([{'zpid': '1', 'price': 'stale'}]).to_csv(output, index=False)
+
+    assert merge_outputs([str(tmp_path / 'listings-*.csv')], str(output)) == 1
+    assert read_listings(str(output))['price'].tolist() == ['100']
+
+
+def test_merge_outputs_without_inputs(tmp_path):
+    output = tmp_path / 'listings.csv'
+    pd.DataFrame([{'zpid': '1'}]).to_csv(output, index=False)
+
+    with pytest.raises(ValueError):
+        merge_outputs([str(tmp_path / '*.csv')], str(output))
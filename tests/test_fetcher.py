@@ -0,0 +1,129 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from zillow.fetcher import ListingFetcher
+
+PER_PAGE = 3
+
+
+def card(page, index):
+    return (
+        f'<article><a class="list-card-link" href="/homedetails/{page}-{index}/">'
+        f'<address class="list-card-addr">{index} Main St, Page {page}</address></a>'
+        f'<div class="list-card-price">${page},{index:03d}</div>'
+        f'<ul class="list-card-details"><li>3 bds</li><li>2 ba</li></ul></article>'
+    )
+
+
+class StubServer:
+    """Serves ``pages`` search pages at /homes/, /homes/2_p/, ..., and a 404 after them.
+
+    Requests for the pages in ``drop`` are answered by closing the connection.
+    """
+
+    def __init__(self, pages, status=200, drop=()):
+        self.pages = pages
+        self.status = status
+        self.drop = drop
+        self.requested = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requested.append(self.path)
+                page = 1 if self.path == '/homes/' else int(self.path.split('/')[2].split('_')[0])
+                if page in stub.drop:
+                    self.close_connection = True
+                    return
+                if stub.status != 200 or page > stub.pages:
+                    self.send_response(stub.status if stub.status != 200 else 404)
+                    self.end_headers()
+                    return
+                body = ''.join(card(page, index) for index in range(PER_PAGE)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}/homes/'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def test_page_url():
+    assert ListingFetcher.page_url('https://example.com/homes/', 1) == 'https://example.com/homes/'
+    assert ListingFetcher.page_url('https://example.com/homes/', 3) == 'https://example.com/homes/3_p/'
+
+
+def test_fetch_all_pages_in_order():
+    with StubServer(pages=4) as server:
+        results = ListingFetcher(concurrency=3, timeout=5).fetch(server.url)
+
+    assert len(results['Address']) == 4 * PER_PAGE
+    assert results['Address'][0] == '0 Main St, Page 1'
+    assert results['Address'][-1] == f'{PER_PAGE - 1} Main St, Page 4'
+    assert results['Price'][1] == '$1,001'
+    assert results['Beds'][0] == '3 bds2 ba'
+    assert results['Link'][PER_PAGE] == '/homedetails/2-0/'
+
+
+def test_iter_pages_stops_at_quota():
+    with StubServer(pages=10) as server:
+        pages = list(ListingFetcher(concurrency=4, timeout=5).iter_pages(server.url, max_properties=5))
+
+    assert [len(page['Address']) for page in pages] == [3, 2]
+    assert pages[1]['Address'] == ['0 Main St, Page 2', '1 Main St, Page 2']
+    # Only the pages the quota needs are requested
+    assert sorted(server.requested) == ['/homes/', '/homes/2_p/']
+
+
+def test_iter_pages_stops_at_missing_page():
+    with StubServer(pages=2) as server:
+        pages = list(ListingFetcher(concurrency=2, timeout=5).iter_pages(server.url))
+
+    assert len(pages) == 2
+
+
+def test_failed_first_page_raises():
+    with StubServer(pages=3, status=403) as server:
+        with pytest.raises(requests.HTTPError, match='403'):
+            ListingFetcher(timeout=5).fetch(server.url)
+
+
+def test_failed_later_page_ends_search():
+    with StubServer(pages=1) as server:
+        fetcher = ListingFetcher(timeout=5)
+        assert fetcher.fetch_page(ListingFetcher.page_url(server.url, 2)) is None
+        with pytest.raises(requests.HTTPError):
+            fetcher.fetch_page(ListingFetcher.page_url(server.url, 2), required=True)
+
+
+def test_dropped_later_page_ends_search():
+    with StubServer(pages=4, drop={2}) as server:
+        pages = list(ListingFetcher(concurrency=1, timeout=5).iter_pages(server.url))
+
+    assert [page['Address'][0] for page in pages] == ['0 Main St, Page 1']
+
+
+def test_dropped_first_page_raises():
+    with StubServer(pages=4, drop={1}) as server:
+        with pytest.raises(requests.ConnectionError):
+            ListingFetcher(timeout=5).fetch(server.url)
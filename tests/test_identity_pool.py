@@ -0,0 +1,200 @@
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+
+from zillow.middlewares import IdentityPool, IdentityPoolMiddleware
+
+
+def test_consecutive_failures_evict():
+    pool = IdentityPool(['a', 'b'], max_failures=3, cooldown=60)
+
+    assert not pool.record('a', False)
+    assert not pool.record('a', False)
+    assert pool.record('a', False)
+    assert pool.healthy() == ['b']
+    # Evicted members come back after the cooldown with a fresh score
+    assert pool.healthy(now=time.time() + 61) == ['a', 'b']
+    assert pool.scores['a'].failures == 0
+
+
+def test_success_resets_failure_streak():
+    pool = IdentityPool(['a'], max_failures=3, min_samples=100)
+
+    for _ in range(10):
+        assert not pool.record('a', False)
+        assert not pool.record('a', False)
+        assert not pool.record('a', True)
+    assert pool.healthy() == ['a']
+
+
+def test_low_success_rate_evicts_after_min_samples():
+    pool = IdentityPool(['a'], max_failures=100, min_success=0.5, min_samples=5)
+
+    # One success after every two failures drags the weighted success rate below 0.5
+    outcomes = [False, False, True] * 3
+    evicted = [pool.record('a', ok) for ok in outcomes]
+    assert any(evicted)
+    assert evicted.index(True) >= 4
+    assert pool.healthy() == []
+
+
+def test_unknown_member_is_ignored():
+    pool = IdentityPool(['a'])
+    assert not pool.record('z', False)
+    assert pool.healthy() == ['a']
+
+
+def test_choose_prefers_healthy_members():
+    pool = IdentityPool(['fast', 'slow'], rng=random.Random(0))
+    for _ in range(4):
+        pool.record('fast', True, latency=0.1)
+        pool.record('slow', True, latency=5.0)
+
+    picks = [pool.choose() for _ in range(1000)]
+    assert picks.count('fast') > 800
+
+
+def test_choose_never_picks_evicted_members():
+    pool = IdentityPool(['a', 'b'], max_failures=1, rng=random.Random(0))
+    pool.record('a', False)
+
+    assert {pool.choose() for _ in range(100)} == {'b'}
+
+
+def test_choose_falls_back_to_first_returning_member():
+    pool = IdentityPool(['a', 'b'], max_failures=1, cooldown=60)
+    pool.record('b', False)
+    time.sleep(0.01)
+    pool.record('a', False)
+
+    assert pool.choose() == 'b'
+
+
+PROFILES = [
+    {'user-agent': 'Chrome', 'sec-ch-ua': '"Chromium";v="124"', 'accept': 'text/html'},
+    {'user-agent': 'Firefox', 'accept': 'text/html'},
+]
+DEFAULT_HEADERS = {'user-agent': 'Scrapy', 'sec-ch-ua': '"Chromium";v="93"', 'accept': '*/*', 'pragma': 'no-cache'}
+PAGE = b'<html><body><script type="application/ld+json">{}</script></body></html>'
+
+
+class StandInProxy:
+    """A local HTTP proxy that answers every request itself with ``status``."""
+
+    def __init__(self, status):
+        self.seen = []
+        proxy = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                proxy.seen.append((self.path, {name.lower(): value for name, value in self.headers.items()}))
+                body = PAGE if status == 200 else b'blocked'
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def proxies():
+    blocked, healthy = StandInProxy(403), StandInProxy(200)
+    yield blocked, healthy
+    blocked.close()
+    healthy.close()
+
+
+def make_middleware(proxies, **settings):
+    crawler = get_crawler(settings_dict={
+        'IDENTITY_HEADER_PROFILES': PROFILES,
+        'IDENTITY_PROXIES': [proxy.url for proxy in proxies],
+        'DEFAULT_REQUEST_HEADERS': DEFAULT_HEADERS,
+        'IDENTITY_EVICT_AFTER_FAILURES': 3,
+        **settings,
+    })
+    return IdentityPoolMiddleware.from_crawler(crawler), crawler
+
+
+def download(middleware, request, spider=None):
+    """Send ``request`` through the middleware and its proxy, as the downloader would."""
+    for name, value in DEFAULT_HEADERS.items():
+        request.headers.setdefault(name, value)
+    assert middleware.process_request(request, spider) is None
+    headers = {name.decode(): request.headers.get(name).decode() for name in request.headers}
+    answer = requests.get(request.url, headers=headers, proxies={'http': request.meta['proxy']}, timeout=5)
+    response = HtmlResponse(request.url, status=answer.status_code, body=answer.content, request=request)
+    return middleware.process_response(request, response, spider)
+
+
+def test_middleware_assigns_profile_and_proxy(proxies):
+    middleware, _ = make_middleware(proxies)
+    request = Request('http://listings.test/brooklyn-ny/1_p/')
+    download(middleware, request)
+
+    profile, proxy = request.meta['identity']
+    assert proxy in {p.url for p in proxies}
+    assert request.meta['proxy'] == proxy
+    assert request.meta['cookiejar'] == f'{profile}|{proxy}'
+    (path, headers), = next(p for p in proxies if p.url == proxy).seen
+    assert path == 'http://listings.test/brooklyn-ny/1_p/'
+    assert headers['user-agent'] == PROFILES[profile]['user-agent']
+    assert headers['pragma'] == 'no-cache'
+    # Profiles without client hints do not inherit the default ones
+    assert headers.get('sec-ch-ua') == PROFILES[profile].get('sec-ch-ua')
+
+
+def test_middleware_keeps_request_headers(proxies):
+    middleware, _ = make_middleware(proxies)
+    request = Request('http://listings.test/search/', headers={'Accept': 'application/json'})
+    download(middleware, request)
+
+    assert request.headers['Accept'] == b'application/json'
+    assert request.headers['User-Agent'] == PROFILES[request.meta['identity'][0]]['user-agent'].encode()
+
+
+def test_middleware_replaces_earlier_identity_on_retry(proxies):
+    middleware, _ = make_middleware(proxies)
+    request = Request('http://listings.test/brooklyn-ny/1_p/')
+    download(middleware, request)
+
+    middleware.profile_pool.scores[request.meta['identity'][0]].evicted_until = time.time() + 60
+    retry = request.replace()
+    download(middleware, retry)
+
+    profile = retry.meta['identity'][0]
+    assert profile != request.meta['identity'][0]
+    assert retry.headers['User-Agent'] == PROFILES[profile]['user-agent'].encode()
+    client_hint = PROFILES[profile].get('sec-ch-ua')
+    assert retry.headers.get('sec-ch-ua') == (client_hint.encode() if client_hint else None)
+
+
+def test_middleware_evicts_blocked_proxy(proxies):
+    blocked, healthy = proxies
+    middleware, crawler = make_middleware(proxies)
+    middleware.profile_pool.rng = middleware.proxy_pool.rng = random.Random(0)
+
+    for page in range(20):
+        download(middleware, Request(f'http://listings.test/brooklyn-ny/{page}_p/'))
+
+    assert len(blocked.seen) == 3
+    assert middleware.proxy_pool.healthy() == [healthy.url]
+    assert crawler.stats.get_value('identity/proxies_evicted') == 1
+    assert crawler.stats.get_value('identity/proxies_healthy') == 1
+    assert len(healthy.seen) == 17
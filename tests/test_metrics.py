@@ -0,0 +1,79 @@
+import asyncio
+import time
+from collections import defaultdict, deque
+
+import pytest
+
+from zillow.metrics import instrument_methods, timed_callback
+
+
+class Pipeline:
+    def process_item(self, item, spider):
+        return item
+
+
+class Manager:
+    def __init__(self, pipelines):
+        self.methods = defaultdict(deque)
+        self._mw_methods_requiring_spider = set()
+        for pipeline in pipelines:
+            self.methods['process_item'].append(pipeline.process_item)
+            self._mw_methods_requiring_spider.add(pipeline.process_item)
+
+
+def test_instrument_methods_keeps_spider_argument():
+    manager = Manager([Pipeline(), Pipeline()])
+    calls = []
+
+    def wrap(method):
+        def wrapper(*args, **kwargs):
+            calls.append(method)
+            return method(*args, **kwargs)
+        return wrapper
+
+    instrument_methods(manager, 'process_item', wrap)
+
+    assert isinstance(manager.methods['process_item'], deque)
+    for method in manager.methods['process_item']:
+        assert method in manager._mw_methods_requiring_spider
+        assert method('item', 'spider') == 'item'
+    assert len(calls) == 2
+
+
+def test_timed_coroutine_callback_excludes_awaits():
+    finished, offloaded = [], []
+
+    async def callback(response):
+        await asyncio.sleep(0.05)
+        return [response]
+
+    timed = timed_callback('parse', callback, finished.append, offloaded=lambda name, wall: offloaded.append(wall))
+    assert asyncio.run(timed('response')) == ['response']
+
+    call, = finished
+    assert call.wall < 0.05
+    assert offloaded[0] >= 0.05
+
+
+def test_timed_coroutine_callback_raises():
+    finished = []
+
+    async def callback(response):
+        await asyncio.sleep(0)
+        raise ValueError(response)
+
+    timed = timed_callback('parse', callback, finished.append)
+    with pytest.raises(ValueError):
+        asyncio.run(timed('response'))
+    assert len(finished) == 1
+
+
+def test_timed_generator_callback():
+    finished = []
+
+    def callback(response):
+        time.sleep(0.01)
+        yield response
+
+    assert list(timed_callback('parse', callback, finished.append)('response')) == ['response']
+    assert finished[0].wall >= 0.01
@@ -0,0 +1,492 @@
+# Saved-search alerts.
+#
+# A saved search is a set of criteria such as "3+ bed single family home in
+# 11233 under $600k, price dropped". AlertPipeline compares every crawled
+# listing with the state recorded for it by the previous crawls, and matches
+# the listings that are new or changed against all saved searches.
+#
+# Testing every search against every listing costs O(searches) per listing.
+# SearchIndex instead files each search under its most selective criterion
+# (a postal code, else a locality, else a home type) and under the price
+# buckets its price range overlaps. Prices are bucketed on a log scale, so a
+# range covers a handful of buckets. A listing then looks up at most eight
+# posting lists: its postal code, locality, home type and "any", each in its
+# own price bucket and in the "any price" list. Only the searches found there
+# are tested in full, so the cost per listing follows the number of searches
+# that could match it, not the number of saved searches.
+#
+# Matches go to an outbox table in the alert store, written in batches and
+# unique per (search, listing, event, price), so a listing seen again by a
+# later crawl, or by another worker, is not queued twice. A notifier reads
+# the pending entries and marks them delivered (``python -m zillow.alerts
+# pending STORE --ack``).
+
+import argparse
+import dataclasses
+import json
+import math
+import os
+import sqlite3
+import time
+import typing
+
+from zillow.records import HomeType, ListingRecord, to_cents, to_int, to_text
+from zillow.utils import parse_number
+
+DEFAULT_FILENAME = 'zillow-alerts.sqlite3'
+
+# Events a listing can trigger
+NEW = 'new'
+PRICE_DROP = 'price_drop'
+CHANGED = 'changed'
+EVENTS = (NEW, PRICE_DROP, CHANGED)
+
+# Price buckets: PRICE_BUCKET_FLOOR cents and below is bucket 0, every bucket
+# above spans PRICE_BUCKET_RATIO times the previous one
+PRICE_BUCKET_FLOOR = 50_000_00
+PRICE_BUCKET_RATIO = 1.5
+PRICE_BUCKETS = 24
+
+
+def price_bucket(cents):
+    if cents <= PRICE_BUCKET_FLOOR:
+        return 0
+    return min(int(math.log(cents / PRICE_BUCKET_FLOOR) / math.log(PRICE_BUCKET_RATIO)) + 1, PRICE_BUCKETS - 1)
+
+
+def normalize_locality(value):
+    value = to_text(value)
+    return value.lower() if value else None
+
+
+def normalize_postal_code(value):
+    value = to_text(value)
+    return value[:5] if value else None
+
+
+@dataclasses.dataclass(slots=True)
+class SavedSearch:
+    """The criteria of one saved search; unset criteria match anything.
+
+    Prices are in cents. Numeric bounds are inclusive, and a listing missing
+    a bounded value does not match.
+    """
+    search_id: str
+    postal_codes: frozenset = frozenset()
+    localities: frozenset = frozenset()
+    home_types: frozenset = frozenset()
+    min_price_cents: typing.Optional[int] = None
+    max_price_cents: typing.Optional[int] = None
+    min_beds: typing.Optional[int] = None
+    max_beds: typing.Optional[int] = None
+    min_baths: typing.Optional[float] = None
+    max_baths: typing.Optional[float] = None
+    min_sqft: typing.Optional[int] = None
+    max_sqft: typing.Optional[int] = None
+    events: frozenset = frozenset((NEW, PRICE_DROP))
+    notify: typing.Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a search from its JSON form.
+
+        Args:
+            data (dict): ``id`` and any of ``postal_codes``, ``localities``,
+                ``home_types``, ``events`` (lists), ``min_price``,
+                ``max_price`` (dollars), ``min_beds``, ``max_beds``,
+                ``min_baths``, ``max_baths``, ``min_sqft``, ``max_sqft`` and
+                ``notify`` (an address for the notifier).
+
+        Raises:
+            ValueError: Without an id, or with an unknown criterion or event.
+        """
+        data = dict(data)
+        search_id = to_text(data.pop('id', None))
+        if search_id is None:
+            raise ValueError('A saved search needs an id')
+        unknown = data.keys() - SEARCH_KEYS
+        if unknown:
+            raise ValueError(f"Unknown criteria in saved search {search_id}: {', '.join(sorted(unknown))}")
+
+        def values(key, normalize):
+            value = data.get(key) or ()
+            if isinstance(value, str):
+                value = [value]
+            return frozenset(filter(None, map(normalize, value)))
+
+        def number(key, convert=parse_number):
+            value = data.get(key)
+            return convert(value) if value not in (None, '') else None
+
+        events = values('events', to_text) or frozenset((NEW, PRICE_DROP))
+        if events - set(EVENTS):
+            raise ValueError(f"Unknown events in saved search {search_id}: {', '.join(sorted(events - set(EVENTS)))}")
+        return cls(
+            search_id=search_id,
+            postal_codes=values('postal_codes', normalize_postal_code),
+            localities=values('localities', normalize_locality),
+            home_types=values('home_types', HomeType.parse),
+            min_price_cents=number('min_price', to_cents),
+            max_price_cents=number('max_price', to_cents),
+            min_beds=number('min_beds', to_int),
+            max_beds=number('max_beds', to_int),
+            min_baths=number('min_baths'),
+            max_baths=number('max_baths'),
+            min_sqft=number('min_sqft', to_int),
+            max_sqft=number('max_sqft', to_int),
+            events=events,
+            notify=to_text(data.get('notify')),
+        )
+
+    def to_dict(self):
+        data = {'id': self.search_id}
+        for key in ('postal_codes', 'localities', 'home_types', 'events'):
+            if getattr(self, key):
+                data[key] = sorted(map(str, getattr(self, key)))
+        for key in ('min_price', 'max_price'):
+            if getattr(self, f'{key}_cents') is not None:
+                data[key] = getattr(self, f'{key}_cents') / 100
+        for key in ('min_beds', 'max_beds', 'min_baths', 'max_baths', 'min_sqft', 'max_sqft', 'notify'):
+            if getattr(self, key) is not None:
+                data[key] = getattr(self, key)
+        return data
+
+    def matches(self, listing, event):
+        """Test every criterion against a normalized listing dict."""
+        if event not in self.events:
+            return False
+        if self.postal_codes and normalize_postal_code(listing.get('postal_code')) not in self.postal_codes:
+            return False
+        if self.localities and normalize_locality(listing.get('address_locality')) not in self.localities:
+            return False
+        if self.home_types and HomeType.parse(listing.get('real_estate_type')) not in self.home_types:
+            return False
+        return (
+            within(listing.get('price_cents'), self.min_price_cents, self.max_price_cents)
+            and within(listing.get('bedrooms'), self.min_beds, self.max_beds)
+            and within(listing.get('bathrooms'), self.min_baths, self.max_baths)
+            and within(listing.get('floor_size'), self.min_sqft, self.max_sqft)
+        )
+
+
+SEARCH_KEYS = {
+    'postal_codes', 'localities', 'home_types', 'min_price', 'max_price', 'min_beds', 'max_beds',
+    'min_baths', 'max_baths', 'min_sqft', 'max_sqft', 'events', 'notify',
+}
+
+
+def within(value, low, high):
+    if low is None and high is None:
+        return True
+    if value is None:
+        return False
+    return (low is None or value >= low) and (high is None or value <= high)
+
+
+class SearchIndex:
+    """Saved searches, indexed by their most selective criterion and price range."""
+
+    def __init__(self, searches=()):
+        # (dimension, value, price bucket or None for "any price") -> searches
+        self.postings = {}
+        self.searches = {}
+        for search in searches:
+            self.add(search)
+
+    def __len__(self):
+        return len(self.searches)
+
+    @staticmethod
+    def keys(search):
+        if search.postal_codes:
+            dimension, values = 'postal_code', search.postal_codes
+        elif search.localities:
+            dimension, values = 'locality', search.localities
+        elif search.home_types:
+            dimension, values = 'home_type', search.home_types
+        else:
+            dimension, values = None, (None,)
+
+        if search.min_price_cents is None and search.max_price_cents is None:
+            buckets = (None,)
+        else:
+            low = price_bucket(search.min_price_cents or 0)
+            high = price_bucket(search.max_price_cents) if search.max_price_cents is not None else PRICE_BUCKETS - 1
+            buckets = range(low, high + 1)
+        return [(dimension, value, bucket) for value in values for bucket in buckets]
+
+    def add(self, search):
+        if search.search_id in self.searches:
+            self.remove(search.search_id)
+        self.searches[search.search_id] = search
+        for key in self.keys(search):
+            self.postings.setdefault(key, []).append(search)
+
+    def remove(self, search_id):
+        search = self.searches.pop(search_id, None)
+        if search is None:
+            return
+        for key in self.keys(search):
+            postings = self.postings[key]
+            postings.remove(search)
+            if not postings:
+                del self.postings[key]
+
+    def candidates(self, listing):
+        """Searches whose indexed criteria the listing meets; each at most once."""
+        price = listing.get('price_cents')
+        buckets = (None,) if price is None else (None, price_bucket(price))
+        found = []
+        for dimension, value in (
+            ('postal_code', normalize_postal_code(listing.get('postal_code'))),
+            ('locality', normalize_locality(listing.get('address_locality'))),
+            ('home_type', HomeType.parse(listing.get('real_estate_type'))),
+            (None, None),
+        ):
+            if value is None and dimension is not None:
+                continue
+            for bucket in buckets:
+                found.extend(self.postings.get((dimension, value, bucket), ()))
+        return found
+
+    def match(self, listing, event):
+        """Return the searches matching a normalized listing dict for ``event``."""
+        return [search for search in self.candidates(listing) if search.matches(listing, event)]
+
+
+class AlertStore:
+    """Saved searches, the last seen state of every listing and the outbox."""
+
+    def __init__(self, path, commit_every=500):
+        """
+        Args:
+            path (str): SQLite database file; created if missing.
+            commit_every (int): Observed listings batched into one transaction.
+        """
+        self.path = path
+        self.commit_every = commit_every
+        self._pending = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Writes take the lock up front, as workers of a distributed crawl share the store
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level='IMMEDIATE', check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS searches ('
+            ' id TEXT PRIMARY KEY,'
+            ' criteria TEXT NOT NULL,'
+            ' created_at INTEGER NOT NULL'
+            ') WITHOUT ROWID'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS listings ('
+            ' zpid INTEGER PRIMARY KEY,'
+            ' price_cents INTEGER,'
+            ' status TEXT'
+            ')'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            ' id INTEGER PRIMARY KEY,'
+            ' search_id TEXT NOT NULL,'
+            ' zpid INTEGER NOT NULL,'
+            ' event TEXT NOT NULL,'
+            ' price_cents INTEGER,'
+            ' previous_price_cents INTEGER,'
+            ' listing TEXT NOT NULL,'
+            ' created_at INTEGER NOT NULL,'
+            ' delivered_at INTEGER,'
+            ' UNIQUE (search_id, zpid, event, price_cents)'
+            ')'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (id) WHERE delivered_at IS NULL')
+        self.conn.commit()
+
+    def add_search(self, search):
+        self.conn.execute(
+            'INSERT INTO searches (id, criteria, created_at) VALUES (?, ?, ?)'
+            ' ON CONFLICT (id) DO UPDATE SET criteria = excluded.criteria',
+            (search.search_id, json.dumps(search.to_dict()), int(time.time())),
+        )
+        self.conn.commit()
+
+    def remove_search(self, search_id):
+        removed = self.conn.execute('DELETE FROM searches WHERE id = ?', (search_id,)).rowcount
+        self.conn.commit()
+        return bool(removed)
+
+    def searches(self):
+        return [SavedSearch.from_dict(json.loads(criteria))
+                for criteria, in self.conn.execute('SELECT criteria FROM searches ORDER BY id')]
+
+    def observe(self, zpid, price_cents, status):
+        """Compare a listing with its last seen state and store the new state.
+
+        Returns:
+            tuple: ``(event, previous price)``; the event is None if neither
+            the price nor the status changed.
+        """
+        known = self.conn.execute('SELECT price_cents, status FROM listings WHERE zpid = ?', (zpid,)).fetchone()
+        if known is None:
+            event, previous = NEW, None
+        else:
+            previous, previous_status = known
+            if price_cents is not None and previous is not None and price_cents < previous:
+                event = PRICE_DROP
+            elif (price_cents is not None and price_cents != previous) or (status is not None and status != previous_status):
+                event = CHANGED
+            else:
+                return None, previous
+
+        self.conn.execute(
+            'INSERT INTO listings (zpid, price_cents, status) VALUES (?, ?, ?) ON CONFLICT (zpid) DO UPDATE SET'
+            ' price_cents = COALESCE(excluded.price_cents, price_cents), status = COALESCE(excluded.status, status)',
+            (zpid, price_cents, status),
+        )
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+        return event, previous
+
+    def enqueue(self, matches):
+        """Add matches to the outbox, skipping those already queued.
+
+        Args:
+            matches: ``(search_id, zpid, event, price_cents, previous_price_cents, listing)``
+                tuples; ``listing`` is a JSON string.
+
+        Returns:
+            int: Matches added.
+        """
+        before = self.conn.total_changes
+        now = int(time.time())
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO outbox (search_id, zpid, event, price_cents, previous_price_cents, listing, created_at)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [match + (now,) for match in matches],
+        )
+        return self.conn.total_changes - before
+
+    def pending(self, limit=None):
+        """Return undelivered outbox entries, oldest first, as dicts."""
+        query = ('SELECT id, search_id, zpid, event, price_cents, previous_price_cents, listing, created_at'
+                 ' FROM outbox WHERE delivered_at IS NULL ORDER BY id')
+        params = ()
+        if limit is not None:
+            query += ' LIMIT ?'
+            params = (limit,)
+        columns = ('id', 'search_id', 'zpid', 'event', 'price_cents', 'previous_price_cents', 'listing', 'created_at')
+        entries = []
+        for row in self.conn.execute(query, params):
+            entry = dict(zip(columns, row))
+            entry['listing'] = json.loads(entry['listing'])
+            entries.append(entry)
+        return entries
+
+    def mark_delivered(self, ids):
+        now = int(time.time())
+        self.conn.executemany('UPDATE outbox SET delivered_at = ? WHERE id = ?', [(now, i) for i in ids])
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self):
+        if self.conn is not None:
+            self.commit()
+            self.conn.close()
+            self.conn = None
+
+
+class AlertMatcher:
+    """Match observed listings against an index of saved searches, batching outbox writes."""
+
+    def __init__(self, store, index=None, batch_size=500):
+        self.store = store
+        self.index = index if index is not None else SearchIndex(store.searches())
+        self.batch_size = batch_size
+        self.batch = []
+        self.matched = 0
+        self.queued = 0
+
+    def process(self, item):
+        """Observe one listing, raw or normalized, and queue its matches.
+
+        Returns:
+            list: The matching searches.
+        """
+        if 'price_cents' not in item:
+            item = ListingRecord.from_item(item).asdict()
+        zpid = item.get('zpid')
+        if zpid is None:
+            return []
+        event, previous = self.store.observe(zpid, item.get('price_cents'), item.get('availability'))
+        if event is None:
+            return []
+        searches = self.index.match(item, event)
+        if searches:
+            listing = json.dumps({key: value for key, value in item.items() if value is not None}, default=str)
+            price = item.get('price_cents')
+            self.batch.extend((search.search_id, zpid, event, price, previous, listing) for search in searches)
+            self.matched += len(searches)
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+        return searches
+
+    def flush(self):
+        if self.batch:
+            self.queued += self.store.enqueue(self.batch)
+            self.batch = []
+        self.store.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage saved searches and read the alert outbox.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    add = commands.add_parser('add', help='Add or replace saved searches, from a JSON lines file or inline JSON')
+    add.add_argument('store', help='ALERTS_STORE_PATH')
+    add.add_argument('searches', help='A .jsonl file of searches, or one search as JSON')
+    remove = commands.add_parser('remove', help='Remove a saved search')
+    remove.add_argument('store', help='ALERTS_STORE_PATH')
+    remove.add_argument('search_id')
+    show = commands.add_parser('list', help='Print the saved searches')
+    show.add_argument('store', help='ALERTS_STORE_PATH')
+    pending = commands.add_parser('pending', help='Print undelivered alerts as JSON lines')
+    pending.add_argument('store', help='ALERTS_STORE_PATH')
+    pending.add_argument('--limit', type=int)
+    pending.add_argument('--ack', action='store_true', help='Mark the printed alerts delivered')
+    args = parser.parse_args(argv)
+
+    store = AlertStore(args.store)
+    try:
+        if args.command == 'add':
+            if os.path.exists(args.searches):
+                with open(args.searches) as f:
+                    searches = [json.loads(line) for line in f if line.strip()]
+            else:
+                searches = [json.loads(args.searches)]
+            for data in searches:
+                store.add_search(SavedSearch.from_dict(data))
+            print(f"{len(searches)} saved searches added")
+        elif args.command == 'remove':
+            if not store.remove_search(args.search_id):
+                parser.exit(1, f"No saved search {args.search_id}\n")
+        elif args.command == 'list':
+            for search in store.searches():
+                print(json.dumps(search.to_dict()))
+        else:
+            entries = store.pending(args.limit)
+            for entry in entries:
+                print(json.dumps(entry))
+            if args.ack:
+                store.mark_delivered([entry['id'] for entry in entries])
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# Shared on-disk cache for search results.
+#
+# Results live in a SQLite database, so every Streamlit worker process and
+# every restart sees the same entries. Entries are fresh for ``ttl`` seconds.
+# After that they are still served for ``stale_ttl`` seconds while a
+# background thread refreshes them (stale-while-revalidate). The least
+# recently used entries are evicted once the cache holds more than
+# ``max_entries`` entries or ``max_bytes`` of payload. Only successful fetches
+# are stored: an exception raised by the fetch function is passed to the
+# caller and nothing is cached.
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """A TTL + LRU cache of JSON-serializable values in a SQLite file."""
+
+    def __init__(self, path, ttl=3600, stale_ttl=86400, max_entries=500, max_bytes=256 * 1024 * 1024, refresh_timeout=300):
+        """
+        Args:
+            path (str): SQLite database file; created if missing.
+            ttl (float): Seconds an entry is served without refreshing it.
+            stale_ttl (float): Seconds after ``ttl`` during which an entry is
+                still served while it is refreshed in the background.
+            max_entries (int): Maximum number of entries kept.
+            max_bytes (int): Maximum total payload size kept.
+            refresh_timeout (float): Seconds after which a refresh that never
+                finished (e.g. its worker died) may be retried by another worker.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.refresh_timeout = refresh_timeout
+        self._local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                ' key TEXT PRIMARY KEY,'
+                ' payload TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' created REAL NOT NULL,'
+                ' accessed REAL NOT NULL'
+                ')'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+            # Refresh leases, so only one worker revalidates a stale entry
+            self.conn.execute('CREATE TABLE IF NOT EXISTS refreshing (key TEXT PRIMARY KEY, expires REAL NOT NULL)')
+
+    @property
+    def conn(self):
+        # SQLite connections cannot be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(*parts):
+        return json.dumps(parts, sort_keys=True, default=str)
+
+    def get(self, key):
+        """Return ``(value, fresh)`` for ``key``, or None if missing or expired."""
+        now = time.time()
+        with self.conn:
+            row = self.conn.execute('SELECT payload, created FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            payload, created = row
+            age = now - created
+            if age >= self.ttl + self.stale_ttl:
+                self.conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                return None
+            self.conn.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+        return json.loads(payload), age < self.ttl
+
+    def set(self, key, value):
+        payload = json.dumps(value)
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO results (key, payload, size, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                (key, payload, len(payload), now, now),
+            )
+            self._evict()
+
+    def _evict(self):
+        # Drop expired entries, then the least recently used ones over the limits
+        self.conn.execute('DELETE FROM results WHERE created < ?', (time.time() - self.ttl - self.stale_ttl,))
+        count, total = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        evict = []
+        for key, size in self.conn.execute('SELECT key, size FROM results ORDER BY accessed'):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            evict.append((key,))
+            count -= 1
+            total -= size
+        self.conn.executemany('DELETE FROM results WHERE key = ?', evict)
+
+    def get_or_fetch(self, key, fetch):
+        """Return the cached value for ``key``, calling ``fetch()`` on a miss.
+
+        A stale entry is returned immediately, and ``fetch`` runs on a
+        background thread to refresh it.
+        """
+        cached = self.get(key)
+        if cached is not None:
+            value, fresh = cached
+            if not fresh:
+                self.revalidate(key, fetch)
+            return value
+
+        value = fetch()
+        self.set(key, value)
+        return value
+
+    def revalidate(self, key, fetch):
+        """Refresh ``key`` with ``fetch()`` on a background thread, unless
+        another thread or process is already refreshing it."""
+        if self._acquire_refresh(key):
+            threading.Thread(target=self._refresh, args=(key, fetch), name='result-cache-refresh', daemon=True).start()
+
+    def _acquire_refresh(self, key):
+        now = time.time()
+        with self.conn:
+            self.conn.execute('DELETE FROM refreshing WHERE key = ? AND expires < ?', (key, now))
+            cursor = self.conn.execute(
+                'INSERT OR IGNORE INTO refreshing (key, expires) VALUES (?, ?)', (key, now + self.refresh_timeout)
+            )
+        return cursor.rowcount == 1
+
+    def _refresh(self, key, fetch):
+        try:
+            self.set(key, fetch())
+        except Exception:
+            # Keep serving the stale entry; the next request will retry
+            logger.exception('Refreshing cached result failed')
+        finally:
+            with self.conn:
+                self.conn.execute('DELETE FROM refreshing WHERE key = ?', (key,))
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM results')
+            self.conn.execute('DELETE FROM refreshing')
+
+
+_default_cache = None
+
+
+def get_result_cache():
+    """Return the process-wide cache, configured from the environment.
+
+    ZILLOW_CACHE_PATH, ZILLOW_CACHE_TTL, ZILLOW_CACHE_STALE_TTL,
+    ZILLOW_CACHE_MAX_ENTRIES and ZILLOW_CACHE_MAX_BYTES override the defaults.
+    """
+    global _default_cache
+    if _default_cache is None:
+        env = os.environ
+        _default_cache = ResultCache(
+            env.get('ZILLOW_CACHE_PATH', os.path.join(os.path.expanduser('~'), '.cache', 'zillow-dealfinder', 'results.sqlite3')),
+            ttl=float(env.get('ZILLOW_CACHE_TTL', 3600)),
+            stale_ttl=float(env.get('ZILLOW_CACHE_STALE_TTL', 86400)),
+            max_entries=int(env.get('ZILLOW_CACHE_MAX_ENTRIES', 500)),
+            max_bytes=int(env.get('ZILLOW_CACHE_MAX_BYTES', 256 * 1024 * 1024)),
+        )
+    return _default_cache
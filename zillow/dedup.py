@@ -0,0 +1,225 @@
+# Persistent record of the listings we have already scraped.
+#
+# Listing keys (zpids, or URLs for listings without one) live in a SQLite
+# table so they survive restarts. An in-RAM Bloom filter sits in front of it:
+# most lookups during a crawl are for listings we have never seen, and those
+# are answered without touching the disk. The filter has a fixed size, so
+# memory stays bounded however many listings the table grows to.
+#
+# In distributed crawls several processes write to the same table. The
+# filter only knows this process's writes then, so shared stores skip it and
+# commit every write.
+
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import time
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter over string keys."""
+
+    def __init__(self, capacity=1_000_000, error_rate=0.001):
+        """
+        Args:
+            capacity (int): Number of keys the filter is sized for. More keys
+                can be added, at the cost of a higher false positive rate.
+            error_rate (float): Target false positive rate at ``capacity``.
+        """
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: derive all probe positions from one 128-bit digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+def item_fingerprint(values, fields=None):
+    """Return a stable hash of an item's values.
+
+    Args:
+        values (Mapping): The item, e.g. an ``ItemAdapter``.
+        fields (Iterable[str]): Only hash these fields. Defaults to all of them.
+
+    Returns:
+        str: A hex digest that changes whenever one of the values does.
+    """
+    if fields is not None:
+        values = {field: values.get(field) for field in fields}
+    payload = json.dumps(dict(values), sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+# Fields only the details page fills in (see ZillowSpider.enrich)
+DETAILS_FIELDS = ('zestimate_value', 'zestimate_cents')
+
+
+def card_fingerprint(values):
+    """Return the ``item_fingerprint`` of an item without its ``DETAILS_FIELDS``.
+
+    A listing whose details request was skipped fingerprints the same as
+    the complete item, and the Zestimate moving from day to day does not
+    count as a change to the listing.
+    """
+    return item_fingerprint(values, [field for field in values.keys() if field not in DETAILS_FIELDS])
+
+
+class SeenStore:
+    """A persistent set of listing keys with optional content fingerprints.
+
+    Every key records when it was first seen and when its fingerprint last
+    changed, so callers can tell listings that are new or changed during the
+    current crawl from ones that are known and unchanged.
+    """
+
+    # Where from_crawler() keeps the shared instance and finds its path
+    crawler_attr = 'seen_store'
+    path_setting = 'DEDUP_STORE_PATH'
+    default_filename = 'zillow-seen.sqlite3'
+
+    def __init__(self, path, capacity=1_000_000, error_rate=0.001, commit_every=500, shared=False):
+        """
+        Args:
+            path (str): SQLite database file; created if missing.
+            capacity (int): Number of keys the Bloom filter is sized for.
+            error_rate (float): Bloom filter false positive rate at capacity.
+            commit_every (int): Number of writes batched into one transaction.
+            shared (bool): Other processes write to the file too; disables
+                the Bloom filter and write batching.
+        """
+        self.path = path
+        self.bloom = None if shared else BloomFilter(capacity, error_rate)
+        self.commit_every = 1 if shared else commit_every
+        self._pending = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS seen ('
+            ' key TEXT PRIMARY KEY,'
+            ' fingerprint TEXT,'
+            ' first_seen REAL NOT NULL,'
+            ' last_seen REAL NOT NULL,'
+            ' last_changed REAL NOT NULL'
+            ') WITHOUT ROWID'
+        )
+        self.conn.commit()
+
+        # Warm the filter with everything from previous crawls
+        if self.bloom is not None:
+            for (key,) in self.conn.execute('SELECT key FROM seen'):
+                self.bloom.add(key)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Return the store shared by every component of ``crawler``.
+
+        The pipeline and the spider middleware must see each other's writes,
+        so the store is created once per crawler and closed with the spider.
+        """
+        store = getattr(crawler, cls.crawler_attr, None)
+        if store is None:
+            from scrapy import signals
+            from scrapy.utils.project import data_path
+            from zillow.distributed import distributed_enabled
+
+            settings = crawler.settings
+            path = settings.get(cls.path_setting) or data_path(cls.default_filename)
+            store = cls(
+                path,
+                capacity=settings.getint('DEDUP_BLOOM_CAPACITY', 1_000_000),
+                error_rate=settings.getfloat('DEDUP_BLOOM_ERROR_RATE', 0.001),
+                shared=settings.getbool('DEDUP_SHARED', distributed_enabled(settings)),
+            )
+            crawler.signals.connect(lambda spider: store.close(), signal=signals.spider_closed, weak=False)
+            setattr(crawler, cls.crawler_attr, store)
+        return store
+
+    def __contains__(self, key):
+        if self.bloom is not None and key not in self.bloom:
+            return False
+        return self.conn.execute('SELECT 1 FROM seen WHERE key = ?', (key,)).fetchone() is not None
+
+    def get(self, key):
+        """Return ``(fingerprint, last_changed)`` for ``key``, or None if unknown."""
+        if self.bloom is not None and key not in self.bloom:
+            return None
+        return self.conn.execute('SELECT fingerprint, last_changed FROM seen WHERE key = ?', (key,)).fetchone()
+
+    def add(self, key, fingerprint=None):
+        """Record ``key`` as seen now.
+
+        Args:
+            key (str): The listing key.
+            fingerprint (str): Optional content fingerprint of the listing.
+
+        Returns:
+            bool: True if the key is new or its fingerprint changed.
+        """
+        now = time.time()
+        known = self.get(key)
+        if known is None:
+            inserted = self.conn.execute(
+                'INSERT OR IGNORE INTO seen (key, fingerprint, first_seen, last_seen, last_changed)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (key, fingerprint, now, now, now),
+            ).rowcount
+            if self.bloom is not None:
+                self.bloom.add(key)
+            if inserted:
+                self._count_write()
+                return True
+            # Another process added the key in the meantime
+            known = self.conn.execute('SELECT fingerprint, last_changed FROM seen WHERE key = ?', (key,)).fetchone()
+
+        changed = fingerprint is not None and known[0] != fingerprint
+        if changed:
+            self.conn.execute(
+                'UPDATE seen SET fingerprint = ?, last_seen = ?, last_changed = ? WHERE key = ?',
+                (fingerprint, now, now, key),
+            )
+        else:
+            self.conn.execute('UPDATE seen SET last_seen = ? WHERE key = ?', (now, key))
+
+        self._count_write()
+        return changed
+
+    def _count_write(self):
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def unchanged_since(self, key, timestamp):
+        """Return True if ``key`` is known and has not changed since ``timestamp``."""
+        known = self.get(key)
+        return known is not None and known[1] < timestamp
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self):
+        if self.conn is not None:
+            self.commit()
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,487 @@
+# Distributed crawls: several spider processes sharing one frontier.
+#
+# Every worker runs ``scrapy crawl zillowspider`` with SCHEDULER set to
+# DistributedScheduler and the same DISTRIBUTED_FRONTIER_PATH. The frontier
+# is a SQLite database (WAL mode, so workers on one host read and write it
+# concurrently). It holds the serialized requests of all workers and the
+# fingerprints of every request ever enqueued, which makes it the shared
+# dupefilter too. The zpid-seen set of DuplicatesPipeline and
+# SeenListingsMiddleware is shared the same way, see DEDUP_SHARED.
+#
+# A worker leases the requests it pops and renews its leases while it runs.
+# A request leaves the frontier only once its callback's output has been
+# consumed (FrontierAckMiddleware), so the requests a killed worker held are
+# handed to another worker when their lease runs out. Requests are sharded by
+# city, or by city and map tile; a worker takes its own shards first and the
+# others' when it runs dry.
+#
+# Each worker writes its own export files (see partition_path), which
+# ``python -m zillow.distributed merge`` combines once the crawl is over.
+
+import argparse
+import glob
+import os
+import pickle
+import socket
+import sqlite3
+import time
+import zlib
+
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.utils.request import request_from_dict
+from twisted.internet import task
+
+DEFAULT_FILENAME = 'zillow-frontier.sqlite3'
+SCHEDULER_PATH = 'zillow.distributed.DistributedScheduler'
+
+
+def distributed_enabled(settings):
+    """Return True if the crawl's SCHEDULER is DistributedScheduler."""
+    scheduler = settings.get('SCHEDULER')
+    return scheduler is DistributedScheduler or scheduler == SCHEDULER_PATH
+
+
+def worker_id(settings):
+    """DISTRIBUTED_WORKER_ID, or ``<host>-<pid>`` by default."""
+    return settings.get('DISTRIBUTED_WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def partition_path(path, settings):
+    """Give every worker of a distributed crawl its own output file.
+
+    ``{worker}`` in ``path`` is replaced by the worker id; in distributed
+    crawls a path without the placeholder gets ``-{worker}`` before its
+    extension. Other crawls use ``path`` unchanged.
+    """
+    if '{worker}' not in path:
+        if not distributed_enabled(settings):
+            return path
+        root, ext = os.path.splitext(path)
+        path = f"{root}-{{worker}}{ext}"
+    return path.replace('{worker}', worker_id(settings))
+
+
+def shard_hash(shard):
+    return zlib.crc32(shard.encode('utf-8'))
+
+
+class Frontier:
+    """A priority queue of leased requests, plus the fingerprints of every request it took.
+
+    Rows with ``leased_until`` in the past are pending: never popped, or
+    popped by a worker that stopped renewing its lease. Acknowledged rows are
+    deleted.
+    """
+
+    def __init__(self, path, lease_timeout=120, max_attempts=3):
+        """
+        Args:
+            path (str): SQLite database file shared by the workers; created if missing.
+            lease_timeout (float): Seconds a popped request stays with its
+                worker without a renewal.
+            max_attempts (int): Leases after which a request that was never
+                acknowledged is dropped, e.g. one that kills its workers.
+        """
+        self.path = path
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.abandoned = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Autocommit mode; writes take the database lock up front with BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS requests ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' priority INTEGER NOT NULL,'
+            ' shard TEXT NOT NULL,'
+            ' shard_hash INTEGER NOT NULL,'
+            ' payload BLOB NOT NULL,'
+            ' worker TEXT,'
+            ' leased_until REAL NOT NULL DEFAULT 0,'
+            ' attempts INTEGER NOT NULL DEFAULT 0'
+            ')'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS requests_order ON requests (priority DESC, id)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS requests_worker ON requests (worker)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS fingerprints (fingerprint TEXT PRIMARY KEY) WITHOUT ROWID')
+
+    def push(self, payload, priority=0, shard='', fingerprint=None, replaces=None):
+        """Add a request unless its fingerprint was seen before.
+
+        Args:
+            payload (bytes): The serialized request.
+            priority (int): Higher goes first.
+            shard (str): The city or tile the request belongs to.
+            fingerprint (str): Dupefilter fingerprint; None to never filter.
+            replaces (int): Id of a leased request this one supersedes, e.g.
+                a retry or redirect of it; acknowledged in the same transaction.
+
+        Returns:
+            bool: False if the request was filtered as a duplicate.
+        """
+        with self._transaction():
+            if replaces is not None:
+                self.conn.execute('DELETE FROM requests WHERE id = ?', (replaces,))
+            if fingerprint is not None:
+                cursor = self.conn.execute('INSERT OR IGNORE INTO fingerprints VALUES (?)', (fingerprint,))
+                if not cursor.rowcount:
+                    return False
+            self.conn.execute(
+                'INSERT INTO requests (priority, shard, shard_hash, payload) VALUES (?, ?, ?, ?)',
+                (priority, shard, shard_hash(shard), payload),
+            )
+        return True
+
+    def pop(self, worker, limit=1, shards=None, bucket=None):
+        """Lease up to ``limit`` pending requests to ``worker``, highest priority first.
+
+        Args:
+            worker (str): The worker id the leases are recorded under.
+            limit (int): Requests to lease at once.
+            shards (Iterable[str]): Only take requests of these shards.
+            bucket (tuple): ``(index, count)``: only take requests whose shard
+                hashes to ``index`` modulo ``count``.
+
+        Returns:
+            list: ``(id, payload)`` pairs.
+        """
+        now = time.time()
+        where, params = ['leased_until < ?'], [now]
+        if shards is not None:
+            shards = list(shards)
+            where.append(f"shard IN ({', '.join('?' * len(shards))})")
+            params.extend(shards)
+        if bucket is not None:
+            where.append('shard_hash % ? = ?')
+            params.extend((bucket[1], bucket[0]))
+
+        leased = []
+        with self._transaction():
+            rows = self.conn.execute(
+                f"SELECT id, payload, attempts FROM requests WHERE {' AND '.join(where)}"
+                ' ORDER BY priority DESC, id LIMIT ?',
+                (*params, limit),
+            ).fetchall()
+            for request_id, payload, attempts in rows:
+                if attempts >= self.max_attempts:
+                    self.conn.execute('DELETE FROM requests WHERE id = ?', (request_id,))
+                    self.abandoned += 1
+                    continue
+                self.conn.execute(
+                    'UPDATE requests SET worker = ?, leased_until = ?, attempts = attempts + 1 WHERE id = ?',
+                    (worker, now + self.lease_timeout, request_id),
+                )
+                leased.append((request_id, payload))
+        return leased
+
+    def ack(self, request_id):
+        """Remove a request whose processing finished."""
+        self.conn.execute('DELETE FROM requests WHERE id = ?', (request_id,))
+
+    def ack_worker(self, worker):
+        """Remove every request leased to ``worker``, e.g. once it is idle.
+
+        Returns:
+            int: Requests removed.
+        """
+        return self.conn.execute('DELETE FROM requests WHERE worker = ? AND leased_until >= ?',
+                                 (worker, time.time())).rowcount
+
+    def renew(self, worker):
+        """Extend the leases ``worker`` still holds."""
+        now = time.time()
+        self.conn.execute(
+            'UPDATE requests SET leased_until = ? WHERE worker = ? AND leased_until >= ?',
+            (now + self.lease_timeout, worker, now),
+        )
+
+    def release(self, worker, request_ids=None):
+        """Hand requests leased by ``worker`` back to the other workers.
+
+        Args:
+            request_ids (Iterable[int]): Only these; all of the worker's leases by default.
+        """
+        if request_ids is None:
+            self.conn.execute('UPDATE requests SET worker = NULL, leased_until = 0 WHERE worker = ?', (worker,))
+            return
+        with self._transaction():
+            self.conn.executemany(
+                'UPDATE requests SET worker = NULL, leased_until = 0, attempts = attempts - 1'
+                ' WHERE id = ? AND worker = ?',
+                [(request_id, worker) for request_id in request_ids],
+            )
+
+    def pending(self):
+        """Number of requests waiting for a worker."""
+        return self.conn.execute('SELECT COUNT(*) FROM requests WHERE leased_until < ?', (time.time(),)).fetchone()[0]
+
+    def in_flight(self):
+        """Number of requests leased to workers."""
+        return self.conn.execute('SELECT COUNT(*) FROM requests WHERE leased_until >= ?', (time.time(),)).fetchone()[0]
+
+    def status(self):
+        """Return ``{shard: (pending, in flight)}``."""
+        rows = self.conn.execute(
+            'SELECT shard, SUM(leased_until < :now), SUM(leased_until >= :now) FROM requests GROUP BY shard',
+            {'now': time.time()},
+        )
+        return {shard: (pending, in_flight) for shard, pending, in_flight in rows}
+
+    def seen(self):
+        """Number of fingerprints recorded by the dupefilter."""
+        return self.conn.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+
+    def reset(self):
+        """Forget every request and fingerprint, e.g. before a new crawl."""
+        with self._transaction():
+            self.conn.execute('DELETE FROM requests')
+            self.conn.execute('DELETE FROM fingerprints')
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _transaction(self):
+        return _Transaction(self.conn)
+
+
+class _Transaction:
+    """``BEGIN IMMEDIATE`` ... ``COMMIT``, rolled back on errors."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+def request_shard(request, by='city'):
+    """The shard of a request: ``meta['shard']``, else its city (and tile).
+
+    Args:
+        by (str): 'city', or 'tile' to also split a city's search API
+            requests by the map tile they search.
+    """
+    shard = request.meta.get('shard')
+    if shard is not None:
+        return str(shard)
+    shard = request.cb_kwargs.get('city') or ''
+    tile = request.cb_kwargs.get('tile')
+    if by == 'tile' and tile is not None:
+        shard = f"{shard}/{tile.west:.5f},{tile.south:.5f},{tile.depth}"
+    return shard
+
+
+class DistributedScheduler:
+    """Scrapy scheduler backed by a shared ``Frontier``.
+
+    Enable it with ``SCHEDULER = 'zillow.distributed.DistributedScheduler'``,
+    together with FrontierAckMiddleware. Requests are pickled with
+    ``Request.to_dict``, so callbacks and errbacks must be spider methods and
+    ``meta`` and ``cb_kwargs`` must be picklable. Popped requests carry
+    ``meta['frontier_id']``; a request enqueued with that key (a retry or a
+    redirect) replaces the original.
+    """
+
+    def __init__(self, crawler, frontier, worker, prefetch=4, shard_by='city', shards=None, bucket=None,
+                 steal=True):
+        """
+        Args:
+            crawler (Crawler): The crawler; its stats receive frontier/* values.
+            frontier (Frontier): The shared frontier.
+            worker (str): This worker's id.
+            prefetch (int): Requests leased per frontier round trip.
+            shard_by (str): 'city' or 'tile', see request_shard().
+            shards (list): Shards this worker takes first.
+            bucket (tuple): ``(index, count)``: this worker takes the shards
+                hashing to ``index`` first.
+            steal (bool): Take other shards' requests when the own ones ran out.
+        """
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.frontier = frontier
+        self.worker = worker
+        self.prefetch = max(1, prefetch)
+        self.shard_by = shard_by
+        self.shards = shards
+        self.bucket = bucket
+        self.steal = steal
+        self.spider = None
+        self.local = []
+        self.renewal = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        from scrapy.utils.project import data_path
+
+        settings = crawler.settings
+        frontier = Frontier(
+            settings.get('DISTRIBUTED_FRONTIER_PATH') or data_path(DEFAULT_FILENAME),
+            lease_timeout=settings.getfloat('DISTRIBUTED_LEASE_TIMEOUT', 120),
+            max_attempts=settings.getint('DISTRIBUTED_MAX_ATTEMPTS', 3),
+        )
+        count = settings.getint('DISTRIBUTED_WORKER_COUNT', 0)
+        scheduler = cls(
+            crawler,
+            frontier,
+            worker_id(settings),
+            prefetch=settings.getint('DISTRIBUTED_PREFETCH', 4),
+            shard_by=settings.get('DISTRIBUTED_SHARD_BY', 'city'),
+            shards=settings.getlist('DISTRIBUTED_SHARDS') or None,
+            bucket=(settings.getint('DISTRIBUTED_WORKER_INDEX', 0), count) if count > 1 else None,
+            steal=settings.getbool('DISTRIBUTED_STEAL', True),
+        )
+        crawler.distributed_scheduler = scheduler
+        return scheduler
+
+    def open(self, spider):
+        self.spider = spider
+        self.crawler.signals.connect(self.spider_idle, signal=signals.spider_idle)
+        self.renewal = task.LoopingCall(self.frontier.renew, self.worker)
+        self.renewal.start(self.frontier.lease_timeout / 3, now=False)
+
+    def close(self, reason):
+        if self.renewal is not None and self.renewal.running:
+            self.renewal.stop()
+        # Whatever this worker did not finish goes back to the others
+        self.frontier.release(self.worker, [request_id for request_id, _ in self.local])
+        self.frontier.release(self.worker)
+        self.local.clear()
+        self.stats.set_value('frontier/abandoned', self.frontier.abandoned, spider=self.spider)
+        self.frontier.close()
+
+    def has_pending_requests(self):
+        return bool(self.local) or self.frontier.pending() > 0
+
+    def __len__(self):
+        return len(self.local) + self.frontier.pending()
+
+    def enqueue_request(self, request):
+        replaces = request.meta.pop('frontier_id', None)
+        fingerprint = None
+        if not request.dont_filter:
+            fingerprinter = getattr(self.crawler, 'request_fingerprinter', None)
+            if fingerprinter is not None:
+                fingerprint = fingerprinter.fingerprint(request).hex()
+            else:
+                from scrapy.utils.request import request_fingerprint  # Scrapy < 2.7
+                fingerprint = request_fingerprint(request)
+        payload = pickle.dumps(request.to_dict(spider=self.spider), protocol=pickle.HIGHEST_PROTOCOL)
+        if not self.frontier.push(payload, request.priority, request_shard(request, self.shard_by), fingerprint,
+                                  replaces):
+            self.stats.inc_value('dupefilter/filtered', spider=self.spider)
+            return False
+        self.stats.inc_value('frontier/enqueued', spider=self.spider)
+        return True
+
+    def next_request(self):
+        if not self.local:
+            self.local = self.lease()[::-1]
+            if not self.local:
+                return None
+        request_id, payload = self.local.pop()
+        request = request_from_dict(pickle.loads(payload), spider=self.spider)
+        request.meta['frontier_id'] = request_id
+        self.stats.inc_value('frontier/dequeued', spider=self.spider)
+        return request
+
+    def lease(self):
+        """Lease a batch from the own shards, else (when stealing) from any."""
+        own = self.shards is not None or self.bucket is not None
+        leased = self.frontier.pop(self.worker, self.prefetch, self.shards, self.bucket)
+        if not leased and own and self.steal:
+            leased = self.frontier.pop(self.worker, self.prefetch)
+            if leased:
+                self.stats.inc_value('frontier/stolen', len(leased), spider=self.spider)
+        return leased
+
+    def ack(self, request):
+        """Remove a finished request from the frontier."""
+        request_id = request.meta.get('frontier_id')
+        if request_id is not None:
+            self.frontier.ack(request_id)
+            self.stats.inc_value('frontier/acked', spider=self.spider)
+
+    def spider_idle(self, spider):
+        if spider is not self.spider:
+            return
+        # Nothing is in progress here, so leases still held belong to requests
+        # that ended without an acknowledgement, e.g. dropped by a middleware
+        dropped = self.frontier.ack_worker(self.worker)
+        if dropped:
+            self.stats.inc_value('frontier/acked_on_idle', dropped, spider=spider)
+        # Stay up while other workers hold leases: their callbacks may enqueue
+        # more requests, and the leases of a killed worker come back on expiry
+        if self.frontier.in_flight():
+            raise DontCloseSpider
+
+
+def merge_outputs(inputs, output):
+    """Merge per-worker export files into one, keeping the last copy of every listing.
+
+    Args:
+        inputs (list): Files or glob patterns (.csv, .json, .jsonl or Parquet).
+        output (str): The merged file; its extension picks the format.
+
+    Returns:
+        int: Listings written.
+    """
+    from zillow.scoring import pd, read_listings, write_listings
+
+    paths = sorted({path for pattern in inputs for path in (glob.glob(pattern) or [pattern])})
+    paths = [path for path in paths if os.path.abspath(path) != os.path.abspath(output)]
+    frames = [read_listings(path) for path in paths]
+    if not frames:
+        raise ValueError('No input files')
+    merged = pd.concat(frames, ignore_index=True)
+    if 'zpid' in merged:
+        key = merged['zpid'].astype('string')
+        if 'url' in merged:
+            key = key.fillna(merged['url'].astype('string'))
+        merged = merged[~key.duplicated(keep='last') | key.isna()]
+    write_listings(merged, output)
+    return len(merged)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage distributed Zillow crawls.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    status = commands.add_parser('status', help='Show the requests waiting and in flight per shard')
+    status.add_argument('frontier', help='DISTRIBUTED_FRONTIER_PATH')
+    reset = commands.add_parser('reset', help='Clear the frontier and dupefilter before a new crawl')
+    reset.add_argument('frontier', help='DISTRIBUTED_FRONTIER_PATH')
+    merge = commands.add_parser('merge', help="Merge the workers' export files")
+    merge.add_argument('inputs', nargs='+', help="Files or glob patterns, e.g. 'output-*.csv'")
+    merge.add_argument('-o', '--output', required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == 'merge':
+        print(f"{merge_outputs(args.inputs, args.output)} listings written to {args.output}")
+        return
+
+    frontier = Frontier(args.frontier)
+    try:
+        if args.command == 'reset':
+            frontier.reset()
+            return
+        shards = frontier.status()
+        for shard, (pending, in_flight) in sorted(shards.items()):
+            print(f"{shard or '-'}\t{pending} pending\t{in_flight} in flight")
+        print(f"{sum(p for p, _ in shards.values())} pending, {sum(f for _, f in shards.values())} in flight,"
+              f" {frontier.seen()} fingerprints")
+    finally:
+        frontier.close()
+
+
+if __name__ == '__main__':
+    main()
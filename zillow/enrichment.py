@@ -0,0 +1,75 @@
+# Holding area for items waiting on their details page.
+#
+# A search card has most of a listing's fields, but the Zestimate is only on
+# the listing's details page. Rather than emitting a partial item and
+# updating it later, the spider keeps each item here, keyed by listing, until
+# its details page has been parsed. It then emits one complete item. The
+# buffer is bounded in both size and age: when it is full the oldest item
+# leaves early, and an item whose details page has not arrived within
+# ``timeout`` seconds is emitted as it is.
+
+import time
+from collections import OrderedDict
+
+
+class EnrichmentBuffer:
+    """Items keyed by listing, in arrival order, with size and age limits."""
+
+    def __init__(self, max_size=1000, timeout=120, clock=time.monotonic):
+        """
+        Args:
+            max_size (int): Most items held at once.
+            timeout (float): Seconds an item may wait for its details.
+            clock (callable): Returns the current time in seconds.
+        """
+        self.max_size = max_size
+        self.timeout = timeout
+        self.clock = clock
+        self.items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, key, item):
+        """Hold ``item`` until ``pop(key)``.
+
+        Returns:
+            list: Items pushed out because the buffer was full, oldest first.
+        """
+        self.items[key] = (self.clock(), item)
+        evicted = []
+        while len(self.items) > self.max_size:
+            evicted.append(self.items.popitem(last=False)[1][1])
+        return evicted
+
+    def get(self, key):
+        """Return the item held for ``key`` without removing it, or None."""
+        entry = self.items.get(key)
+        return entry[1] if entry is not None else None
+
+    def pop(self, key):
+        """Remove and return the item held for ``key``, or None."""
+        entry = self.items.pop(key, None)
+        return entry[1] if entry is not None else None
+
+    def expired(self):
+        """Remove and return the items that waited longer than ``timeout``."""
+        deadline = self.clock() - self.timeout
+        expired = []
+        # Arrival order is age order, so stop at the first item still in time
+        while self.items:
+            key, (added, item) = next(iter(self.items.items()))
+            if added > deadline:
+                break
+            del self.items[key]
+            expired.append(item)
+        return expired
+
+    def drain(self):
+        """Remove and return every item."""
+        items = [item for _, item in self.items.values()]
+        self.items.clear()
+        return items
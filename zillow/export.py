@@ -0,0 +1,146 @@
+# Background writer used by the export pipelines.
+#
+# Serializing and writing items is blocking file I/O. Doing it inside
+# process_item stalls the Twisted reactor, and with it every download and
+# callback. BackgroundWriter hands items to a dedicated thread through a
+# bounded queue instead. When the queue is full, submit() returns a Deferred
+# that only fires once the writer has caught up; Scrapy waits on it before
+# finishing the item, which throttles the crawl rather than growing memory.
+
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from twisted.internet import defer, reactor, threads
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class BackgroundWriter:
+    """Runs a blocking ``write`` callable on its own thread."""
+
+    def __init__(self, write, name='export', max_queue=1000, on_idle=None, idle_interval=1.0, on_close=None, stats=None):
+        """
+        Args:
+            write (callable): Called on the writer thread with every submitted object.
+            name (str): Used for the thread name and the stats keys.
+            max_queue (int): Objects that may wait before backpressure kicks in.
+            on_idle (callable): Called on the writer thread when nothing arrived
+                for ``idle_interval`` seconds, e.g. to flush time-based batches.
+            idle_interval (float): See ``on_idle``.
+            on_close (callable): Called on the writer thread after the queue drained.
+            stats (StatsCollector): Receives queue depth and write latency stats.
+        """
+        self.write = write
+        self.name = name
+        self.on_idle = on_idle
+        self.idle_interval = idle_interval
+        self.on_close = on_close
+        self.stats = stats
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.waiting = deque()
+        self.thread = threading.Thread(target=self._run, name=f"{name}-writer", daemon=True)
+
+        # Updated by the writer thread, published as stats from the reactor thread
+        self.written = 0
+        self.errors = 0
+        self.write_time = 0.0
+        self.write_time_max = 0.0
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, obj):
+        """Queue ``obj`` for writing.
+
+        Returns:
+            Deferred: None if ``obj`` was queued right away, otherwise a Deferred
+            firing once there was room for it.
+        """
+        self._publish_stats()
+        # Objects already waiting for room go first, so writes keep submission order
+        if not self.waiting:
+            try:
+                self.queue.put_nowait(obj)
+                return None
+            except queue.Full:
+                pass
+
+        d = defer.Deferred()
+        self.waiting.append((d, obj))
+        if self.stats:
+            self.stats.inc_value(f'export/{self.name}/backpressure')
+        # The writer may have drained the queue before the waiter was visible
+        self._release_waiting()
+        return d
+
+    def close(self):
+        """Drain the queue, run ``on_close`` and stop the thread.
+
+        Returns:
+            Deferred: Fires once the writer thread has exited.
+        """
+        d = self.submit(_STOP) or defer.succeed(None)
+        d.addCallback(lambda _: threads.deferToThread(self.thread.join))
+        d.addCallback(lambda _: self._publish_stats())
+        return d
+
+    def _release_waiting(self):
+        # Reactor thread: move waiting objects into the queue while there is room
+        while self.waiting:
+            d, obj = self.waiting[0]
+            try:
+                self.queue.put_nowait(obj)
+            except queue.Full:
+                return
+            self.waiting.popleft()
+            d.callback(None)
+
+    def _publish_stats(self):
+        if not self.stats:
+            return
+        prefix = f'export/{self.name}'
+        self.stats.max_value(f'{prefix}/queue_depth_max', self.queue.qsize() + len(self.waiting))
+        self.stats.set_value(f'{prefix}/items_written', self.written)
+        if self.errors:
+            self.stats.set_value(f'{prefix}/errors', self.errors)
+        if self.written:
+            self.stats.set_value(f'{prefix}/write_latency_avg_ms', self.write_time / self.written * 1000)
+            self.stats.set_value(f'{prefix}/write_latency_max_ms', self.write_time_max * 1000)
+
+    def _run(self):
+        while True:
+            try:
+                obj = self.queue.get(timeout=self.idle_interval)
+            except queue.Empty:
+                self._call(self.on_idle)
+                continue
+
+            if self.waiting:
+                reactor.callFromThread(self._release_waiting)
+            if obj is _STOP:
+                break
+
+            started = time.perf_counter()
+            if self._call(self.write, obj):
+                elapsed = time.perf_counter() - started
+                self.written += 1
+                self.write_time += elapsed
+                self.write_time_max = max(self.write_time_max, elapsed)
+
+        self._call(self.on_close)
+
+    def _call(self, func, *args):
+        if func is None:
+            return False
+        try:
+            func(*args)
+            return True
+        except Exception:
+            self.errors += 1
+            logger.exception('%s writer failed', self.name)
+            return False
@@ -0,0 +1,276 @@
+# Search page fetch engine for the Streamlit app.
+#
+# All pages go through one pooled keep-alive requests.Session, and several
+# pages are fetched concurrently by a small thread pool. Pages are consumed in
+# order, and fetching stops as soon as the listing quota is filled or a page
+# comes back empty or cannot be fetched at all (e.g. a dropped connection). A
+# first page that fails (e.g. blocked with a 403) raises requests.HTTPError or
+# another requests.RequestException instead, so callers do not mistake it for
+# no results.
+#
+# Listing cards are extracted by the fastest installed parser backend
+# (selectolax, then lxml), with BeautifulSoup as the fallback. Every backend
+# collects the four card fields in one pass over the document.
+
+import logging
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HEADERS = {
+    'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
+    'accept-encoding': 'gzip, deflate, br',
+    'accept-language': 'en-US,en;q=0.8',
+    'upgrade-insecure-requests': '1',
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/61.0.3163.100 Safari/537.36'
+}
+
+COLUMNS = ('Address', 'Price', 'Beds', 'Link')
+
+
+# Card class -> result column
+CARD_CLASSES = {
+    'list-card-addr': 'Address',
+    'list-card-price': 'Price',
+    'list-card-details': 'Beds',
+    'list-card-link': 'Link',
+}
+
+
+def _empty_columns():
+    return {column: [] for column in COLUMNS}
+
+
+def _card_columns(tag, class_attr):
+    """Return the columns an element with these class tokens contributes to."""
+    columns = []
+    for token in class_attr.split():
+        column = CARD_CLASSES.get(token)
+        # Only <ul> elements carry the bed/bath/sqft details
+        if column and (column != 'Beds' or tag == 'ul'):
+            columns.append(column)
+    return columns
+
+
+def parse_with_selectolax(content):
+    results = _empty_columns()
+    tree = HTMLParser(content)
+    for node in tree.css('.list-card-addr, .list-card-price, ul.list-card-details, .list-card-link'):
+        for column in _card_columns(node.tag, node.attributes.get('class') or ''):
+            if column == 'Link':
+                results[column].append(node.attributes.get('href') or '')
+            else:
+                results[column].append(node.text(deep=True, separator='', strip=True))
+    return results
+
+
+def parse_with_lxml(content):
+    results = _empty_columns()
+    root = lxml.html.fromstring(content)
+    for element in root.iter():
+        class_attr = element.get('class') if isinstance(element.tag, str) else None
+        if not class_attr or 'list-card-' not in class_attr:
+            continue
+        for column in _card_columns(element.tag, class_attr):
+            if column == 'Link':
+                results[column].append(element.get('href', ''))
+            else:
+                results[column].append(''.join(text.strip() for text in element.itertext()))
+    return results
+
+
+def parse_with_bs4(content):
+    results = _empty_columns()
+    soup = BeautifulSoup(content, 'html.parser')
+    for element in soup.find_all(class_=list(CARD_CLASSES)):
+        for column in _card_columns(element.name, ' '.join(element.get('class', []))):
+            if column == 'Link':
+                results[column].append(element.get('href', ''))
+            else:
+                results[column].append(element.get_text(strip=True))
+    return results
+
+
+PARSERS = {}
+if HTMLParser is not None:
+    PARSERS['selectolax'] = parse_with_selectolax
+if lxml is not None:
+    PARSERS['lxml'] = parse_with_lxml
+if BeautifulSoup is not None:
+    PARSERS['bs4'] = parse_with_bs4
+
+
+def get_parser(backend=None):
+    """Return the card parser for ``backend``, or the fastest installed one.
+
+    Args:
+        backend (str): 'selectolax', 'lxml' or 'bs4'.
+
+    Returns:
+        callable: Turns page content into a dict of column lists.
+    """
+    if backend:
+        try:
+            return PARSERS[backend]
+        except KeyError:
+            raise ValueError(f"Unknown or unavailable parser backend: {backend!r}") from None
+    if not PARSERS:
+        raise ImportError('No HTML parser installed, install selectolax, lxml or beautifulsoup4')
+    return next(iter(PARSERS.values()))
+
+
+def parse_search_page(content, backend=None):
+    """Extract the listing cards of a search results page.
+
+    Args:
+        content (bytes): The page HTML.
+        backend (str): Parser backend, defaults to the fastest installed one.
+
+    Returns:
+        dict: Lists of addresses, prices, bed details and links, keyed by column name.
+    """
+    return get_parser(backend)(content)
+
+
+class ListingFetcher:
+    """Fetches search result pages concurrently over a shared session."""
+
+    def __init__(self, concurrency=4, timeout=20, headers=None, session=None, parse=parse_search_page):
+        """
+        Args:
+            concurrency (int): Maximum number of pages fetched at the same time.
+            timeout (float): Per-request timeout in seconds.
+            headers (dict): Request headers, defaults to ``DEFAULT_HEADERS``.
+            session (requests.Session): Session to reuse; one with a connection
+                pool sized for ``concurrency`` is created if omitted.
+            parse (callable): Turns page content into a dict of column lists.
+        """
+        self.concurrency = max(1, int(concurrency))
+        self.timeout = timeout
+        self.headers = headers or DEFAULT_HEADERS
+        self.parse = parse
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+    @staticmethod
+    def page_url(base_url, page_num):
+        return f'{base_url}{page_num}_p/' if page_num > 1 else base_url
+
+    def fetch_page(self, url, required=False):
+        """Fetch and parse one page.
+
+        Args:
+            url (str): The page.
+            required (bool): Raise instead of returning None if the page
+                cannot be fetched, as for the first page of a search.
+
+        Returns:
+            dict: The parsed columns, or None if the page does not exist.
+
+        Raises:
+            requests.RequestException: If ``required`` and the request fails,
+                e.g. requests.HTTPError if the response is not a 200.
+        """
+        try:
+            response = self.session.get(url, headers=self.headers, timeout=self.timeout)
+        except requests.RequestException:
+            if required:
+                raise
+            logger.warning("Failed to fetch %s; ending the search there", url, exc_info=True)
+            return None
+        if response.status_code != 200:
+            if required:
+                raise requests.HTTPError(f"{response.status_code} response from {url}", response=response)
+            return None
+        return self.parse(response.content)
+
+    def fetch(self, base_url, max_properties=None):
+        """Fetch listings from consecutive pages of ``base_url``.
+
+        Args:
+            base_url (str): The first search results page.
+            max_properties (int): Stop once this many listings were collected.
+
+        Returns:
+            dict: Lists of at most ``max_properties`` values per column.
+        """
+        results = _empty_columns()
+        for page in self.iter_pages(base_url, max_properties):
+            for column in COLUMNS:
+                results[column].extend(page[column])
+        return results
+
+    def iter_pages(self, base_url, max_properties=None):
+        """Yield the parsed pages of ``base_url`` in order, trimmed to the quota.
+
+        Raises:
+            requests.RequestException: If the first page cannot be fetched.
+        """
+        pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='zillow-fetch')
+        pending = deque()
+        next_page = 1
+        fetched = 0
+        per_page = None
+        try:
+            while True:
+                # Keep the window full, but only speculate on as many pages as
+                # the remaining quota needs once the page size is known
+                window = self.concurrency
+                if max_properties is not None:
+                    window = 1 if per_page is None else min(window, math.ceil((max_properties - fetched) / per_page))
+                while len(pending) < window:
+                    pending.append(pool.submit(self.fetch_page, self.page_url(base_url, next_page), next_page == 1))
+                    next_page += 1
+
+                page = pending.popleft().result()
+                num_new = len(page['Address']) if page else 0
+                if not num_new:
+                    return
+                per_page = per_page or num_new
+
+                if max_properties is not None and fetched + num_new > max_properties:
+                    num_new = max_properties - fetched
+                    page = {column: values[:num_new] for column, values in page.items()}
+                fetched += num_new
+                yield page
+
+                if max_properties is not None and fetched >= max_properties:
+                    return
+        finally:
+            # Pages still queued are never started; running ones are abandoned
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+_default_fetcher = None
+
+
+def get_fetcher():
+    """Return the process-wide fetcher, so connections are reused across searches."""
+    global _default_fetcher
+    if _default_fetcher is None:
+        _default_fetcher = ListingFetcher()
+    return _default_fetcher
@@ -0,0 +1,157 @@
+# Geographic partitioning of search areas.
+#
+# A search query returns at most a fixed number of results, however many
+# listings match. Dense cities are therefore covered with map-bounds tiles:
+# the crawl starts from the city's bounding box, and every tile whose first
+# page reports more results than the cap is split into four quadrants, which
+# are searched in turn. Sparse areas cost one query and dense areas get
+# exactly the depth they need. Tiles are half-open, so a listing on a shared
+# edge belongs to one tile only; ListingMerger uses the listings' coordinates
+# and zpids to drop the duplicates neighbouring tiles return.
+
+
+class Tile:
+    """A map-bounds rectangle in degrees, ``[west, east) x [south, north)``.
+
+    ``edges`` names the sides that lie on the border of the searched area.
+    Listings beyond such a side still belong to the tile, so the leaves of a
+    partition own every listing the area's query can return exactly once.
+    """
+
+    __slots__ = ('west', 'east', 'south', 'north', 'depth', 'edges')
+
+    ALL_EDGES = frozenset(('west', 'east', 'south', 'north'))
+
+    def __init__(self, west, east, south, north, depth=0, edges=ALL_EDGES):
+        self.west = west
+        self.east = east
+        self.south = south
+        self.north = north
+        self.depth = depth
+        self.edges = frozenset(edges)
+
+    @classmethod
+    def from_bounds(cls, bounds):
+        """Build a tile from a ``{'west', 'east', 'south', 'north'}`` dict, e.g. a query's mapBounds."""
+        return cls(bounds['west'], bounds['east'], bounds['south'], bounds['north'])
+
+    def as_bounds(self):
+        return {'west': self.west, 'east': self.east, 'south': self.south, 'north': self.north}
+
+    def __repr__(self):
+        return f"Tile({self.west}, {self.east}, {self.south}, {self.north}, depth={self.depth})"
+
+    def contains(self, latitude, longitude):
+        edges = self.edges
+        return ((longitude >= self.west or 'west' in edges) and (longitude < self.east or 'east' in edges)
+                and (latitude >= self.south or 'south' in edges) and (latitude < self.north or 'north' in edges))
+
+    def grid(self, rows, cols=None):
+        """Split the tile into a ``rows`` x ``cols`` grid, south-west first."""
+        cols = cols or rows
+        width = (self.east - self.west) / cols
+        height = (self.north - self.south) / rows
+        tiles = []
+        for row in range(rows):
+            for col in range(cols):
+                edges = set()
+                if col == 0:
+                    edges.add('west')
+                if col == cols - 1:
+                    edges.add('east')
+                if row == 0:
+                    edges.add('south')
+                if row == rows - 1:
+                    edges.add('north')
+                tiles.append(Tile(
+                    self.west + col * width,
+                    self.east if col == cols - 1 else self.west + (col + 1) * width,
+                    self.south + row * height,
+                    self.north if row == rows - 1 else self.south + (row + 1) * height,
+                    depth=self.depth + 1,
+                    edges=edges & self.edges,
+                ))
+        return tiles
+
+    def split(self):
+        """Return the four quadrants of the tile."""
+        return self.grid(2)
+
+
+class QuadtreePartitioner:
+    """Decides which tiles must be split to stay under the result cap."""
+
+    def __init__(self, result_cap=500, max_depth=8):
+        """
+        Args:
+            result_cap (int): Most results one query returns.
+            max_depth (int): Tiles this many splits deep are never split again,
+                e.g. when a single building holds more listings than the cap.
+        """
+        self.result_cap = result_cap
+        self.max_depth = max_depth
+
+    def should_split(self, tile, total_results):
+        return total_results > self.result_cap and tile.depth < self.max_depth
+
+    def partition(self, tile, count):
+        """Split ``tile`` until every leaf holds at most ``result_cap`` results.
+
+        This is the offline form of what the spider does one response at a
+        time; it is handy for planning and for testing against synthetic
+        listing distributions.
+
+        Args:
+            tile (Tile): The area to cover.
+            count (callable): Returns the number of results of a tile.
+
+        Returns:
+            list: ``(tile, count)`` pairs for the leaf tiles.
+        """
+        leaves = []
+        pending = [tile]
+        while pending:
+            tile = pending.pop()
+            total = count(tile)
+            if self.should_split(tile, total):
+                pending.extend(tile.split())
+            else:
+                leaves.append((tile, total))
+        return leaves
+
+
+def listing_coordinates(item):
+    """Return ``(latitude, longitude)`` of an item as floats, or None if unknown."""
+    try:
+        return float(item.get('latitude')), float(item.get('longitude'))
+    except (TypeError, ValueError):
+        return None
+
+
+class ListingMerger:
+    """Merges the listings of overlapping tile searches by zpid."""
+
+    def __init__(self):
+        self.seen = set()
+        self.duplicates = 0
+        self.outside = 0
+
+    def accept(self, item, tile=None):
+        """Return True the first time a listing of ``tile`` is offered.
+
+        Listings whose coordinates fall outside ``tile`` are left to the tile
+        that owns them, which is how results on shared edges are merged.
+        """
+        if tile is not None:
+            coordinates = listing_coordinates(item)
+            if coordinates is not None and not tile.contains(*coordinates):
+                self.outside += 1
+                return False
+        zpid = item.get('zpid')
+        if not zpid:
+            return True
+        if zpid in self.seen:
+            self.duplicates += 1
+            return False
+        self.seen.add(zpid)
+        return True
@@ -0,0 +1,304 @@
+# Price history of crawled listings.
+#
+# Exports are overwritten by every crawl, but deal finding needs the price
+# trajectory of a listing. PriceHistory is an append-only SQLite store keyed
+# by zpid. The listings table holds the latest known price, Zestimate and
+# status of every listing, with an index on postal code. The changes table
+# holds one row per observation that changed something, with only the changed
+# fields set: prices and Zestimates as integer-cent deltas against the
+# previous value, the status as its new value. A listing's first observation
+# is a delta against nothing, so summing the deltas up to a point in time
+# gives the price at that time.
+#
+# Changes are clustered by (zpid, time), and a partial covering index holds
+# the price changes by time. "Price cut by 5% in the last 14 days" therefore
+# reads only the last 14 days of price changes, however many years of crawls
+# the store holds.
+
+import argparse
+import os
+import sqlite3
+import time
+
+from zillow.records import ListingRecord, to_cents, to_int, to_text
+
+DEFAULT_FILENAME = 'zillow-history.sqlite3'
+DAY = 86400
+
+
+class PriceHistory:
+    """Append-only price, Zestimate and status history per zpid."""
+
+    def __init__(self, path, commit_every=500):
+        """
+        Args:
+            path (str): SQLite database file; created if missing.
+            commit_every (int): Observations batched into one transaction.
+        """
+        self.path = path
+        self.commit_every = commit_every
+        self._pending = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Writes take the lock up front, so the workers of a distributed crawl
+        # queue for it instead of failing to upgrade a read lock
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level='IMMEDIATE', check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS listings ('
+            ' zpid INTEGER PRIMARY KEY,'
+            ' postal_code TEXT,'
+            ' price_cents INTEGER,'
+            ' zestimate_cents INTEGER,'
+            ' status TEXT,'
+            ' first_seen INTEGER NOT NULL,'
+            ' last_seen INTEGER NOT NULL'
+            ')'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS listings_postal_code ON listings (postal_code)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS changes ('
+            ' zpid INTEGER NOT NULL,'
+            ' observed_at INTEGER NOT NULL,'
+            ' price_delta INTEGER,'
+            ' zestimate_delta INTEGER,'
+            ' status TEXT,'
+            ' PRIMARY KEY (zpid, observed_at)'
+            ') WITHOUT ROWID'
+        )
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS price_changes ON changes (observed_at, zpid, price_delta)'
+            ' WHERE price_delta IS NOT NULL'
+        )
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM listings').fetchone()[0]
+
+    def record(self, zpid, price_cents=None, zestimate_cents=None, status=None, postal_code=None,
+               observed_at=None):
+        """Record one observation of a listing.
+
+        None means "not observed": a missing Zestimate neither changes nor
+        clears the stored one.
+
+        Args:
+            zpid (int): The listing.
+            price_cents (int): Asking price.
+            zestimate_cents (int): Zestimate.
+            status (str): Listing status, e.g. FOR_SALE or SOLD.
+            postal_code (str): Stored with the listing for postal code queries.
+            observed_at (float): Epoch seconds; now by default.
+
+        Returns:
+            dict: The fields that changed, ``{field: (old, new)}``; for a new
+            listing every observed field, with None as the old value.
+        """
+        observed_at = int(observed_at if observed_at is not None else time.time())
+        current = self.conn.execute(
+            'SELECT price_cents, zestimate_cents, status FROM listings WHERE zpid = ?', (zpid,)).fetchone()
+        old = current or (None, None, None)
+        new = (price_cents, zestimate_cents, status)
+        changed = {
+            name: (before, after)
+            for name, before, after in zip(('price_cents', 'zestimate_cents', 'status'), old, new)
+            if after is not None and after != before
+        }
+
+        if current is None:
+            self.conn.execute(
+                'INSERT INTO listings (zpid, postal_code, price_cents, zestimate_cents, status, first_seen, last_seen)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (zpid, postal_code, price_cents, zestimate_cents, status, observed_at, observed_at),
+            )
+        else:
+            self.conn.execute(
+                'UPDATE listings SET postal_code = COALESCE(?, postal_code), price_cents = COALESCE(?, price_cents),'
+                ' zestimate_cents = COALESCE(?, zestimate_cents), status = COALESCE(?, status),'
+                ' last_seen = MAX(last_seen, ?) WHERE zpid = ?',
+                (postal_code, price_cents, zestimate_cents, status, observed_at, zpid),
+            )
+
+        if changed:
+            price = changed.get('price_cents')
+            zestimate = changed.get('zestimate_cents')
+            self.conn.execute(
+                'INSERT INTO changes (zpid, observed_at, price_delta, zestimate_delta, status) VALUES (?, ?, ?, ?, ?)'
+                ' ON CONFLICT (zpid, observed_at) DO UPDATE SET'
+                ' price_delta = IFNULL(price_delta + excluded.price_delta, COALESCE(price_delta, excluded.price_delta)),'
+                ' zestimate_delta = IFNULL(zestimate_delta + excluded.zestimate_delta,'
+                ' COALESCE(zestimate_delta, excluded.zestimate_delta)),'
+                ' status = COALESCE(excluded.status, status)',
+                (zpid, observed_at,
+                 price[1] - (price[0] or 0) if price else None,
+                 zestimate[1] - (zestimate[0] or 0) if zestimate else None,
+                 changed['status'][1] if 'status' in changed else None),
+            )
+
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+        return changed
+
+    def record_item(self, item, observed_at=None):
+        """Record a scraped item, raw or normalized; ignored without a zpid.
+
+        Args:
+            item: A ``ListingRecord``, a ``ZillowItem`` or a dict of either's fields.
+
+        Returns:
+            dict: See ``record``.
+        """
+        if isinstance(item, ListingRecord):
+            item = item.asdict()
+        get = item.get
+        if 'price_cents' in item:
+            zpid, price, zestimate = to_int(get('zpid')), to_int(get('price_cents')), to_int(get('zestimate_cents'))
+        else:
+            zpid, price, zestimate = to_int(get('zpid')), to_cents(get('price')), to_cents(get('zestimate_value'))
+        if zpid is None:
+            return {}
+        return self.record(zpid, price, zestimate, to_text(get('availability')), to_text(get('postal_code')),
+                           observed_at)
+
+    def history(self, zpid):
+        """Return the listing's values after every change, oldest first.
+
+        Returns:
+            list: ``(observed_at, price_cents, zestimate_cents, status)`` tuples.
+        """
+        rows = []
+        price = zestimate = status = None
+        for observed_at, price_delta, zestimate_delta, new_status in self.conn.execute(
+                'SELECT observed_at, price_delta, zestimate_delta, status FROM changes'
+                ' WHERE zpid = ? ORDER BY observed_at', (zpid,)):
+            if price_delta is not None:
+                price = (price or 0) + price_delta
+            if zestimate_delta is not None:
+                zestimate = (zestimate or 0) + zestimate_delta
+            status = new_status or status
+            rows.append((observed_at, price, zestimate, status))
+        return rows
+
+    def price_cuts(self, min_cut=0.05, days=14, postal_code=None, now=None, limit=None):
+        """Listings whose price dropped by at least ``min_cut`` within the last ``days``.
+
+        The price at the end of the window is the current price minus the
+        price deltas after it, and the price at its start is that minus the
+        deltas inside it, so only changes from the window on are read.
+        Listings first seen inside the window are left out.
+
+        Args:
+            min_cut (float): Fraction of the earlier price, e.g. 0.05 for 5%.
+            days (float): Window length.
+            postal_code (str): Only listings in this postal code.
+            now (float): End of the window in epoch seconds; now by default.
+            limit (int): Return at most this many, biggest cuts first.
+
+        Returns:
+            list: ``(zpid, postal_code, price_before_cents, price_cents, cut)``
+            tuples, biggest cuts first.
+        """
+        now = int(now if now is not None else time.time())
+        query = (
+            'SELECT w.zpid, l.postal_code, l.price_cents - w.later - w.delta AS before,'
+            ' l.price_cents - w.later AS after FROM ('
+            ' SELECT zpid,'
+            '  SUM(CASE WHEN observed_at <= ? THEN price_delta ELSE 0 END) AS delta,'
+            '  SUM(CASE WHEN observed_at > ? THEN price_delta ELSE 0 END) AS later'
+            ' FROM changes INDEXED BY price_changes'
+            ' WHERE observed_at >= ? AND price_delta IS NOT NULL GROUP BY zpid HAVING MIN(observed_at) <= ?'
+            ') w JOIN listings l ON l.zpid = w.zpid'
+            ' WHERE before > 0 AND after <= before * (1 - ?)'
+        )
+        params = [now, now, now - days * DAY, now, min_cut]
+        if postal_code is not None:
+            query += ' AND l.postal_code = ?'
+            params.append(str(postal_code))
+        query += ' ORDER BY CAST(before - after AS REAL) / before DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        return [(zpid, postal, before, price, (before - price) / before)
+                for zpid, postal, before, price in self.conn.execute(query, params)]
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self):
+        if self.conn is not None:
+            self.commit()
+            self.conn.close()
+            self.conn = None
+
+
+def load_export(history, path, observed_at=None):
+    """Record every listing of an exported crawl, e.g. to backfill older crawls.
+
+    Args:
+        history (PriceHistory): The store.
+        path (str): A .csv, .json, .jsonl or Parquet export.
+        observed_at (float): When the crawl ran; the file's modification time by default.
+
+    Returns:
+        int: Listings whose price, Zestimate or status changed.
+    """
+    from zillow.scoring import read_listings
+
+    observed_at = observed_at if observed_at is not None else os.path.getmtime(path)
+    frame = read_listings(path).astype(object)
+    frame = frame.where(frame.notna(), None)
+    changed = 0
+    for row in frame.to_dict('records'):
+        changed += bool(history.record_item(row, observed_at))
+    history.commit()
+    return changed
+
+
+def main(argv=None):
+    import datetime
+
+    parser = argparse.ArgumentParser(description='Query and fill the price history of crawled listings.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    cuts = commands.add_parser('cuts', help='List recent price cuts')
+    cuts.add_argument('store', help='PRICE_HISTORY_PATH')
+    cuts.add_argument('--min-cut', type=float, default=5, help='Percent of the earlier price')
+    cuts.add_argument('--days', type=float, default=14)
+    cuts.add_argument('--postal-code')
+    cuts.add_argument('--limit', type=int, default=50)
+    show = commands.add_parser('show', help="Print a listing's history")
+    show.add_argument('store', help='PRICE_HISTORY_PATH')
+    show.add_argument('zpid', type=int)
+    load = commands.add_parser('load', help='Record the listings of exported crawls')
+    load.add_argument('store', help='PRICE_HISTORY_PATH')
+    load.add_argument('exports', nargs='+', help='Exports, oldest crawl first')
+    load.add_argument('--date', help='Crawl date (YYYY-MM-DD); the files\' modification times by default')
+    args = parser.parse_args(argv)
+
+    history = PriceHistory(args.store)
+    try:
+        if args.command == 'cuts':
+            for zpid, postal_code, before, price, cut in history.price_cuts(
+                    args.min_cut / 100, args.days, args.postal_code, limit=args.limit):
+                print(f"{zpid}\t{postal_code or '-'}\t${before / 100:,.0f} -> ${price / 100:,.0f}\t-{cut:.1%}")
+        elif args.command == 'show':
+            for observed_at, price, zestimate, status in history.history(args.zpid):
+                day = datetime.datetime.fromtimestamp(observed_at).date().isoformat()
+                print(f"{day}\t{price / 100 if price is not None else '-'}"
+                      f"\t{zestimate / 100 if zestimate is not None else '-'}\t{status or '-'}")
+        else:
+            observed_at = None
+            if args.date:
+                observed_at = datetime.datetime.fromisoformat(args.date).timestamp()
+            for path in args.exports:
+                print(f"{path}: {load_export(history, path, observed_at)} listings changed")
+    finally:
+        history.close()
+
+
+if __name__ == '__main__':
+    main()
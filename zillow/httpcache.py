@@ -0,0 +1,504 @@
+# Compressed, content-addressed store of crawled responses.
+#
+# ResponseStore keeps every response a crawl downloads in one SQLite file.
+# Bodies are stored once per distinct content (keyed by their SHA-256), are
+# decoded from the transfer's gzip/deflate, and are compressed with zstd. The
+# zstd dictionary is trained on the first bodies of the store, so the
+# template markup every Zillow page repeats costs next to nothing; during a
+# crawl it is trained on a thread, so downloads go on meanwhile. Without the
+# zstandard package, zlib is used. The responses table indexes the bodies
+# by request fingerprint and crawl date: a page that did not change since
+# yesterday adds one index row, not another body.
+#
+# ResponseStoreStorage plugs the store into Scrapy's HttpCacheMiddleware.
+# ``python -m zillow.httpcache reparse`` re-runs the spider over a stored
+# crawl with every request answered from the store, so a fixed field mapping
+# can be applied to past crawls without touching the network.
+
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_FILENAME = 'zillow-responses.sqlite3'
+
+# Headers describing the transfer encoding of a body that is stored decoded
+TRANSFER_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding')
+
+# Output file extensions whose Scrapy feed format has another name
+FEED_FORMATS = {'jsonl': 'jsonlines', 'jl': 'jsonlines'}
+
+logger = logging.getLogger(__name__)
+
+
+def decode_body(body, headers):
+    """Undo a gzip or deflate Content-Encoding.
+
+    Args:
+        body (bytes): The body as downloaded.
+        headers (dict): ``{name: [values]}``; transfer headers are removed
+            when the body is decoded.
+
+    Returns:
+        bytes: The decoded body, or ``body`` for other encodings.
+    """
+    encoding = next((values[-1] for name, values in headers.items() if name.lower() == 'content-encoding'), '')
+    encoding = encoding.strip().lower()
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        try:
+            # wbits 47 accepts gzip and zlib streams; raw deflate needs -15
+            body = zlib.decompress(body, 47)
+        except zlib.error:
+            try:
+                body = zlib.decompress(body, -15)
+            except zlib.error:
+                return body
+    elif encoding not in ('', 'identity'):
+        return body
+    for name in [name for name in headers if name.lower() in TRANSFER_HEADERS]:
+        del headers[name]
+    return body
+
+
+class ResponseStore:
+    """Responses indexed by request fingerprint and crawl date, bodies stored once."""
+
+    def __init__(self, path, level=9, dictionary_after=1000, dictionary_size=112_640, commit_every=100,
+                 train_in_thread=False):
+        """
+        Args:
+            path (str): SQLite database file; created if missing.
+            level (int): zstd compression level (zlib levels top out at 9).
+            dictionary_after (int): Bodies stored before a zstd dictionary is
+                trained on them; 0 to never train one.
+            dictionary_size (int): Dictionary size in bytes.
+            commit_every (int): Responses batched into one transaction.
+            train_in_thread (bool): Train the dictionary on a Twisted pool
+                thread instead of in the ``store`` call that triggers it.
+        """
+        self.path = path
+        self.level = level
+        self.dictionary_after = dictionary_after
+        self.dictionary_size = dictionary_size
+        self.commit_every = commit_every
+        self.train_in_thread = train_in_thread
+        self.training = False
+        self._pending = 0
+        self._compressors = {}
+        self._decompressors = {}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS bodies ('
+            ' hash TEXT PRIMARY KEY,'
+            ' codec TEXT NOT NULL,'
+            ' dictionary INTEGER,'
+            ' size INTEGER NOT NULL,'
+            ' data BLOB NOT NULL'
+            ')'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            ' fingerprint TEXT NOT NULL,'
+            ' crawl_date TEXT NOT NULL,'
+            ' url TEXT NOT NULL,'
+            ' status INTEGER NOT NULL,'
+            ' headers TEXT NOT NULL,'
+            ' body TEXT NOT NULL REFERENCES bodies (hash),'
+            ' callback TEXT,'
+            ' stored REAL NOT NULL,'
+            ' PRIMARY KEY (fingerprint, crawl_date)'
+            ') WITHOUT ROWID'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_date ON responses (crawl_date)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS dictionaries (id INTEGER PRIMARY KEY, data BLOB NOT NULL)')
+        self.conn.commit()
+
+        row = self.conn.execute('SELECT MAX(id) FROM dictionaries').fetchone()
+        self.dictionary_id = row[0]
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def put_body(self, body):
+        """Store ``body`` unless an identical one is stored already.
+
+        Returns:
+            str: The body's content hash.
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        if self.conn.execute('SELECT 1 FROM bodies WHERE hash = ?', (digest,)).fetchone() is None:
+            codec, dictionary, data = self.compress(body)
+            self.conn.execute(
+                'INSERT INTO bodies (hash, codec, dictionary, size, data) VALUES (?, ?, ?, ?, ?)',
+                (digest, codec, dictionary, len(body), data),
+            )
+            if zstandard is not None and self.dictionary_id is None and self.dictionary_after and not self.training:
+                # Trained once, retried every dictionary_after bodies if there was too little to train on
+                count = self.conn.execute('SELECT COUNT(*) FROM bodies').fetchone()[0]
+                if count % self.dictionary_after == 0:
+                    if self.train_in_thread:
+                        self.train_dictionary_in_thread()
+                    else:
+                        self.train_dictionary()
+        return digest
+
+    def get_body(self, digest):
+        row = self.conn.execute('SELECT codec, dictionary, data FROM bodies WHERE hash = ?', (digest,)).fetchone()
+        return self.decompress(*row) if row else None
+
+    def store(self, fingerprint, url, status, headers, body, crawl_date=None, callback=None):
+        """Record the response to the request with ``fingerprint``.
+
+        A response stored again on the same crawl date replaces the earlier
+        one, e.g. a successful retry replaces a blocked page.
+
+        Args:
+            fingerprint (str): The request fingerprint.
+            url (str): The response URL.
+            status (int): The HTTP status.
+            headers (dict): ``{name: [values]}``.
+            body (bytes): The decoded body.
+            crawl_date (str): ISO date; today by default.
+            callback (str): Name of the spider callback the request was for.
+        """
+        digest = self.put_body(body)
+        self.conn.execute(
+            'INSERT OR REPLACE INTO responses (fingerprint, crawl_date, url, status, headers, body, callback, stored)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (fingerprint, crawl_date or datetime.date.today().isoformat(), url, status,
+             json.dumps(headers, separators=(',', ':')), digest, callback, time.time()),
+        )
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def lookup(self, fingerprint, crawl_date=None, max_age=None):
+        """Return the stored response ``(url, status, headers, body)``, or None.
+
+        Args:
+            fingerprint (str): The request fingerprint.
+            crawl_date (str): Only the response of this crawl date; the
+                newest one by default.
+            max_age (float): Ignore responses stored more than this many
+                seconds ago.
+        """
+        query = 'SELECT url, status, headers, body FROM responses WHERE fingerprint = ?'
+        params = [fingerprint]
+        if crawl_date is not None:
+            query += ' AND crawl_date = ?'
+            params.append(crawl_date)
+        if max_age:
+            query += ' AND stored >= ?'
+            params.append(time.time() - max_age)
+        row = self.conn.execute(query + ' ORDER BY crawl_date DESC LIMIT 1', params).fetchone()
+        if row is None:
+            return None
+        url, status, headers, digest = row
+        return url, status, json.loads(headers), self.get_body(digest)
+
+    def crawl_dates(self):
+        """Return ``[(crawl date, responses)]``, oldest first."""
+        return self.conn.execute(
+            'SELECT crawl_date, COUNT(*) FROM responses GROUP BY crawl_date ORDER BY crawl_date').fetchall()
+
+    def summary(self):
+        """Return counts and sizes: responses, bodies, raw and stored body bytes."""
+        responses = len(self)
+        bodies, raw, stored = self.conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(data)), 0) FROM bodies').fetchone()
+        referenced = self.conn.execute(
+            'SELECT COALESCE(SUM(b.size), 0) FROM responses r JOIN bodies b ON b.hash = r.body').fetchone()[0]
+        return {'responses': responses, 'bodies': bodies, 'response_bytes': referenced, 'body_bytes': raw,
+                'stored_bytes': stored}
+
+    def compress(self, body):
+        """Return ``(codec, dictionary id, data)`` for ``body``."""
+        if zstandard is None:
+            return 'zlib', None, zlib.compress(body, min(self.level, 9))
+        compressor = self._compressors.get(self.dictionary_id)
+        if compressor is None:
+            dictionary = self._dictionary(self.dictionary_id)
+            compressor = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
+            self._compressors[self.dictionary_id] = compressor
+        return 'zstd', self.dictionary_id, compressor.compress(body)
+
+    def decompress(self, codec, dictionary_id, data):
+        if codec == 'zlib':
+            return zlib.decompress(data)
+        if codec != 'zstd':
+            raise ValueError(f"Unknown body codec: {codec!r}")
+        if zstandard is None:
+            raise RuntimeError('Reading zstd bodies requires the zstandard package')
+        decompressor = self._decompressors.get(dictionary_id)
+        if decompressor is None:
+            decompressor = zstandard.ZstdDecompressor(dict_data=self._dictionary(dictionary_id))
+            self._decompressors[dictionary_id] = decompressor
+        return decompressor.decompress(data)
+
+    def train_dictionary(self, samples=1000):
+        """Train a zstd dictionary on a sample of the stored bodies; later bodies use it.
+
+        Returns:
+            int: The new dictionary's id, or None if there is too little to train on.
+        """
+        self.commit()
+        return self.add_dictionary(build_dictionary(self.path, self.dictionary_size, samples))
+
+    def train_dictionary_in_thread(self, samples=1000):
+        """Like ``train_dictionary``, on a Twisted pool thread; returns a Deferred.
+
+        Bodies stored meanwhile are compressed without a dictionary.
+        """
+        from twisted.internet.threads import deferToThread
+
+        def done(result):
+            self.training = False
+            return result
+
+        def failed(failure):
+            logger.error('Training a zstd dictionary failed', exc_info=(failure.type, failure.value, failure.tb))
+
+        self.commit()
+        self.training = True
+        d = deferToThread(build_dictionary, self.path, self.dictionary_size, samples)
+        d.addCallback(self.add_dictionary)
+        d.addErrback(failed)
+        return d.addBoth(done)
+
+    def add_dictionary(self, data):
+        """Store a trained dictionary for the bodies stored from now on; return its id."""
+        if data is None or self.conn is None:
+            return None
+        cursor = self.conn.execute('INSERT INTO dictionaries (data) VALUES (?)', (data,))
+        self.conn.commit()
+        self.dictionary_id = cursor.lastrowid
+        return self.dictionary_id
+
+    def _dictionary(self, dictionary_id):
+        if dictionary_id is None:
+            return None
+        (data,) = self.conn.execute('SELECT data FROM dictionaries WHERE id = ?', (dictionary_id,)).fetchone()
+        return zstandard.ZstdCompressionDict(data)
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self):
+        if self.conn is not None:
+            self.commit()
+            self.conn.close()
+            self.conn = None
+
+
+def build_dictionary(path, size, samples=1000):
+    """Train a zstd dictionary on a sample of the bodies stored at ``path``.
+
+    Reads through a connection of its own, so it can run on another thread
+    than the store writing to ``path``.
+
+    Returns:
+        bytes: The dictionary, or None if there is too little to train on.
+    """
+    store = ResponseStore(path, dictionary_after=0)
+    try:
+        rows = store.conn.execute('SELECT hash FROM bodies ORDER BY RANDOM() LIMIT ?', (samples,)).fetchall()
+        bodies = [store.get_body(digest) for (digest,) in rows]
+    finally:
+        store.close()
+    try:
+        return zstandard.train_dictionary(size, bodies).as_bytes()
+    except zstandard.ZstdError:
+        return None
+
+
+class ResponseStoreStorage:
+    """Scrapy HTTP cache storage backed by a ``ResponseStore``.
+
+    Enable it with ``HTTPCACHE_ENABLED = True`` and ``HTTPCACHE_STORAGE =
+    'zillow.httpcache.ResponseStoreStorage'``. Responses are retrieved like
+    Scrapy's own storages do: the newest one not older than
+    HTTPCACHE_EXPIRATION_SECS (0 never expires). RESPONSE_STORE_REPLAY_DATE
+    pins retrieval to one crawl date instead.
+    """
+
+    def __init__(self, settings):
+        from scrapy.utils.project import data_path
+
+        self.path = settings.get('RESPONSE_STORE_PATH') or data_path(DEFAULT_FILENAME)
+        self.level = settings.getint('RESPONSE_STORE_ZSTD_LEVEL', 9)
+        self.dictionary_after = settings.getint('RESPONSE_STORE_DICTIONARY_AFTER', 1000)
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        replay_date = settings.get('RESPONSE_STORE_REPLAY_DATE')
+        self.replay_date = None if replay_date in (None, '', 'latest') else str(replay_date)
+        self.store = None
+        self.fingerprint = None
+
+    def open_spider(self, spider):
+        # Training takes seconds; downloads go on meanwhile
+        self.store = ResponseStore(self.path, level=self.level, dictionary_after=self.dictionary_after,
+                                   train_in_thread=True)
+        fingerprinter = getattr(spider.crawler, 'request_fingerprinter', None)
+        if fingerprinter is not None:
+            self.fingerprint = lambda request: fingerprinter.fingerprint(request).hex()
+        else:
+            from scrapy.utils.request import request_fingerprint  # Scrapy < 2.7
+            self.fingerprint = request_fingerprint
+
+    def close_spider(self, spider):
+        self.store.close()
+
+    def retrieve_response(self, spider, request):
+        from scrapy.http import Headers
+        from scrapy.responsetypes import responsetypes
+
+        max_age = None if self.replay_date else self.expiration_secs
+        stored = self.store.lookup(self.fingerprint(request), self.replay_date, max_age)
+        if stored is None:
+            return None
+        url, status, headers, body = stored
+        headers = Headers(headers)
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        headers = {
+            name.decode('latin-1'): [value.decode('latin-1') for value in values]
+            for name, values in response.headers.items()
+        }
+        body = decode_body(response.body, headers)
+        self.store.store(self.fingerprint(request), response.url, response.status, headers, body,
+                         callback=getattr(request.callback, '__name__', None))
+
+
+def reparse(store_path, crawl_date=None, output=None, spider_args=None, settings_overrides=None,
+            concurrency=64, log_level='INFO'):
+    """Re-run the spider over a stored crawl, answering every request from the store.
+
+    Requests missing from the store are dropped, so nothing is downloaded.
+    Give the spider the arguments of the original crawl (city names, mode,
+    ...) so it makes the same requests. The listing stores (DEDUP_*,
+    INCREMENTAL_*, PRICE_HISTORY_PATH, ALERTS_STORE_PATH) and the
+    distributed scheduler are replaced by throwaway local ones, so a
+    re-parse neither drops listings as already seen nor touches a running
+    crawl, the price history or the alerts.
+
+    Args:
+        store_path (str): The ResponseStore file.
+        crawl_date (str): ISO date of the crawl; the newest responses by default.
+        output (str): Feed URI for the items, e.g. 'reparsed.jsonl'.
+        spider_args (dict): Spider arguments.
+        settings_overrides (dict): Extra settings.
+        concurrency (int): Requests processed at once.
+    """
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    scratch = tempfile.mkdtemp(prefix='zillow-reparse-')
+    settings = get_project_settings()
+    settings.setdict({
+        'HTTPCACHE_ENABLED': True,
+        'HTTPCACHE_STORAGE': 'zillow.httpcache.ResponseStoreStorage',
+        'HTTPCACHE_POLICY': 'scrapy.extensions.httpcache.DummyPolicy',
+        'HTTPCACHE_IGNORE_MISSING': True,
+        'HTTPCACHE_IGNORE_HTTP_CODES': [],
+        'HTTPCACHE_EXPIRATION_SECS': 0,
+        'RESPONSE_STORE_PATH': store_path,
+        'RESPONSE_STORE_REPLAY_DATE': crawl_date or 'latest',
+        'SCHEDULER': 'scrapy.core.scheduler.Scheduler',
+        'DEDUP_STORE_PATH': os.path.join(scratch, 'seen.sqlite3'),
+        'INCREMENTAL_STORE_PATH': os.path.join(scratch, 'incremental.sqlite3'),
+        'PRICE_HISTORY_PATH': os.path.join(scratch, 'history.sqlite3'),
+        'ALERTS_STORE_PATH': os.path.join(scratch, 'alerts.sqlite3'),
+        'DOWNLOAD_DELAY': 0,
+        'AUTOTHROTTLE_ENABLED': False,
+        'CONCURRENT_REQUESTS': concurrency,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': concurrency,
+        'ADAPTIVE_START_CONCURRENCY': concurrency,
+        'ADAPTIVE_MAX_CONCURRENCY': concurrency,
+        'ADAPTIVE_MIN_DELAY': 0,
+        'ROBOTSTXT_OBEY': False,
+        'TELNETCONSOLE_ENABLED': False,
+        'LOG_LEVEL': log_level,
+    }, priority='cmdline')
+    if output:
+        extension = os.path.splitext(output)[1].lstrip('.')
+        feed_format = FEED_FORMATS.get(extension, extension or 'jsonlines')
+        settings.set('FEEDS', {output: {'format': feed_format}}, priority='cmdline')
+    settings.setdict(settings_overrides or {}, priority='cmdline')
+
+    # The acknowledgement middleware only runs under the distributed scheduler
+    for name in ('SPIDER_MIDDLEWARES', 'DOWNLOADER_MIDDLEWARES'):
+        middlewares = dict(settings.getdict(name))
+        middlewares.pop('zillow.middlewares.FrontierAckMiddleware', None)
+        settings.set(name, middlewares, priority='cmdline')
+
+    process = CrawlerProcess(settings)
+    process.crawl('zillowspider', **(spider_args or {}))
+    process.start()
+
+
+def parse_pairs(values):
+    """Turn ``['key=value', ...]`` into a dict."""
+    return dict(value.split('=', 1) for value in values or [])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect and re-parse stored Zillow crawls.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    info = commands.add_parser('info', help='Show the stored crawl dates and the space they take')
+    info.add_argument('store', help='RESPONSE_STORE_PATH')
+    train = commands.add_parser('train', help='Train a new zstd dictionary on the stored bodies')
+    train.add_argument('store', help='RESPONSE_STORE_PATH')
+    run = commands.add_parser('reparse', help='Re-run the spider over a stored crawl, without network')
+    run.add_argument('store', help='RESPONSE_STORE_PATH')
+    run.add_argument('--date', help='Crawl date (YYYY-MM-DD); the newest responses by default')
+    run.add_argument('-o', '--output', help='Write the items here, e.g. reparsed.jsonl')
+    run.add_argument('-a', dest='spider_args', action='append', metavar='NAME=VALUE',
+                     help='Spider argument of the original crawl, e.g. city_names="brooklyn ny"')
+    run.add_argument('-s', dest='settings', action='append', metavar='NAME=VALUE', help='Override a setting')
+    run.add_argument('--concurrency', type=int, default=64)
+    args = parser.parse_args(argv)
+
+    if args.command == 'reparse':
+        reparse(args.store, args.date, args.output, parse_pairs(args.spider_args), parse_pairs(args.settings),
+                args.concurrency)
+        return
+
+    store = ResponseStore(args.store)
+    try:
+        if args.command == 'train':
+            if zstandard is None:
+                parser.error('training a dictionary requires the zstandard package')
+            print(f"Dictionary {store.train_dictionary()} trained")
+            return
+        for crawl_date, responses in store.crawl_dates():
+            print(f"{crawl_date}\t{responses} responses")
+        summary = store.summary()
+        ratio = summary['response_bytes'] / summary['stored_bytes'] if summary['stored_bytes'] else 0
+        print(f"{summary['responses']} responses, {summary['bodies']} distinct bodies,"
+              f" {summary['response_bytes'] / 1e6:.1f} MB stored in {summary['stored_bytes'] / 1e6:.1f} MB"
+              f" ({ratio:.1f}x)")
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
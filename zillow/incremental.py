@@ -0,0 +1,71 @@
+# Incremental re-crawl support.
+#
+# Daily re-crawls mostly see listings that have not changed since yesterday.
+# IncrementalStore remembers a fingerprint of every search card and search
+# page, plus the HTTP validators (ETag / Last-Modified) of every page, so the
+# spider can skip unchanged pages and listings and the downloader middleware
+# can send conditional requests.
+
+import hashlib
+
+from zillow.dedup import SeenStore
+
+
+def content_fingerprint(chunks):
+    """Return a hex digest over an iterable of byte strings."""
+    digest = hashlib.sha1()
+    for chunk in chunks:
+        digest.update(chunk)
+        # Separator, so moving bytes between chunks changes the digest
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class IncrementalStore(SeenStore):
+    """Listing fingerprints (the ``seen`` table) plus per-page state."""
+
+    crawler_attr = 'incremental_store'
+    path_setting = 'INCREMENTAL_STORE_PATH'
+    default_filename = 'zillow-incremental.sqlite3'
+
+    def __init__(self, path, *args, **kwargs):
+        super().__init__(path, *args, **kwargs)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            ' url TEXT PRIMARY KEY,'
+            ' fingerprint TEXT,'
+            ' etag TEXT,'
+            ' last_modified TEXT'
+            ') WITHOUT ROWID'
+        )
+        self.conn.commit()
+
+    def page(self, url):
+        """Return ``(fingerprint, etag, last_modified)`` for ``url``, or None."""
+        return self.conn.execute(
+            'SELECT fingerprint, etag, last_modified FROM pages WHERE url = ?', (url,)
+        ).fetchone()
+
+    def update_page_fingerprint(self, url, fingerprint):
+        """Store the fingerprint of ``url``.
+
+        Returns:
+            bool: True if the page is new or its fingerprint changed.
+        """
+        known = self.page(url)
+        self.conn.execute(
+            'INSERT INTO pages (url, fingerprint) VALUES (?, ?)'
+            ' ON CONFLICT(url) DO UPDATE SET fingerprint = excluded.fingerprint',
+            (url, fingerprint),
+        )
+        self._count_write()
+        return known is None or known[0] != fingerprint
+
+    def update_page_validators(self, url, etag=None, last_modified=None):
+        """Store the ETag and Last-Modified headers last served for ``url``."""
+        self.conn.execute(
+            'INSERT INTO pages (url, etag, last_modified) VALUES (?, ?, ?)'
+            ' ON CONFLICT(url) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified',
+            (url, etag, last_modified),
+        )
+        self._count_write()
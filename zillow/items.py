@@ -2,6 +2,7 @@ import scrapy
 
 class ZillowItem(scrapy.Item):
     url = scrapy.Field()
+    zpid = scrapy.Field()
     name = scrapy.Field()
     floor_size = scrapy.Field()
     street_address = scrapy.Field()
@@ -19,6 +20,14 @@ class ZillowItem(scrapy.Item):
     price_currency = scrapy.Field()
     availability = scrapy.Field()
     zestimate_value = scrapy.Field()
+    rent_zestimate = scrapy.Field()
+    bedrooms = scrapy.Field()
+    bathrooms = scrapy.Field()
+    tax_assessed_value = scrapy.Field()
+    date_sold = scrapy.Field()
+    lot_area_value = scrapy.Field()
+    lot_area_unit = scrapy.Field()
+    listing_category = scrapy.Field()
 
     # add more fields as needed
 
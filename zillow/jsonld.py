@@ -0,0 +1,131 @@
+# Fast-path JSON-LD extraction for Zillow search pages.
+#
+# Search pages embed one <script type="application/ld+json"> block per listing.
+# Rather than building a full DOM and evaluating a CSS selector to find them,
+# the helpers below scan the raw response bytes for the script boundaries and
+# hand only those slices to the JSON decoder.
+
+import json
+
+from zillow.utils import zpid_from_url
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+LD_JSON_MARKER = b'application/ld+json'
+
+
+JSON_BACKENDS = {
+    'json': json.loads,
+}
+if orjson is not None:
+    JSON_BACKENDS['orjson'] = orjson.loads
+
+
+def get_loads(backend=None):
+    """Return the ``loads`` callable for a JSON backend.
+
+    Args:
+        backend (str): Name of the backend ('orjson' or 'json'). Defaults to
+            the fastest installed backend.
+
+    Returns:
+        callable: A function decoding bytes or str into Python objects. Decode
+        errors are raised as ``json.JSONDecodeError`` (orjson's error type
+        subclasses it).
+    """
+    if not backend:
+        return JSON_BACKENDS.get('orjson', json.loads)
+    try:
+        return JSON_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown or unavailable JSON backend: {backend!r}") from None
+
+
+def iter_ld_json_blocks(body):
+    """Yield the raw content of every ``application/ld+json`` script in ``body``.
+
+    Args:
+        body (bytes): The raw HTML of the page.
+
+    Yields:
+        bytes: The text between the opening and closing script tags.
+    """
+    find = body.find
+    marker_len = len(LD_JSON_MARKER)
+    pos = 0
+    while True:
+        marker = find(LD_JSON_MARKER, pos)
+        if marker < 0:
+            return
+        pos = marker + marker_len
+
+        # The marker must sit inside an opening <script ...> tag
+        tag_start = body.rfind(b'<', 0, marker)
+        if tag_start < 0 or find(b'>', tag_start, marker) >= 0:
+            continue
+        if body[tag_start + 1:tag_start + 7].lower() != b'script':
+            continue
+
+        tag_end = find(b'>', marker)
+        if tag_end < 0:
+            return
+        # Script text ends at the first </script, whatever its case
+        content_end = find(b'</', tag_end)
+        while content_end >= 0 and body[content_end + 2:content_end + 8].lower() != b'script':
+            content_end = find(b'</', content_end + 2)
+        if content_end < 0:
+            return
+
+        content = body[tag_end + 1:content_end]
+        pos = content_end
+        # Empty scripts have no text node, so the selector path never saw them
+        if content:
+            yield content
+
+
+def decode_block(content, encoding='utf-8'):
+    """Prepare a raw script block for the JSON decoder.
+
+    UTF-8 (and ASCII) blocks are passed through untouched so the decoder can
+    work on the bytes directly; other encodings are transcoded to str.
+    """
+    if encoding and encoding.lower().replace('_', '-') not in ('utf-8', 'utf8', 'ascii'):
+        return content.decode(encoding, 'replace')
+    return content
+
+
+def map_listing(json_data):
+    """Map a decoded JSON-LD listing onto ``ZillowItem`` fields in one pass.
+
+    Args:
+        json_data (dict): The decoded JSON-LD object.
+
+    Returns:
+        dict: The item fields, or None if the object has no ``@type``.
+    """
+    real_estate_type = json_data.get('@type', '')
+    if not real_estate_type:
+        return None
+
+    address = json_data.get('address') or {}
+    geo = json_data.get('geo') or {}
+    floor_size = json_data.get('floorSize') or {}
+    url = json_data.get('url', '')
+
+    return {
+        'real_estate_type': real_estate_type,
+        'name': json_data.get('name', ''),
+        'floor_size': floor_size.get('value', ''),
+        'street_address': address.get('streetAddress', ''),
+        'address_locality': address.get('addressLocality', ''),
+        'address_region': address.get('addressRegion', ''),
+        'postal_code': address.get('postalCode', ''),
+        'latitude': geo.get('latitude', ''),
+        'longitude': geo.get('longitude', ''),
+        'url': url,
+        'zpid': zpid_from_url(url),
+    }
@@ -0,0 +1,563 @@
+# Live crawl metrics.
+#
+# Scrapy's stats are dumped once the crawl is over and hold totals only.
+# MetricsExtension times every spider callback, downloader middleware hop
+# and item pipeline stage while the crawl runs. It also counts scraped and
+# dropped items, JSON decode failures and response bytes per page type. The
+# histograms and counters are served in the Prometheus text format on a
+# local port (METRICS_PORT), together with the numeric Scrapy stats.
+#
+# Callbacks and middlewares are wrapped where they are looked up: callbacks
+# on the spider instance, as methods bound to it so requests still serialize,
+# middleware and pipeline methods in their managers' method lists. Generator
+# callbacks are only timed while they run, not while Scrapy waits to pull
+# their next output, and coroutine callbacks only while they run, not while
+# they await a worker process. Hops that return a Deferred are timed until it
+# fires. benchmarks/crawl_benchmark.py times its stages with the same
+# wrappers.
+#
+# With PROFILE_SLOW_PAGES set, a sampling profiler thread samples the reactor
+# thread's stack while a callback runs. The samples of callbacks slower than
+# the threshold are written out as collapsed stacks, one file per page, ready
+# for flamegraph.pl or speedscope. Parsing done in worker processes
+# (PARSE_WORKERS) is not sampled.
+
+import bisect
+import functools
+import inspect
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import types
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Callbacks timed, and the page type of the responses they handle
+CALLBACK_PAGE_TYPES = {
+    'parse': 'search_page',
+    'parse_home_details': 'home_details',
+    'parse_query_state': 'query_state',
+    'parse_page_state': 'search_api',
+}
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def page_type(request):
+    """Return the page type of a request, from the name of its callback."""
+    name = getattr(request.callback, '__name__', None) or 'parse'
+    return CALLBACK_PAGE_TYPES.get(name, name)
+
+
+def instrument_callbacks(spider, names, wrap):
+    """Replace the callbacks ``names`` of ``spider`` with ``wrap(name, callback)``.
+
+    Requests built inside callbacks look the callback up on the instance, so
+    follow-up requests get the wrapped version too. The wrappers are bound to
+    the spider as methods: ``Request.to_dict`` finds callbacks by name, which
+    the distributed frontier and JOBDIR disk queues rely on.
+    """
+    for name in names:
+        callback = getattr(spider, name, None)
+        if callback is not None:
+            setattr(spider, name, bind(wrap(name, callback), spider))
+
+
+def bind(function, spider):
+    def method(self, *args, **kwargs):
+        return function(*args, **kwargs)
+
+    return types.MethodType(functools.wraps(function)(method), spider)
+
+
+def instrument_methods(manager, name, wrap):
+    """Replace the ``name`` methods of a middleware manager with ``wrap(method)``.
+
+    Scrapy 2.13+ passes the spider only to the methods it registered as
+    requiring it, so the wrappers of those are registered too.
+    """
+    methods = manager.methods[name]
+    requiring_spider = getattr(manager, '_mw_methods_requiring_spider', None)
+    wrapped = []
+    for method in methods:
+        if method is not None:
+            wrapper = wrap(method)
+            if requiring_spider is not None and method in requiring_spider:
+                requiring_spider.add(wrapper)
+            method = wrapper
+        wrapped.append(method)
+    manager.methods[name] = type(methods)(wrapped)
+
+
+def timed_callback(name, callback, finished, profiler=None, offloaded=None):
+    """Wrap a spider callback so ``finished(call)`` gets a ``Call`` with the time spent in it.
+
+    Args:
+        name (str): The callback's name.
+        callback: The bound callback.
+        finished: Called with the ``Call`` once the callback, or the generator
+            or coroutine it returned, is done.
+        profiler (SamplingProfiler): Samples the callback's stack while it runs.
+        offloaded: Called with the name and the wall time until a coroutine
+            callback that had to wait finishes, e.g. one waiting for a worker
+            process.
+    """
+
+    def timed(*args, **kwargs):
+        call = Call(name, args[0] if args else None, finished, profiler)
+        started = call.enter()
+        try:
+            result = callback(*args, **kwargs)
+        except BaseException:
+            call.exit(started)
+            call.done()
+            raise
+        call.exit(started)
+        if hasattr(result, '__next__'):
+            return call.iterate(result)
+        if inspect.iscoroutine(result):
+            return call.wait(result, offloaded)
+        call.done()
+        return result
+
+    return functools.wraps(callback)(timed)
+
+
+def timed_call(method, record):
+    """Wrap ``method`` so ``record(wall, cpu)`` gets the seconds spent in each call.
+
+    Calls returning a Deferred are timed until it fires.
+    """
+
+    def timed(*args, **kwargs):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            result = method(*args, **kwargs)
+        except BaseException:
+            record(time.perf_counter() - wall, time.thread_time() - cpu)
+            raise
+        if hasattr(result, 'addBoth'):
+            def fired(value):
+                record(time.perf_counter() - wall, time.thread_time() - cpu)
+                return value
+
+            return result.addBoth(fired)
+        record(time.perf_counter() - wall, time.thread_time() - cpu)
+        return result
+
+    return functools.wraps(method)(timed)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels) + '}'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    """Observations counted into fixed buckets, as Prometheus histograms are."""
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating within its bucket; None without observations."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                low = self.bounds[i - 1] if i else 0.0
+                high = self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+
+class MetricsRegistry:
+    """Counters and histograms by name and labels, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        # name -> (type, help text); name -> {labels: value or Histogram}
+        self.descriptions = {}
+        self.series = {}
+
+    def describe(self, name, kind, text):
+        self.descriptions[name] = (kind, text)
+        self.series.setdefault(name, {})
+
+    def inc(self, name, value=1, **labels):
+        series = self.series[name]
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, **labels):
+        series = self.series[name]
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def get(self, name, **labels):
+        return self.series[name].get(tuple(sorted(labels.items())))
+
+    def render(self, gauges=()):
+        """Render every series, then ``gauges``: ``(name, type, labels, value)`` tuples
+        of values kept elsewhere, such as Scrapy's stats."""
+        lines = []
+        for name, (kind, text) in self.descriptions.items():
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(self.series[name].items()):
+                if kind != 'histogram':
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.bounds, value.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {value.count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {value.count}")
+        described = set()
+        for name, kind, labels, value in gauges:
+            if name not in described:
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """Sample one thread's stack while a profiled call is running on it."""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        # Samples of the call now running on the sampled thread, or None
+        self.current = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='metrics-profiler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            samples = self.current
+            if samples is None:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                samples[collapse(frame)] += 1
+
+
+def collapse(frame):
+    """Return the stack of ``frame`` as one collapsed line, outermost frame first."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def write_collapsed(path, samples):
+    with open(path, 'w') as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+
+
+class MetricsExtension:
+    """Time callbacks, middleware hops and pipelines, and serve the metrics over HTTP.
+
+    METRICS_ENABLED = False turns it off. The endpoint listens on the first
+    free port of METRICS_PORT (a ``[first, last]`` range) on METRICS_HOST;
+    0 does not listen, e.g. to only read ``crawler.metrics``.
+    """
+
+    def __init__(self, crawler, slow_page=0.0, profile_interval=0.005, profile_dir='profiles', max_profiles=100):
+        self.crawler = crawler
+        self.registry = MetricsRegistry()
+        self.slow_page = slow_page
+        self.profile_interval = profile_interval
+        self.profile_dir = profile_dir
+        self.max_profiles = max_profiles
+        self.profiles_written = 0
+        self.profiler = None
+        self.port_range = []
+        self.host = '127.0.0.1'
+        self.listener = None
+
+        describe = self.registry.describe
+        describe('zillow_callback_seconds', 'histogram', 'Time spent in spider callbacks.')
+        describe('zillow_offloaded_callback_seconds', 'histogram',
+                 'Time until callbacks parsing in worker processes return their results.')
+        describe('zillow_callback_errors_total', 'counter', 'Exceptions raised by spider callbacks.')
+        describe('zillow_downloader_middleware_seconds', 'histogram', 'Time spent in downloader middleware methods.')
+        describe('zillow_pipeline_seconds', 'histogram', 'Time spent in item pipeline process_item.')
+        describe('zillow_items_scraped_total', 'counter', 'Items that passed every pipeline.')
+        describe('zillow_items_dropped_total', 'counter', 'Items dropped, by the pipeline that dropped them.')
+        describe('zillow_response_bytes', 'histogram', 'Response body sizes by page type.')
+        describe('zillow_slow_pages_total', 'counter', 'Callbacks slower than PROFILE_SLOW_PAGES.')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        from scrapy import signals
+        from scrapy.exceptions import NotConfigured
+
+        settings = crawler.settings
+        if not settings.getbool('METRICS_ENABLED', True):
+            raise NotConfigured
+        ext = cls(
+            crawler,
+            slow_page=settings.getfloat('PROFILE_SLOW_PAGES', 0) / 1000,
+            profile_interval=settings.getfloat('PROFILE_INTERVAL', 5) / 1000,
+            profile_dir=settings.get('PROFILE_DIR', 'profiles'),
+            max_profiles=settings.getint('PROFILE_MAX_PAGES', 100),
+        )
+        ext.port_range = [int(port) for port in settings.getlist('METRICS_PORT', [9410, 9420])]
+        ext.host = settings.get('METRICS_HOST', '127.0.0.1')
+        crawler.signals.connect(ext.engine_started, signal=signals.engine_started)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(ext.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(ext.response_received, signal=signals.response_received)
+        crawler.signals.connect(ext.spider_error, signal=signals.spider_error)
+        crawler.metrics = ext
+        return ext
+
+    def engine_started(self):
+        if not self.port_range or not self.port_range[0]:
+            return
+        from scrapy.utils.reactor import listen_tcp
+        from twisted.web import server
+
+        self.listener = listen_tcp(self.port_range, self.host, server.Site(metrics_resource(self.render)))
+        address = self.listener.getHost()
+        logger.info(f"Metrics at http://{address.host}:{address.port}/metrics")
+
+    def spider_opened(self, spider):
+        if self.slow_page:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            self.profiler = SamplingProfiler(threading.get_ident(), self.profile_interval)
+            self.profiler.start()
+
+        instrument_callbacks(spider, CALLBACK_PAGE_TYPES, self.time_callback)
+        for hop in ('process_request', 'process_response', 'process_exception'):
+            instrument_methods(self.crawler.engine.downloader.middleware, hop, functools.partial(self.time_hop, hop))
+        instrument_methods(self.crawler.engine.scraper.itemproc, 'process_item', self.time_pipeline)
+
+    def spider_closed(self, spider):
+        if self.profiler is not None:
+            self.profiler.stop()
+        if self.listener is not None:
+            self.listener.stopListening()
+            self.listener = None
+        for line in self.summary():
+            logger.info(line)
+
+    def summary(self):
+        """Yield one line per timed stage: calls, total time and estimated p50 / p95."""
+        for metric in ('zillow_callback_seconds', 'zillow_offloaded_callback_seconds',
+                       'zillow_downloader_middleware_seconds', 'zillow_pipeline_seconds'):
+            for labels, histogram in sorted(self.registry.series[metric].items()):
+                name = '.'.join(str(value) for _, value in labels)
+                yield (f"{metric[len('zillow_'):-len('_seconds')]} {name}: {histogram.count} calls,"
+                       f" {histogram.sum:.2f} s, p50 {histogram.quantile(0.5) * 1000:.1f} ms,"
+                       f" p95 {histogram.quantile(0.95) * 1000:.1f} ms")
+
+    def item_scraped(self, item, response, spider):
+        self.registry.inc('zillow_items_scraped_total')
+
+    def response_received(self, response, request, spider):
+        self.registry.observe('zillow_response_bytes', len(response.body), BYTES_BUCKETS, page_type=page_type(request))
+
+    def spider_error(self, failure, response, spider):
+        callback = getattr(response.request.callback, '__name__', None) if response.request is not None else None
+        self.registry.inc('zillow_callback_errors_total', callback=callback or 'parse')
+
+    def time_callback(self, name, callback):
+        return timed_callback(name, callback, self.callback_done, self.profiler, self.offloaded)
+
+    def callback_done(self, call):
+        self.registry.observe('zillow_callback_seconds', call.wall, callback=call.name)
+        if self.slow_page and call.wall >= self.slow_page:
+            self.slow_call(call, call.wall)
+
+    def offloaded(self, name, seconds):
+        # Parsed in a worker process: wall time until the results are back
+        self.registry.observe('zillow_offloaded_callback_seconds', seconds, callback=name)
+
+    def time_hop(self, hop, method):
+        middleware = type(method.__self__).__name__
+        return self.timed(method, 'zillow_downloader_middleware_seconds', middleware=middleware, hop=hop)
+
+    def time_pipeline(self, method):
+        from scrapy.exceptions import DropItem
+
+        pipeline = type(method.__self__).__name__
+        inc = self.registry.inc
+
+        def dropped(failure):
+            if failure.check(DropItem):
+                inc('zillow_items_dropped_total', pipeline=pipeline)
+            return failure
+
+        timed = self.timed(method, 'zillow_pipeline_seconds', pipeline=pipeline)
+
+        def process_item(*args, **kwargs):
+            try:
+                result = timed(*args, **kwargs)
+            except DropItem:
+                inc('zillow_items_dropped_total', pipeline=pipeline)
+                raise
+            if hasattr(result, 'addErrback'):
+                result.addErrback(dropped)
+            return result
+
+        return functools.wraps(method)(process_item)
+
+    def timed(self, method, metric, **labels):
+        observe = self.registry.observe
+        return timed_call(method, lambda wall, cpu: observe(metric, wall, **labels))
+
+    def slow_call(self, call, elapsed):
+        """Record a callback slower than PROFILE_SLOW_PAGES and write its samples."""
+        self.registry.inc('zillow_slow_pages_total', callback=call.name)
+        if not call.samples or self.profiles_written >= self.max_profiles:
+            return
+        self.profiles_written += 1
+        url = getattr(call.response, 'url', '')
+        slug = re.sub(r'[^A-Za-z0-9]+', '-', url.split('://', 1)[-1])[:80].strip('-')
+        path = os.path.join(self.profile_dir, f"{int(time.time())}-{call.name}-{elapsed * 1000:.0f}ms-{slug}.folded")
+        write_collapsed(path, call.samples)
+        logger.info(f"{call.name} took {elapsed * 1000:.0f} ms on {url}; stacks written to {path}")
+
+    def gauges(self):
+        """The numeric Scrapy stats, and the JSON decode failures the spider counted."""
+        stats = [(key, value) for key, value in (self.crawler.stats.get_stats() or {}).items()
+                 if isinstance(value, (int, float)) and not isinstance(value, bool)]
+        for key, value in stats:
+            if key.startswith('parse/json_errors/'):
+                yield 'zillow_json_decode_errors_total', 'counter', (('page_type', key.rsplit('/', 1)[1]),), value
+        for key, value in stats:
+            yield 'zillow_scrapy_stat', 'gauge', (('key', key),), value
+
+    def render(self):
+        return self.registry.render(self.gauges())
+
+
+class Call:
+    """One timed callback invocation: wall and CPU time spent inside it, and
+    the profiler's samples of its stack."""
+
+    __slots__ = ('name', 'response', 'finished', 'profiler', 'wall', 'cpu', 'samples')
+
+    def __init__(self, name, response, finished, profiler=None):
+        self.name = name
+        self.response = response
+        self.finished = finished
+        self.profiler = profiler
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.samples = Counter() if profiler is not None else None
+
+    def enter(self):
+        if self.profiler is not None:
+            self.profiler.current = self.samples
+        return time.perf_counter(), time.thread_time()
+
+    def exit(self, started):
+        wall, cpu = started
+        self.wall += time.perf_counter() - wall
+        self.cpu += time.thread_time() - cpu
+        if self.profiler is not None:
+            self.profiler.current = None
+
+    def iterate(self, iterator):
+        # Only time spent inside the callback counts, not downstream consumers
+        try:
+            while True:
+                started = self.enter()
+                try:
+                    value = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.exit(started)
+                yield value
+        finally:
+            self.done()
+
+    async def wait(self, coroutine, offloaded=None):
+        return await self.resume(coroutine, offloaded)
+
+    @types.coroutine
+    def resume(self, coroutine, offloaded=None):
+        # Only the coroutine's own steps count, not what it awaits in between
+        wall = time.perf_counter()
+        waited = False
+        send, value = coroutine.send, None
+        try:
+            while True:
+                started = self.enter()
+                try:
+                    awaited = send(value)
+                except StopIteration as stop:
+                    return stop.value
+                finally:
+                    self.exit(started)
+                waited = True
+                try:
+                    send, value = coroutine.send, (yield awaited)
+                except GeneratorExit:
+                    coroutine.close()
+                    raise
+                except BaseException as error:
+                    send, value = coroutine.throw, error
+        finally:
+            if waited and offloaded is not None:
+                offloaded(self.name, time.perf_counter() - wall)
+            self.done()
+
+    def done(self):
+        self.finished(self)
+
+
+def metrics_resource(render):
+    """Return a twisted.web resource serving ``render()`` at any path."""
+    from twisted.web import resource
+
+    class MetricsResource(resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+            return render().encode()
+
+    return MetricsResource()
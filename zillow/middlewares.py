@@ -4,12 +4,21 @@
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
 from scrapy import signals
+from scrapy.downloadermiddlewares.retry import get_retry_request
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Headers, HtmlResponse, Request
 import random
+import time
 from scrapy.downloadermiddlewares.useragent import UserAgentMiddleware
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from zillow.dedup import SeenStore, card_fingerprint
+from zillow.incremental import IncrementalStore
+from zillow.jsonld import LD_JSON_MARKER
+from zillow.utils import zpid_from_url
+
 
 class ZillowSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -58,15 +67,80 @@ class ZillowSpiderMiddleware:
         spider.logger.info('Spider opened: %s' % spider.name)
 
 
+BLOCK_STATUSES = (403, 429)
+CAPTCHA_MARKERS = (b'px-captcha', b'/captcha', b'captcha-container', b'Please verify you\'re a human')
+# Markup of every search results page, even one without results
+SEARCH_PAGE_MARKERS = (b'id="grid-search-results"', b'searchPageState', b'mobileSearchPageStore')
+
+
+def block_reason(request, response, spider):
+    """Return why ``response`` looks like a block, or None if it looks healthy."""
+    if response.status in BLOCK_STATUSES:
+        return str(response.status)
+    if response.status != 200 or not isinstance(response, HtmlResponse):
+        return None
+    body = response.body
+    if any(marker in body for marker in CAPTCHA_MARKERS):
+        return 'captcha'
+    # A search page without listings is only a block if it is not a search
+    # page at all, e.g. a decoy; past the last page, results just run out
+    if request.callback in (None, getattr(spider, 'parse', None)) and request.cb_kwargs.get('city') \
+            and LD_JSON_MARKER not in body and not any(marker in body for marker in SEARCH_PAGE_MARKERS):
+        return 'no_search_markup'
+    return None
+
+
+class AIMDWindow:
+    """Concurrency window and download delay of one downloader slot.
+
+    The window grows additively while responses are healthy and shrinks
+    multiplicatively on block or congestion signals, the same way TCP probes
+    for the highest rate a path sustains.
+    """
+
+    def __init__(self, concurrency, delay, settings):
+        self.concurrency = float(concurrency)
+        self.delay = float(delay)
+        self.min_concurrency = settings.getint('ADAPTIVE_MIN_CONCURRENCY', 1)
+        self.max_concurrency = settings.getint('ADAPTIVE_MAX_CONCURRENCY', 32)
+        self.min_delay = settings.getfloat('ADAPTIVE_MIN_DELAY', 0.25)
+        self.max_delay = settings.getfloat('ADAPTIVE_MAX_DELAY', 60.0)
+        self.increase = settings.getfloat('ADAPTIVE_INCREASE', 1.0)
+        self.decrease = settings.getfloat('ADAPTIVE_DECREASE', 0.5)
+        self.delay_step = settings.getfloat('ADAPTIVE_DELAY_STEP', 0.05)
+
+    def on_success(self):
+        # +increase per window's worth of responses, i.e. roughly per round trip
+        self.concurrency = min(self.max_concurrency, self.concurrency + self.increase / self.concurrency)
+        self.delay = max(self.min_delay, self.delay - self.delay_step)
+
+    def on_congestion(self):
+        self.concurrency = max(self.min_concurrency, self.concurrency * self.decrease)
+
+    def on_block(self, retry_after=None):
+        self.on_congestion()
+        self.delay = min(self.max_delay, max(self.delay * 2, self.min_delay * 4, retry_after or 0))
+
+
 class ZillowDownloaderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
+    # Adaptive (AIMD) throttling: every downloader slot gets a concurrency
+    # window and a delay that are tuned from what the responses look like.
+    # Slow responses shrink the window; 403/429 responses, captcha pages and
+    # search pages without any search page markup count as blocks, which also
+    # back off the delay and retry the request. Replaces AutoThrottle.
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.settings = crawler.settings
+        self.stats = crawler.stats
+        self.windows = {}
+        self.target_latency = self.settings.getfloat('ADAPTIVE_TARGET_LATENCY', 3.0)
+        self.max_block_retries = self.settings.getint('ADAPTIVE_BLOCK_RETRIES', 5)
 
     @classmethod
     def from_crawler(cls, crawler):
         # This method is used by Scrapy to create your spiders.
-        s = cls()
+        s = cls(crawler)
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         return s
 
@@ -89,6 +163,28 @@ class ZillowDownloaderMiddleware:
         # - return a Response object
         # - return a Request object
         # - or raise IgnoreRequest
+        slot_key, window = self.window(request)
+        if window is None:
+            return response
+
+        reason = block_reason(request, response, spider)
+        if reason:
+            retry_after = response.headers.get('Retry-After')
+            window.on_block(float(retry_after) if retry_after and retry_after.isdigit() else None)
+            self.apply(slot_key, window, spider)
+            self.stats.inc_value('adaptive/blocked', spider=spider)
+            self.stats.inc_value(f'adaptive/blocked/{reason}', spider=spider)
+            retry = get_retry_request(
+                request, spider=spider, reason=f'blocked: {reason}', max_retry_times=self.max_block_retries,
+            )
+            return retry or response
+
+        if request.meta.get('download_latency', 0) > self.target_latency:
+            window.on_congestion()
+            self.stats.inc_value('adaptive/slow', spider=spider)
+        else:
+            window.on_success()
+        self.apply(slot_key, window, spider)
         return response
 
     def process_exception(self, request, exception, spider):
@@ -99,7 +195,374 @@ class ZillowDownloaderMiddleware:
         # - return None: continue processing this exception
         # - return a Response object: stops process_exception() chain
         # - return a Request object: stops process_exception() chain
-        pass
+        slot_key, window = self.window(request)
+        if window is not None and not isinstance(exception, IgnoreRequest):
+            # Timeouts and dropped connections mean the host is overloaded;
+            # RetryMiddleware takes care of retrying them
+            window.on_congestion()
+            self.apply(slot_key, window, spider)
+        return None
+
+    def window(self, request):
+        """Return the slot key and AIMD window for ``request``, creating it on first use."""
+        slot_key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(slot_key) if slot_key else None
+        if slot is None:
+            return slot_key, None
+        window = self.windows.get(slot_key)
+        if window is None:
+            start = self.settings.getint('ADAPTIVE_START_CONCURRENCY', 4)
+            window = self.windows[slot_key] = AIMDWindow(min(start, slot.concurrency), slot.delay, self.settings)
+        return slot_key, window
+
+    def apply(self, slot_key, window, spider):
+        slot = self.crawler.engine.downloader.slots.get(slot_key)
+        if slot is not None:
+            slot.concurrency = max(1, int(window.concurrency))
+            slot.delay = window.delay
+        self.stats.set_value(f'adaptive/{slot_key}/concurrency', round(window.concurrency, 2), spider=spider)
+        self.stats.set_value(f'adaptive/{slot_key}/delay', round(window.delay, 3), spider=spider)
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class SeenListingsMiddleware:
+    """Skip detail page requests for listings that are known and unchanged.
+
+    A listing counts as unchanged if the persistent ``SeenStore`` knew it
+    before this crawl started, ``DuplicatesPipeline`` has not recorded a new
+    fingerprint for it since, and the search card the spider holds for the
+    details request (see ``ZillowSpider.enrich``) still has the stored
+    ``card_fingerprint``. The held card has not reached the pipeline yet, so
+    it is compared here: listings whose price or status changed still get
+    their details. For unchanged ones the request is skipped and the held
+    item is released without its details.
+    """
+
+    def __init__(self, store, stats):
+        self.store = store
+        self.stats = stats
+        self.crawl_started = time.time()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(SeenStore.from_crawler(crawler), crawler.stats)
+
+    def process_spider_output(self, response, result, spider):
+        for i in result:
+            if isinstance(i, Request) and self.unchanged(i, spider):
+                self.stats.inc_value('dedup/requests_skipped', spider=spider)
+                item = spider.release_item(i) if hasattr(spider, 'release_item') else None
+                if item is not None:
+                    yield item
+                continue
+            yield i
+
+    def unchanged(self, request, spider):
+        zpid = zpid_from_url(request.url)
+        if not zpid or not self.store.unchanged_since(zpid, self.crawl_started):
+            return False
+        item = spider.peek_item(request) if hasattr(spider, 'peek_item') else None
+        return item is None or self.store.get(zpid)[0] == card_fingerprint(ItemAdapter(item))
+
+
+class ConditionalRequestMiddleware:
+    """Send conditional requests in incremental mode.
+
+    Pages that served an ETag or Last-Modified header last time are requested
+    with If-None-Match / If-Modified-Since. A 304 answer means nothing changed;
+    it reaches the callback with ``meta['not_modified']`` set, so the spider
+    can still follow the page's pagination. Requests whose callback needs the
+    body either way set ``meta['conditional'] = False``.
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.stats = crawler.stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_request(self, request, spider):
+        if not getattr(spider, 'incremental', False) or request.method != 'GET' \
+                or not request.meta.get('conditional', True):
+            return None
+        page = IncrementalStore.from_crawler(self.crawler).page(request.url)
+        if page:
+            _, etag, last_modified = page
+            if etag:
+                request.headers.setdefault('If-None-Match', etag)
+            if last_modified:
+                request.headers.setdefault('If-Modified-Since', last_modified)
+            if etag or last_modified:
+                # Let the 304 through HttpErrorMiddleware to the callback
+                allowed = request.meta.get('handle_httpstatus_list', [])
+                if 304 not in allowed:
+                    request.meta['handle_httpstatus_list'] = [*allowed, 304]
+        return None
+
+    def process_response(self, request, response, spider):
+        if not getattr(spider, 'incremental', False):
+            return response
+        if response.status == 304:
+            self.stats.inc_value('incremental/not_modified', spider=spider)
+            request.meta['not_modified'] = True
+            return response
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if response.status == 200 and (etag or last_modified):
+            IncrementalStore.from_crawler(self.crawler).update_page_validators(
+                response.url,
+                etag.decode('latin-1') if etag else None,
+                last_modified.decode('latin-1') if last_modified else None,
+            )
+        return response
+
+
+class FrontierAckMiddleware:
+    """Acknowledge finished requests of a distributed crawl to the frontier.
+
+    Enable it both as a spider middleware, before every other one, and as a
+    downloader middleware, before every other one. A response's request is
+    acknowledged once its callback's output has been consumed, so the
+    requests it yields are already in the frontier. A failed download is
+    acknowledged once no downloader middleware retried it, just before its
+    errback runs. Requests of a killed worker are never acknowledged, and the
+    frontier hands them to another worker (see ``zillow.distributed``).
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        from zillow.distributed import distributed_enabled
+
+        if not distributed_enabled(crawler.settings):
+            raise NotConfigured('FrontierAckMiddleware requires the distributed scheduler')
+        return cls(crawler)
+
+    def ack(self, request):
+        scheduler = getattr(self.crawler, 'distributed_scheduler', None)
+        if scheduler is not None and request is not None:
+            scheduler.ack(request)
+
+    def process_spider_output(self, response, result, spider):
+        yield from result
+        self.ack(response.request)
+
+    def process_spider_exception(self, response, exception, spider):
+        self.ack(response.request)
+
+    def process_exception(self, request, exception, spider):
+        self.ack(request)
+
+
+# Coherent header sets: the user agent, client hints and accept headers of
+# each profile match what that browser really sends.
+DEFAULT_HEADER_PROFILES = [
+    {
+        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+        'sec-ch-ua': '"Chromium";v="124", "Google Chrome";v="124", "Not-A.Brand";v="99"',
+        'sec-ch-ua-mobile': '?0',
+        'sec-ch-ua-platform': '"macOS"',
+        'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+        'accept-language': 'en-US,en;q=0.9',
+    },
+    {
+        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+        'sec-ch-ua': '"Chromium";v="124", "Google Chrome";v="124", "Not-A.Brand";v="99"',
+        'sec-ch-ua-mobile': '?0',
+        'sec-ch-ua-platform': '"Windows"',
+        'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+        'accept-language': 'en-US,en;q=0.9',
+    },
+    {
+        # Firefox and Safari send no client hints
+        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0',
+        'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
+        'accept-language': 'en-US,en;q=0.5',
+    },
+    {
+        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4.1 Safari/605.1.15',
+        'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'accept-language': 'en-US,en;q=0.9',
+    },
+]
+
+# Client hint headers a profile without them must not inherit from DEFAULT_REQUEST_HEADERS
+CLIENT_HINT_HEADERS = ('sec-ch-ua', 'sec-ch-ua-mobile', 'sec-ch-ua-platform')
+
+
+class HealthScore:
+    """Exponentially weighted success rate and latency of one pool member."""
+
+    __slots__ = ('success', 'latency', 'samples', 'failures', 'evicted_until')
+
+    def __init__(self):
+        self.success = 1.0
+        self.latency = 1.0
+        self.samples = 0
+        self.failures = 0
+        self.evicted_until = 0.0
+
+    def record(self, ok, latency=None, alpha=0.2):
+        self.samples += 1
+        self.success += alpha * ((1.0 if ok else 0.0) - self.success)
+        if latency is not None:
+            self.latency += alpha * (latency - self.latency)
+        self.failures = 0 if ok else self.failures + 1
+
+    @property
+    def weight(self):
+        # Favour reliable members strongly, fast ones mildly
+        return self.success ** 2 / (0.1 + self.latency)
+
+
+class IdentityPool:
+    """Weighted random choice among members, evicting unhealthy ones for a while."""
+
+    def __init__(self, members, max_failures=3, min_success=0.5, min_samples=5, cooldown=300, rng=random):
+        """
+        Args:
+            members (list): Hashable pool members.
+            max_failures (int): Consecutive failures that evict a member.
+            min_success (float): Success rate below which a member is evicted,
+                once it has ``min_samples`` samples.
+            cooldown (float): Seconds an evicted member sits out before it gets
+                another chance with a fresh score.
+            rng: Source of randomness, ``random`` by default.
+        """
+        self.scores = {member: HealthScore() for member in members}
+        self.max_failures = max_failures
+        self.min_success = min_success
+        self.min_samples = min_samples
+        self.cooldown = cooldown
+        self.rng = rng
+
+    def __bool__(self):
+        return bool(self.scores)
+
+    def healthy(self, now=None):
+        now = time.time() if now is None else now
+        return [member for member, score in self.scores.items() if score.evicted_until <= now]
+
+    def choose(self):
+        """Return a member, picked with probability proportional to its health."""
+        members = self.healthy()
+        if not members:
+            # Everyone is evicted: fall back to the member that comes back first
+            return min(self.scores, key=lambda member: self.scores[member].evicted_until)
+        weights = [self.scores[member].weight for member in members]
+        return self.rng.choices(members, weights=weights)[0]
+
+    def record(self, member, ok, latency=None):
+        """Update ``member``'s score; return True if this evicted it."""
+        score = self.scores.get(member)
+        if score is None:
+            return False
+        score.record(ok, latency)
+        if score.failures >= self.max_failures or (
+                score.samples >= self.min_samples and score.success < self.min_success):
+            self.scores[member] = HealthScore()
+            self.scores[member].evicted_until = time.time() + self.cooldown
+            return True
+        return False
+
+
+class IdentityPoolMiddleware(UserAgentMiddleware):
+    """Rotate coherent header profiles and proxies, preferring healthy ones.
+
+    Replaces Scrapy's UserAgentMiddleware. Every request gets a header profile
+    from IDENTITY_HEADER_PROFILES and, if IDENTITY_PROXIES is set, a proxy,
+    each picked by weighted random choice on its observed success rate and
+    latency. Members that keep getting blocked or failing are evicted for
+    IDENTITY_COOLDOWN seconds. Each identity keeps its own cookie jar.
+
+    A profile replaces the DEFAULT_REQUEST_HEADERS and the headers of an
+    earlier identity, e.g. that of a retried request, but never headers the
+    request set itself, such as the JSON Accept header of search API requests.
+    """
+
+    def __init__(self, profiles, proxies, settings, stats):
+        super().__init__(profiles[0].get('user-agent', 'Scrapy') if profiles else 'Scrapy')
+        options = {
+            'max_failures': settings.getint('IDENTITY_EVICT_AFTER_FAILURES', 3),
+            'min_success': settings.getfloat('IDENTITY_MIN_SUCCESS_RATE', 0.5),
+            'cooldown': settings.getfloat('IDENTITY_COOLDOWN', 300),
+        }
+        self.profiles = profiles
+        self.profile_pool = IdentityPool(range(len(profiles)), **options)
+        self.proxy_pool = IdentityPool(proxies, **options)
+        self.default_headers = Headers(settings.getdict('DEFAULT_REQUEST_HEADERS'))
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        proxies = list(settings.getlist('IDENTITY_PROXIES'))
+        proxies_file = settings.get('IDENTITY_PROXIES_FILE')
+        if proxies_file:
+            with open(proxies_file, encoding='utf-8') as f:
+                proxies.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+        profiles = settings.getlist('IDENTITY_HEADER_PROFILES') or DEFAULT_HEADER_PROFILES
+        o = cls(profiles, proxies, settings, crawler.stats)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        return o
+
+    def process_request(self, request, spider):
+        # A proxy set by someone else is left alone
+        if 'proxy' in request.meta and 'identity' not in request.meta:
+            return None
+
+        profile = self.profile_pool.choose()
+        proxy = self.proxy_pool.choose() if self.proxy_pool else None
+        request.meta['identity'] = (profile, proxy)
+        request.meta['cookiejar'] = f'{profile}|{proxy}'
+
+        headers = self.profiles[profile]
+        for name in CLIENT_HINT_HEADERS:
+            if name not in headers and self.replaceable(request, name):
+                request.headers.pop(name, None)
+        applied = {}
+        for name, value in headers.items():
+            if self.replaceable(request, name):
+                request.headers[name] = value
+                applied[name.lower()] = request.headers[name]
+        request.meta['identity_headers'] = applied
+        if proxy:
+            request.meta['proxy'] = proxy
+        return None
+
+    def replaceable(self, request, name):
+        """Whether header ``name`` of ``request`` is unset, or was set by
+        DefaultHeadersMiddleware or an earlier identity."""
+        value = request.headers.get(name)
+        return value is None or value == self.default_headers.get(name) \
+            or value == request.meta.get('identity_headers', {}).get(name.lower())
+
+    def process_response(self, request, response, spider):
+        identity = request.meta.get('identity')
+        if identity:
+            ok = response.status < 500 and block_reason(request, response, spider) is None
+            self.record(identity, ok, request.meta.get('download_latency'), spider)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        identity = request.meta.get('identity')
+        if identity and not isinstance(exception, IgnoreRequest):
+            self.record(identity, False, None, spider)
+        return None
+
+    def record(self, identity, ok, latency, spider):
+        profile, proxy = identity
+        if self.profile_pool.record(profile, ok, latency):
+            self.stats.inc_value('identity/profiles_evicted', spider=spider)
+        if proxy is not None and self.proxy_pool.record(proxy, ok, latency):
+            self.stats.inc_value('identity/proxies_evicted', spider=spider)
+        self.stats.set_value('identity/profiles_healthy', len(self.profile_pool.healthy()), spider=spider)
+        if self.proxy_pool:
+            self.stats.set_value('identity/proxies_healthy', len(self.proxy_pool.healthy()), spider=spider)
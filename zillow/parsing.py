@@ -0,0 +1,228 @@
+# Response parsing, optionally in worker processes.
+#
+# The spider's callbacks used to decode JSON and map fields on the reactor
+# thread, so one crawl process parsed on one core while downloads waited.
+# The functions below do the CPU-bound part of every callback: they take a
+# response body and return plain dicts, lists and strings, and touch no
+# spider state. The callbacks pass their result on to generators that keep
+# the stateful part (scheduling, incremental checks, enrichment) on the
+# reactor thread.
+#
+# ParseExecutor runs the parse functions either inline, as before, or in a
+# process pool (PARSE_WORKERS). The spider's callbacks are coroutines that
+# await the parse, so pool results come back to the reactor thread, and at
+# most PARSE_MAX_IN_FLIGHT bodies are handed to the pool at once. Callbacks
+# waiting for a slot keep their responses in the scraper, which throttles
+# downloads like any slow callback does.
+
+import json
+import logging
+from urllib.parse import urljoin
+
+from zillow import jsonld, search_api
+from zillow.incremental import content_fingerprint
+
+logger = logging.getLogger(__name__)
+
+ZESTIMATE_SELECTOR = 'div[data-testid="home-details-chip-container"] script::text'
+
+
+def search_page(body, encoding='utf-8', json_backend=None, fingerprints=False):
+    """Extract the JSON-LD listings of an HTML search page.
+
+    Args:
+        body (bytes): The page.
+        encoding (str): The response encoding.
+        json_backend (str): See ``jsonld.get_loads``.
+        fingerprints (bool): Also fingerprint the page and every card, for
+            incremental crawls.
+
+    Returns:
+        dict: ``blocks`` (the number of ld+json blocks), ``fingerprint`` (of
+        the page, or None), ``listings`` (``(fields, card fingerprint)``
+        pairs) and ``errors`` (the blocks that failed to decode, as text).
+    """
+    loads = jsonld.get_loads(json_backend)
+    script_data = list(jsonld.iter_ld_json_blocks(body))
+    page = {
+        'blocks': len(script_data),
+        'fingerprint': content_fingerprint(script_data) if fingerprints else None,
+        'listings': [],
+        'errors': [],
+    }
+    for script_content in script_data:
+        try:
+            json_data = loads(jsonld.decode_block(script_content, encoding))
+        except json.JSONDecodeError:
+            page['errors'].append(script_content.decode(encoding, 'replace'))
+            continue
+        fields = jsonld.map_listing(json_data) if isinstance(json_data, dict) else None
+        if fields:
+            fingerprint = content_fingerprint([script_content]) if fingerprints else None
+            page['listings'].append((fields, fingerprint))
+    return page
+
+
+def home_details(body, encoding='utf-8', json_backend=None):
+    """Extract the Zestimate of a home details page.
+
+    Returns:
+        dict: ``zestimate`` (the amount as found, or '') and ``error`` (the
+        script text if it failed to decode, else None).
+    """
+    from parsel import Selector
+
+    details = {'zestimate': '', 'error': None}
+    zestimate_script = Selector(text=body.decode(encoding or 'utf-8', 'replace')).css(ZESTIMATE_SELECTOR).get()
+    if not zestimate_script:
+        return details
+    try:
+        zestimate_data = jsonld.get_loads(json_backend)(zestimate_script)
+    except ValueError:
+        details['error'] = zestimate_script
+        return details
+    if isinstance(zestimate_data, dict):
+        details['zestimate'] = (zestimate_data.get('homeValue') or {}).get('amount', '')
+    return details
+
+
+def query_state(body, json_backend=None):
+    """Return the query state of an HTML search page, or None; see ``search_api.extract_query_state``."""
+    return search_api.extract_query_state(body, jsonld.get_loads(json_backend))
+
+
+def search_results_page(body, url, listing_category='', json_backend=None, fingerprints=False):
+    """Map the listings of one JSON search results page.
+
+    Listings with neither a zpid nor a URL are left out; URLs are made
+    absolute against ``url``.
+
+    Returns:
+        dict: ``listings`` (``(fields, fingerprint)`` pairs), ``total_pages``,
+        ``total_results``, and ``error`` (True if the body is not JSON).
+    """
+    try:
+        data = jsonld.get_loads(json_backend)(body)
+    except ValueError:
+        return {'listings': [], 'total_pages': 0, 'total_results': 0, 'error': True}
+    results, total_pages, total_results = search_api.search_results(data if isinstance(data, dict) else {})
+    listings = []
+    for listing in results:
+        fields = search_api.map_list_result(listing, listing_category)
+        if fields['url']:
+            fields['url'] = urljoin(url, fields['url'])
+        if not fields['zpid'] and not fields['url']:
+            continue
+        fingerprint = content_fingerprint([json.dumps(listing, sort_keys=True).encode()]) if fingerprints else None
+        listings.append((fields, fingerprint))
+    return {'listings': listings, 'total_pages': total_pages, 'total_results': total_results, 'error': False}
+
+
+class ParseExecutor:
+    """Run parse functions inline or in a pool of worker processes."""
+
+    def __init__(self, workers=0, max_in_flight=None, start_method='spawn'):
+        """
+        Args:
+            workers (int): Worker processes; 0 parses inline on the calling thread.
+            max_in_flight (int): Bodies handed to the pool at once; twice the
+                number of workers by default.
+            start_method (str): multiprocessing start method of the workers.
+        """
+        self.workers = max(0, int(workers))
+        self.max_in_flight = max(1, int(max_in_flight or 2 * self.workers or 1))
+        self.start_method = start_method
+        self.pool = None
+        self.semaphore = None
+        self.crawler = None
+        self.submitted = 0
+        self.failed = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        from scrapy import signals
+
+        settings = crawler.settings
+        executor = cls(
+            workers=settings.getint('PARSE_WORKERS', 0),
+            max_in_flight=settings.getint('PARSE_MAX_IN_FLIGHT') or None,
+            start_method=settings.get('PARSE_START_METHOD', 'spawn'),
+        )
+        # The crawler's stats only exist once the crawl starts, after the spider is built
+        executor.crawler = crawler
+        crawler.signals.connect(executor.spider_closed, signal=signals.spider_closed)
+        return executor
+
+    def start(self):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        from twisted.internet import defer
+
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(self.start_method))
+        self.semaphore = defer.DeferredSemaphore(self.max_in_flight)
+        logger.info(f"Parsing in {self.workers} worker processes, at most {self.max_in_flight} responses at once")
+
+    async def run(self, parse, args, handle, fallback=None, **kwargs):
+        """Parse, then hand the result to a generator on the calling thread.
+
+        Returns the list of what ``handle(parse(*args), **kwargs)`` yields,
+        for a spider callback to return. With workers, the parse runs in the
+        pool while the callback awaits it. If the worker fails, the error is
+        logged and ``fallback()``'s output is returned instead, e.g. an item
+        that was waiting for the parse.
+
+        Args:
+            parse: A module-level function, so it can be pickled.
+            args (tuple): Its arguments, bodies included.
+            handle: A generator function taking the parse result and ``kwargs``.
+            fallback: A callable returning what to yield on failure.
+        """
+        if not self.workers:
+            return list(handle(parse(*args), **kwargs))
+
+        from scrapy.utils.defer import maybe_deferred_to_future
+
+        if self.pool is None:
+            self.start()
+        try:
+            parsed = await maybe_deferred_to_future(self.semaphore.run(self.submit, parse, *args))
+        except Exception:
+            self.failed += 1
+            logger.error(f"Parsing with {parse.__name__} failed", exc_info=True)
+            return list(fallback()) if fallback is not None else []
+        return list(handle(parsed, **kwargs))
+
+    def submit(self, parse, *args):
+        """Run ``parse(*args)`` in the pool; return a Deferred firing on the reactor thread."""
+        from twisted.internet import defer, reactor
+
+        d = defer.Deferred()
+        future = self.pool.submit(parse, *args)
+        self.submitted += 1
+        # Done callbacks run on a pool thread (or right away if already done)
+        future.add_done_callback(lambda f: reactor.callFromThread(self.fire, d, f))
+        return d
+
+    @staticmethod
+    def fire(d, future):
+        if future.cancelled():
+            d.cancel()
+            return
+        error = future.exception()
+        if error is not None:
+            d.errback(error)
+        else:
+            d.callback(future.result())
+
+    def spider_closed(self, spider):
+        if self.crawler is not None and self.workers:
+            stats = self.crawler.stats
+            stats.set_value('parse_executor/submitted', self.submitted, spider=spider)
+            stats.set_value('parse_executor/failed', self.failed, spider=spider)
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
@@ -5,58 +5,438 @@
 
 # pipelines.py
 import json
+import os
+import re
+import time
+from datetime import date
 from itemadapter import ItemAdapter
 from scrapy.exporters import JsonItemExporter, CsvItemExporter
-from scrapy.exceptions import DropItem
+from scrapy.exceptions import DropItem, NotConfigured
+from zillow.alerts import DEFAULT_FILENAME as ALERTS_FILENAME, AlertMatcher, AlertStore
+from zillow.dedup import SeenStore, card_fingerprint
+from zillow.distributed import distributed_enabled, partition_path, worker_id
+from zillow.export import BackgroundWriter
+from zillow.history import DEFAULT_FILENAME as HISTORY_FILENAME, PriceHistory
+from zillow.records import ListingRecord, field_types
+from zillow.utils import listing_key
 
-class JsonExportPipeline:
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    from zillow import scoring
+except ImportError:
+    scoring = None
+
+class BackgroundExportPipeline:
+    """Base class for pipelines that serialize and write items off the reactor thread.
+
+    ``process_item`` only copies the item into a bounded queue; ``export`` runs
+    on a dedicated writer thread (see ``zillow.export.BackgroundWriter``). When
+    EXPORT_QUEUE_SIZE items are waiting, ``process_item`` returns a Deferred
+    that fires once the writer catches up, which slows the crawl down instead
+    of buffering without bound. ``close_spider`` drains the queue.
+
+    Subclasses implement ``open_exporter``, ``export`` and ``close_exporter``,
+    and may override ``options`` to read their settings.
+    """
     def __init__(self):
-        self.json_exporter = None
+        self.writer = None
+        self.stats = None
+        self.queue_size = 1000
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipe = cls(**cls.options(crawler.settings))
+        pipe.stats = crawler.stats
+        pipe.queue_size = crawler.settings.getint('EXPORT_QUEUE_SIZE', 1000)
+        return pipe
+
+    @classmethod
+    def options(cls, settings):
+        """Return the keyword arguments for the constructor."""
+        return {}
 
     def open_spider(self, spider):
-        self.json_exporter = JsonItemExporter(open('output.json', 'wb'), indent=2)
-        self.json_exporter.start_exporting()
+        self.open_exporter(spider)
+        self.writer = BackgroundWriter(
+            self.export,
+            name=type(self).__name__,
+            max_queue=self.queue_size,
+            on_idle=self.idle,
+            on_close=self.close_exporter,
+            stats=self.stats,
+        )
+        self.writer.start()
 
     def close_spider(self, spider):
-        self.json_exporter.finish_exporting()
+        return self.writer.close()
 
     def process_item(self, item, spider):
-        adapter = ItemAdapter(item)
+        # Copy the item so later pipelines cannot change it under the writer
+        d = self.writer.submit(ItemAdapter(item).asdict())
+        if d is None:
+            return item
+        return d.addCallback(lambda _: item)
+
+    def open_exporter(self, spider):
+        pass
+
+    def export(self, item):
+        raise NotImplementedError
+
+    def idle(self):
+        pass
+
+    def close_exporter(self):
+        pass
+
+
+class JsonExportPipeline(BackgroundExportPipeline):
+    def __init__(self, path='output.json'):
+        super().__init__()
+        self.path = path
+        self.file = None
+        self.json_exporter = None
+
+    @classmethod
+    def options(cls, settings):
+        return {'path': partition_path(settings.get('JSON_EXPORT_PATH', 'output.json'), settings)}
+
+    def open_exporter(self, spider):
+        self.file = open(self.path, 'wb')
+        self.json_exporter = JsonItemExporter(self.file, indent=2)
+        self.json_exporter.start_exporting()
+
+    def export(self, item):
         # Export to JSON
-        self.json_exporter.export_item(adapter)
-        return item
+        self.json_exporter.export_item(item)
 
-class PrintItemsPipeline:
-    def process_item(self, item, spider):
+    def close_exporter(self):
+        self.json_exporter.finish_exporting()
+        self.file.close()
+
+class PrintItemsPipeline(BackgroundExportPipeline):
+    def export(self, item):
         print(item)
-        return item
 
-class CsvExportPipeline:
-    def __init__(self):
+class CsvExportPipeline(BackgroundExportPipeline):
+    def __init__(self, path='output.csv'):
+        super().__init__()
+        self.path = path
+        self.file = None
         self.csv_exporter = None
 
-    def open_spider(self, spider):
-        self.csv_exporter = CsvItemExporter(open('output.csv', 'wb'))
+    @classmethod
+    def options(cls, settings):
+        return {'path': partition_path(settings.get('CSV_EXPORT_PATH', 'output.csv'), settings)}
+
+    def open_exporter(self, spider):
+        self.file = open(self.path, 'wb')
+        self.csv_exporter = CsvItemExporter(self.file)
         self.csv_exporter.start_exporting()
 
-    def close_spider(self, spider):
+    def export(self, item):
+        # Export to CSV
+        self.csv_exporter.export_item(item)
+
+    def close_exporter(self):
         self.csv_exporter.finish_exporting()
+        self.file.close()
+
+
+class NormalizePipeline:
+    """Convert scraped items into typed ``ListingRecord`` objects.
 
+    Run it first: every later pipeline, exporter and the scorer then get
+    integer cents, float coordinates, dates and ``HomeType`` values instead of
+    the strings found on the page.
+    """
     def process_item(self, item, spider):
-        adapter = ItemAdapter(item)
-        # Export to CSV
-        self.csv_exporter.export_item(adapter)
-        return item
+        return ListingRecord.from_item(ItemAdapter(item))
 
 
 class DuplicatesPipeline:
-    def __init__(self):
-        self.ids_seen = set()
+    """Drop listings that were already scraped, in this crawl or a previous one.
+
+    ``ids_seen`` is a persistent ``SeenStore`` (see DEDUP_STORE_PATH), so a
+    listing seen yesterday is dropped today unless its search card changed.
+    """
+    def __init__(self, ids_seen):
+        self.ids_seen = ids_seen
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(SeenStore.from_crawler(crawler))
 
     def process_item(self, item, spider):
         adapter = ItemAdapter(item)
-        if 'zpid' in adapter and adapter['zpid'] in self.ids_seen:
+        key = listing_key(adapter.get('zpid'), adapter.get('url'))
+        if not self.ids_seen.add(key, card_fingerprint(adapter)):
             raise DropItem(f"Duplicate item found: {item!r}")
+        return item
+
+
+class ParquetExportPipeline(BackgroundExportPipeline):
+    """Write items to Parquet files partitioned by region, locality and crawl date.
+
+    Items are buffered and written as typed Arrow record batches, one row group
+    per partition every PARQUET_BATCH_SIZE items or PARQUET_FLUSH_INTERVAL
+    seconds. Conversion and writing happen on the background writer thread.
+    Files follow the hive layout, so the whole tree loads with
+    ``pandas.read_parquet(PARQUET_EXPORT_PATH)``::
+
+        <path>/address_region=NY/address_locality=Brooklyn/crawl_date=2024-05-01/part-<run>.parquet
+
+    The workers of a distributed crawl write their own part files into the
+    same tree. Requires pyarrow.
+    """
+    partition_fields = ('address_region', 'address_locality')
+
+    def __init__(self, path='output_parquet', batch_size=5000, flush_interval=60, worker=None):
+        super().__init__()
+        self.path = path
+        self.worker = worker
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.schema = self.build_schema()
+        self.buffers = {}
+        self.buffered = 0
+        self.writers = {}
+        self.crawl_date = None
+        self.run_id = None
+        self.last_flush = None
+
+    @classmethod
+    def options(cls, settings):
+        if pa is None:
+            raise NotConfigured('ParquetExportPipeline requires pyarrow')
+        return {
+            'path': settings.get('PARQUET_EXPORT_PATH', 'output_parquet'),
+            'batch_size': settings.getint('PARQUET_BATCH_SIZE', 5000),
+            'flush_interval': settings.getfloat('PARQUET_FLUSH_INTERVAL', 60),
+            'worker': worker_id(settings) if distributed_enabled(settings) else None,
+        }
+
+    @classmethod
+    def build_schema(cls):
+        """Arrow schema for ``ListingRecord``, minus the partition columns."""
+        arrow_types = {int: pa.int64(), float: pa.float64(), date: pa.date32()}
+        return pa.schema([
+            pa.field(name, arrow_types.get(kind, pa.string()))
+            for name, kind in field_types().items()
+            if name not in cls.partition_fields
+        ])
+
+    def open_exporter(self, spider):
+        self.crawl_date = date.today().isoformat()
+        self.run_id = f"{spider.name}-{int(time.time())}"
+        if self.worker:
+            self.run_id += f"-{self.worker}"
+        self.last_flush = time.monotonic()
+
+    def close_exporter(self):
+        self.flush()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+
+    def export(self, item):
+        if 'price_cents' not in item:
+            # NormalizePipeline is not enabled, so convert here
+            item = ListingRecord.from_item(item).asdict()
+        partition = tuple(str(item.get(name) or 'unknown') for name in self.partition_fields)
+
+        columns = self.buffers.get(partition)
+        if columns is None:
+            columns = self.buffers[partition] = {name: [] for name in self.schema.names}
+        for name, values in columns.items():
+            values.append(self.convert(name, item.get(name)))
+        self.buffered += 1
+
+        if self.buffered >= self.batch_size:
+            self.flush()
         else:
-            self.ids_seen.add(adapter['zpid'])
-            return item
+            self.idle()
+
+    def idle(self):
+        if self.buffered and time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def convert(self, name, value):
+        # Records are already typed; only text columns need converting
+        if value is None or isinstance(value, (int, float, date)):
+            return value
+        return str(value)
+
+    def flush(self):
+        """Write every buffered partition as one row group."""
+        for partition, columns in self.buffers.items():
+            batch = pa.record_batch([columns[name] for name in self.schema.names], schema=self.schema)
+            self.writer(partition).write_batch(batch)
+        self.buffers.clear()
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+
+    def writer(self, partition):
+        writer = self.writers.get(partition)
+        if writer is None:
+            directory = os.path.join(
+                self.path,
+                *(f"{name}={self.partition_value(value)}" for name, value in zip(self.partition_fields, partition)),
+                f"crawl_date={self.crawl_date}",
+            )
+            os.makedirs(directory, exist_ok=True)
+            writer = pq.ParquetWriter(os.path.join(directory, f"part-{self.run_id}.parquet"), self.schema, compression='zstd')
+            self.writers[partition] = writer
+        return writer
+
+    @staticmethod
+    def partition_value(value):
+        # Path separators and '=' would break the hive layout
+        return re.sub(r'[\\/:*?"<>|=]+', '_', value).strip() or 'unknown'
+
+
+class DealScorePipeline(BackgroundExportPipeline):
+    """Score the crawled listings as deals and write them out best first.
+
+    A listing's score depends on every other listing in its postal code, so
+    items are collected column-wise on the writer thread and scored in one
+    vectorized pass when the spider closes (see ``zillow.scoring``). The
+    result goes to DEAL_SCORES_PATH (.csv, .json, .jsonl or Parquet). The
+    workers of a distributed crawl each score their own share; score the
+    merged export with ``python -m zillow.scoring`` instead.
+
+    Requires numpy and pandas.
+    """
+    def __init__(self, path='deal_scores.csv', weights=None, min_group_size=5):
+        super().__init__()
+        self.path = path
+        self.weights = weights
+        self.min_group_size = min_group_size
+        self.columns = {}
+        self.count = 0
+
+    @classmethod
+    def options(cls, settings):
+        if scoring is None:
+            raise NotConfigured('DealScorePipeline requires numpy and pandas')
+        return {
+            'path': partition_path(settings.get('DEAL_SCORES_PATH', 'deal_scores.csv'), settings),
+            'weights': settings.getdict('DEAL_SCORE_WEIGHTS') or None,
+            'min_group_size': settings.getint('DEAL_SCORE_MIN_GROUP_SIZE', 5),
+        }
+
+    def export(self, item):
+        # Columns follow the items, whether raw ZillowItems or ListingRecords
+        for name in item.keys() - self.columns.keys():
+            self.columns[name] = [None] * self.count
+        for name, values in self.columns.items():
+            values.append(item.get(name))
+        self.count += 1
+
+    def close_exporter(self):
+        listings = scoring.pd.DataFrame(self.columns)
+        scored = scoring.score_listings(listings, weights=self.weights, min_group_size=self.min_group_size)
+        scoring.write_listings(scored.sort_values('deal_score', ascending=False, na_position='last'), self.path)
+
+
+class PriceHistoryPipeline(BackgroundExportPipeline):
+    """Record every crawled listing in the price history (see ``zillow.history``).
+
+    All items of a crawl are recorded as observed when the crawl started, so
+    one crawl is one point of every listing's history. The store lives at
+    PRICE_HISTORY_PATH and is shared by the workers of a distributed crawl.
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.history = None
+        self.observed_at = None
+        # Counted on the writer thread, published as stats when the spider closes
+        self.changed = 0
+        self.repriced = 0
+
+    @classmethod
+    def options(cls, settings):
+        from scrapy.utils.project import data_path
+
+        return {'path': settings.get('PRICE_HISTORY_PATH') or data_path(HISTORY_FILENAME)}
+
+    def open_exporter(self, spider):
+        self.history = PriceHistory(self.path)
+        self.observed_at = time.time()
+
+    def export(self, item):
+        changed = self.history.record_item(item, self.observed_at)
+        if changed:
+            self.changed += 1
+            if changed.get('price_cents', (None,))[0] is not None:
+                self.repriced += 1
+
+    def idle(self):
+        self.history.commit()
+
+    def close_exporter(self):
+        self.history.close()
+
+    def close_spider(self, spider):
+        d = super().close_spider(spider)
+        d.addCallback(self.publish_stats)
+        return d
+
+    def publish_stats(self, _):
+        if self.stats is not None:
+            self.stats.set_value('price_history/changed', self.changed)
+            self.stats.set_value('price_history/repriced', self.repriced)
+
+
+class AlertPipeline(BackgroundExportPipeline):
+    """Match new and changed listings against the saved searches (see ``zillow.alerts``).
+
+    The saved searches are loaded from ALERTS_STORE_PATH when the spider
+    opens. Matches are written to the store's outbox in batches of
+    ALERTS_BATCH_SIZE, and whenever the writer is idle.
+    """
+    def __init__(self, path, batch_size=500):
+        super().__init__()
+        self.path = path
+        self.batch_size = batch_size
+        self.matcher = None
+
+    @classmethod
+    def options(cls, settings):
+        from scrapy.utils.project import data_path
+
+        return {
+            'path': settings.get('ALERTS_STORE_PATH') or data_path(ALERTS_FILENAME),
+            'batch_size': settings.getint('ALERTS_BATCH_SIZE', 500),
+        }
+
+    def open_exporter(self, spider):
+        store = AlertStore(self.path)
+        self.matcher = AlertMatcher(store, batch_size=self.batch_size)
+        spider.logger.info(f"Matching listings against {len(self.matcher.index)} saved searches")
+
+    def export(self, item):
+        self.matcher.process(item)
+
+    def idle(self):
+        self.matcher.flush()
+
+    def close_exporter(self):
+        self.matcher.flush()
+        self.matcher.store.close()
+
+    def close_spider(self, spider):
+        d = super().close_spider(spider)
+        d.addCallback(self.publish_stats)
+        return d
+
+    def publish_stats(self, _):
+        if self.stats is not None:
+            self.stats.set_value('alerts/matched', self.matcher.matched)
+            self.stats.set_value('alerts/queued', self.matcher.queued)
@@ -0,0 +1,186 @@
+# Typed, compact listing records.
+#
+# The spider fills ZillowItem with whatever the page held: strings such as
+# '$1,250,000' or '1,204 sqft', numbers from JSON, and '' for anything
+# missing. NormalizePipeline converts every item once into a ListingRecord.
+# Money becomes integer cents, coordinates and sizes become numbers, dates
+# become ``datetime.date``, the home type becomes a HomeType, and missing
+# values become None. ListingRecord is a slotted dataclass, so a record has
+# no per-instance dict and takes a fraction of an item's memory. Scrapy's
+# exporters and ItemAdapter handle dataclasses natively, and the pipelines
+# and the scorer after the normalization stage read typed values without
+# parsing strings again.
+
+import dataclasses
+import datetime
+import enum
+import typing
+
+from zillow.utils import NUMBER_RE, parse_number
+
+
+class HomeType(str, enum.Enum):
+    SINGLE_FAMILY = 'SINGLE_FAMILY'
+    CONDO = 'CONDO'
+    TOWNHOUSE = 'TOWNHOUSE'
+    MULTI_FAMILY = 'MULTI_FAMILY'
+    APARTMENT = 'APARTMENT'
+    MANUFACTURED = 'MANUFACTURED'
+    LOT = 'LOT'
+    OTHER = 'OTHER'
+
+    def __str__(self):
+        return self.value
+
+    @classmethod
+    def parse(cls, value):
+        """Map a search API homeType or a JSON-LD @type onto a HomeType; None if empty."""
+        if isinstance(value, cls) or value is None:
+            return value
+        key = str(value).strip()
+        if not key:
+            return None
+        try:
+            return cls(key.upper())
+        except ValueError:
+            return HOME_TYPE_ALIASES.get(key.lower().replace('_', '').replace(' ', ''), cls.OTHER)
+
+
+# JSON-LD @type values and other spellings, lower-cased without separators
+HOME_TYPE_ALIASES = {
+    'singlefamilyresidence': HomeType.SINGLE_FAMILY,
+    'singlefamily': HomeType.SINGLE_FAMILY,
+    'house': HomeType.SINGLE_FAMILY,
+    'condominium': HomeType.CONDO,
+    'condo': HomeType.CONDO,
+    'townhouse': HomeType.TOWNHOUSE,
+    'townhome': HomeType.TOWNHOUSE,
+    'multifamily': HomeType.MULTI_FAMILY,
+    'apartment': HomeType.APARTMENT,
+    'apartmentcomplex': HomeType.APARTMENT,
+    'manufactured': HomeType.MANUFACTURED,
+    'mobilehome': HomeType.MANUFACTURED,
+    'lot': HomeType.LOT,
+    'land': HomeType.LOT,
+}
+
+# ZillowItem money fields -> ListingRecord fields holding integer cents
+CENTS_FIELDS = {
+    'price': 'price_cents',
+    'zestimate_value': 'zestimate_cents',
+    'rent_zestimate': 'rent_zestimate_cents',
+    'tax_assessed_value': 'tax_assessed_cents',
+}
+
+
+def to_cents(value):
+    """Convert a scraped amount such as ``'$1,250,000'`` to integer cents, or None."""
+    number = parse_number(value)
+    return round(number * 100) if number is not None else None
+
+
+def to_int(value):
+    number = parse_number(value)
+    return round(number) if number is not None else None
+
+
+def to_date(value):
+    """Convert epoch milliseconds (as in the search API) or an ISO date string to a date."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    if isinstance(value, (int, float)) or NUMBER_RE.fullmatch(str(value)):
+        return datetime.datetime.fromtimestamp(float(value) / 1000, tz=datetime.timezone.utc).date()
+    try:
+        return datetime.date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+
+def to_text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+@dataclasses.dataclass(slots=True)
+class ListingRecord:
+    zpid: typing.Optional[int] = None
+    url: typing.Optional[str] = None
+    name: typing.Optional[str] = None
+    real_estate_type: typing.Optional[HomeType] = None
+    street_address: typing.Optional[str] = None
+    address_locality: typing.Optional[str] = None
+    address_region: typing.Optional[str] = None
+    postal_code: typing.Optional[str] = None
+    latitude: typing.Optional[float] = None
+    longitude: typing.Optional[float] = None
+    floor_size: typing.Optional[int] = None
+    bedrooms: typing.Optional[int] = None
+    bathrooms: typing.Optional[float] = None
+    lot_area_value: typing.Optional[float] = None
+    lot_area_unit: typing.Optional[str] = None
+    price_cents: typing.Optional[int] = None
+    price_currency: typing.Optional[str] = None
+    zestimate_cents: typing.Optional[int] = None
+    rent_zestimate_cents: typing.Optional[int] = None
+    tax_assessed_cents: typing.Optional[int] = None
+    date_sold: typing.Optional[datetime.date] = None
+    availability: typing.Optional[str] = None
+    listing_category: typing.Optional[str] = None
+    image_url: typing.Optional[str] = None
+    open_house_start_date: typing.Optional[str] = None
+    open_house_end_date: typing.Optional[str] = None
+    open_house_description: typing.Optional[str] = None
+
+    @classmethod
+    def from_item(cls, item):
+        """Convert a scraped item (``ZillowItem`` or dict) into a record."""
+        if isinstance(item, cls):
+            return item
+        get = item.get
+        return cls(
+            zpid=to_int(get('zpid')),
+            url=to_text(get('url')),
+            name=to_text(get('name')),
+            real_estate_type=HomeType.parse(get('real_estate_type')),
+            street_address=to_text(get('street_address')),
+            address_locality=to_text(get('address_locality')),
+            address_region=to_text(get('address_region')),
+            postal_code=to_text(get('postal_code')),
+            latitude=parse_number(get('latitude')),
+            longitude=parse_number(get('longitude')),
+            floor_size=to_int(get('floor_size')),
+            bedrooms=to_int(get('bedrooms')),
+            bathrooms=parse_number(get('bathrooms')),
+            lot_area_value=parse_number(get('lot_area_value')),
+            lot_area_unit=to_text(get('lot_area_unit')),
+            price_cents=to_cents(get('price')),
+            price_currency=to_text(get('price_currency')),
+            zestimate_cents=to_cents(get('zestimate_value')),
+            rent_zestimate_cents=to_cents(get('rent_zestimate')),
+            tax_assessed_cents=to_cents(get('tax_assessed_value')),
+            date_sold=to_date(get('date_sold')),
+            availability=to_text(get('availability')),
+            listing_category=to_text(get('listing_category')),
+            image_url=to_text(get('image_url')),
+            open_house_start_date=to_text(get('open_house_start_date')),
+            open_house_end_date=to_text(get('open_house_end_date')),
+            open_house_description=to_text(get('open_house_description')),
+        )
+
+    def asdict(self):
+        return {field.name: getattr(self, field.name) for field in dataclasses.fields(self)}
+
+
+def field_types():
+    """Return ``{field name: type}`` of ListingRecord, with Optional unwrapped."""
+    types = {}
+    for name, hint in typing.get_type_hints(ListingRecord).items():
+        args = [arg for arg in typing.get_args(hint) if arg is not type(None)]
+        types[name] = args[0] if args else hint
+    return types
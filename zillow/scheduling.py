@@ -0,0 +1,122 @@
+# Multi-city crawl planning for ZillowSpider.
+#
+# CrawlScheduler hands out Scrapy request priorities and enforces page and
+# request budgets. Priorities fall by PAGE_STEP with every page depth, so the
+# first page of every city is fetched before any city's second page, and so
+# on. No single city can starve the others. Within a depth, cities are
+# ordered by their configured weight and then by the share of new listings
+# on their latest page, so the cities with the most new listings go first.
+
+
+class CityState:
+    """Budget and yield bookkeeping for one city."""
+
+    __slots__ = ('slug', 'weight', 'pages', 'requests', 'listings', 'new_listings', 'new_ratio', 'exhausted')
+
+    def __init__(self, slug, weight=0):
+        self.slug = slug
+        self.weight = weight
+        self.pages = 0
+        self.requests = 0
+        self.listings = 0
+        self.new_listings = 0
+        # Unknown cities are assumed to be all new until their first page says otherwise
+        self.new_ratio = 1.0
+        self.exhausted = False
+
+
+class CrawlScheduler:
+    """Plans search page and detail requests across many cities."""
+
+    PAGE_STEP = 1000
+    MAX_WEIGHT = 9
+
+    def __init__(self, cities, max_pages=10, max_requests=None, city_max_requests=None):
+        """
+        Args:
+            cities (list): ``(slug, weight)`` pairs; weights run from -9 to 9.
+            max_pages (int): Search pages crawled per city.
+            max_requests (int): Requests (search and detail pages) for the whole crawl.
+            city_max_requests (int): Requests per city.
+        """
+        self.max_pages = max_pages
+        self.max_requests = max_requests
+        self.city_max_requests = city_max_requests
+        self.requests = 0
+        self.cities = {}
+        for slug, weight in cities:
+            weight = max(-self.MAX_WEIGHT, min(self.MAX_WEIGHT, int(weight)))
+            self.cities[slug] = CityState(slug, weight)
+
+    @staticmethod
+    def parse_cities(city_names=None, cities_file=None):
+        """Read ``(name, weight)`` pairs from a pipe-separated string and/or a file.
+
+        Entries look like ``brooklyn ny`` or ``brooklyn ny=5``. The file holds
+        one entry per line; blank lines and lines starting with '#' are ignored.
+        """
+        entries = []
+        if city_names:
+            entries.extend(city_names.split('|'))
+        if cities_file:
+            with open(cities_file, encoding='utf-8') as f:
+                entries.extend(line for line in f if not line.lstrip().startswith('#'))
+
+        cities = []
+        for entry in entries:
+            name, _, weight = entry.partition('=')
+            if name.strip():
+                cities.append((name.strip(), int(weight) if weight.strip() else 0))
+        return cities
+
+    def priority(self, slug, page):
+        """Scrapy priority for a request belonging to page ``page`` of ``slug``."""
+        state = self.cities[slug]
+        return state.weight * 100 + int(state.new_ratio * 99) - page * self.PAGE_STEP
+
+    def reserve(self, slug, page=None):
+        """Take one request from the budgets of ``slug`` and of the crawl.
+
+        Args:
+            slug (str): The city.
+            page (int): The search page number, or None for a detail request.
+
+        Returns:
+            bool: False if a budget is used up and the request must not be made.
+        """
+        state = self.cities.get(slug)
+        if state is None or state.exhausted:
+            return False
+        if self.max_requests is not None and self.requests >= self.max_requests:
+            return False
+        if self.city_max_requests is not None and state.requests >= self.city_max_requests:
+            state.exhausted = True
+            return False
+        if page is not None:
+            if page > self.max_pages:
+                return False
+            state.pages += 1
+        state.requests += 1
+        self.requests += 1
+        return True
+
+    def record_page(self, slug, listings, new_listings, exhausts_city=True):
+        """Update the yield of ``slug`` after parsing one of its search pages.
+
+        Args:
+            slug (str): The city.
+            listings (int): Listings on the page.
+            new_listings (int): Those not seen before.
+            exhausts_city (bool): Whether an empty page means the city has no
+                more pages, as with HTML search pages. Search API tiles run
+                out one by one, so an empty tile leaves the city's other
+                tiles alone.
+        """
+        state = self.cities.get(slug)
+        if state is None:
+            return
+        state.listings += listings
+        state.new_listings += new_listings
+        state.new_ratio = new_listings / listings if listings else 0.0
+        if not listings and exhausts_city:
+            state.exhausted = True
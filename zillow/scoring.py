@@ -0,0 +1,201 @@
+# Deal scoring over crawled listings.
+#
+# A listing is a good deal when it is cheap compared with similar listings
+# nearby. For every listing the scorer computes these metrics:
+#
+# - price per square foot,
+# - price / Zestimate,
+# - price / tax-assessed value,
+# - price per square foot / the average of the listings around it, taken
+#   from a grid over the coordinates (see zillow.spatial); only computed
+#   when it is given a weight.
+#
+# Each metric becomes a z-score within the listing's postal code. Postal
+# codes with fewer than ``min_group_size`` priced listings fall back to the
+# locality (city). The deal score is the weighted mean of the negated
+# z-scores, so a higher score means cheaper than the neighbourhood. Missing
+# metrics drop out of the mean rather than counting as average.
+#
+# Everything is column-wise NumPy/pandas; there are no per-row Python loops,
+# so millions of rows score in seconds. Use it from Python (score_listings),
+# from the DealScorePipeline, or from the command line:
+#
+#     python -m zillow.scoring output.csv -o scored.csv --top 20
+
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+from zillow.records import CENTS_FIELDS
+from zillow.spatial import neighbourhood_mean
+from zillow.utils import NUMBER_RE
+
+# Metric -> weight in the deal score
+DEFAULT_WEIGHTS = {
+    'price_per_sqft': 0.5,
+    'zestimate_ratio': 0.35,
+    'tax_ratio': 0.15,
+}
+METRICS = tuple(DEFAULT_WEIGHTS) + ('nearby_ratio',)
+
+NUMERIC_FIELDS = ('price', 'floor_size', 'zestimate_value', 'tax_assessed_value')
+GROUP_FIELDS = ('postal_code', 'address_locality')
+SCORE_COLUMNS = (
+    'price_per_sqft', 'zestimate_ratio', 'tax_ratio', 'nearby_ratio',
+    'price_per_sqft_z', 'zestimate_ratio_z', 'tax_ratio_z', 'nearby_ratio_z',
+    'price_per_sqft_pct', 'deal_score', 'deal_percentile',
+)
+
+
+def to_numeric(series):
+    """Vectorized ``zillow.utils.parse_number``: '$1,250,000' -> 1250000.0, junk -> NaN."""
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype('float64')
+    text = series.astype('string').str.replace(',', '', regex=False)
+    # The extracted strings are valid numbers or NA, so a plain cast finishes the job
+    return text.str.extract(f'({NUMBER_RE.pattern})', expand=False).astype('float64')
+
+
+def _ratio(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = numerator / denominator
+    return ratio.where(denominator > 0)
+
+
+def _group_stats(frame, columns, by):
+    """Per-row z-scores and group sizes of ``columns`` within groups of ``by``."""
+    grouped = frame.groupby(list(by), sort=False, dropna=False)[list(columns)]
+    mean = grouped.transform('mean')
+    std = grouped.transform('std')
+    count = grouped.transform('count')
+    z = (frame[list(columns)] - mean) / std.where(std > 0)
+    return z, count
+
+
+def score_listings(listings, weights=None, min_group_size=5, nearby_miles=0.5):
+    """Score listings as deals against their neighbourhood.
+
+    Args:
+        listings (pandas.DataFrame): Exported listings. Needs ``price``,
+            ``floor_size``, ``postal_code`` and ``address_locality``;
+            ``zestimate_value`` and ``tax_assessed_value`` are used when
+            present. Numbers may still be scraped strings; the ``*_cents``
+            columns of normalized records are used for missing money fields.
+        weights (dict): Metric name -> weight, see ``DEFAULT_WEIGHTS``.
+        min_group_size (int): Listings a postal code needs before it is used
+            as the comparison group instead of the locality.
+        nearby_miles (float): Grid cell size for the ``nearby_ratio`` metric;
+            listings are compared with those in the surrounding 3 x 3 cells.
+
+    Returns:
+        pandas.DataFrame: A copy of ``listings`` with the ``SCORE_COLUMNS``
+        added. ``deal_score`` is NaN for listings without any metric.
+    """
+    weights = DEFAULT_WEIGHTS if weights is None else weights
+    unknown = set(weights) - set(METRICS)
+    if unknown:
+        raise ValueError(f"Unknown score metrics: {', '.join(sorted(unknown))}")
+
+    frame = listings.copy()
+    # Normalized records carry money as integer cents
+    for field, cents_field in CENTS_FIELDS.items():
+        if field not in frame and cents_field in frame:
+            frame[field] = to_numeric(frame[cents_field]) / 100
+    for field in NUMERIC_FIELDS + GROUP_FIELDS:
+        if field not in frame:
+            frame[field] = np.nan
+    numbers = {field: to_numeric(frame[field]) for field in NUMERIC_FIELDS}
+    for field in GROUP_FIELDS:
+        frame[field] = frame[field].astype('string').fillna('')
+
+    metrics = list(DEFAULT_WEIGHTS)
+    frame['price_per_sqft'] = _ratio(numbers['price'], numbers['floor_size'])
+    frame['zestimate_ratio'] = _ratio(numbers['price'], numbers['zestimate_value'])
+    frame['tax_ratio'] = _ratio(numbers['price'], numbers['tax_assessed_value'])
+    if weights.get('nearby_ratio'):
+        metrics.append('nearby_ratio')
+        nearby = neighbourhood_mean(
+            to_numeric(frame['latitude']) if 'latitude' in frame else np.full(len(frame), np.nan),
+            to_numeric(frame['longitude']) if 'longitude' in frame else np.full(len(frame), np.nan),
+            frame['price_per_sqft'], nearby_miles,
+        )
+        frame['nearby_ratio'] = _ratio(frame['price_per_sqft'], pd.Series(nearby, index=frame.index))
+
+    # Compare within the postal code when it has enough listings, else the locality
+    postal_z, postal_count = _group_stats(frame, metrics, GROUP_FIELDS)
+    locality_z, _ = _group_stats(frame, metrics, GROUP_FIELDS[1:])
+    use_postal = (postal_count.to_numpy() >= min_group_size) & (frame['postal_code'] != '').to_numpy(dtype=bool)[:, None]
+    z = postal_z.where(use_postal, locality_z)
+    for metric in metrics:
+        frame[f'{metric}_z'] = z[metric]
+    for metric in set(METRICS) - set(metrics):
+        frame[metric] = frame[f'{metric}_z'] = np.nan
+
+    frame['price_per_sqft_pct'] = frame.groupby(list(GROUP_FIELDS[1:]), sort=False, dropna=False)['price_per_sqft'] \
+        .rank(pct=True)
+
+    # Weighted mean over the metrics each listing has
+    z_values = z[metrics].to_numpy(dtype='float64')
+    weight_row = np.array([weights.get(metric, 0.0) for metric in metrics], dtype='float64')
+    present = ~np.isnan(z_values)
+    total_weight = (present * weight_row).sum(axis=1)
+    weighted = (np.nan_to_num(-z_values) * weight_row).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frame['deal_score'] = np.where(total_weight > 0, weighted / total_weight, np.nan)
+    frame['deal_percentile'] = frame['deal_score'].rank(pct=True)
+    return frame
+
+
+def read_listings(path):
+    """Load exported listings from CSV, JSON, JSON lines or Parquet."""
+    if path.endswith('.csv'):
+        return pd.read_csv(path, dtype=str)
+    if path.endswith(('.jl', '.jsonl')):
+        return pd.read_json(path, lines=True, dtype=False)
+    if path.endswith('.json'):
+        return pd.read_json(path, dtype=False)
+    return pd.read_parquet(path)
+
+
+def write_listings(frame, path):
+    if path.endswith('.csv'):
+        frame.to_csv(path, index=False)
+    elif path.endswith(('.jl', '.jsonl')):
+        frame.to_json(path, orient='records', lines=True)
+    elif path.endswith('.json'):
+        frame.to_json(path, orient='records', indent=2)
+    else:
+        frame.to_parquet(path, index=False)
+
+
+def parse_weights(text):
+    """Parse ``'price_per_sqft=0.6,tax_ratio=0.4'`` into a weights dict."""
+    weights = {}
+    for entry in filter(None, (part.strip() for part in text.split(','))):
+        name, _, value = entry.partition('=')
+        weights[name.strip()] = float(value)
+    return weights
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Score exported Zillow listings as deals.')
+    parser.add_argument('input', help='Listings exported as .csv, .json, .jsonl or Parquet')
+    parser.add_argument('-o', '--output', help='Write every scored listing here (same formats)')
+    parser.add_argument('--top', type=int, default=20, help='Print this many best deals')
+    parser.add_argument('--weights', type=parse_weights, help="e.g. 'price_per_sqft=0.6,zestimate_ratio=0.4'")
+    parser.add_argument('--min-group-size', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    scored = score_listings(read_listings(args.input), weights=args.weights, min_group_size=args.min_group_size)
+    scored = scored.sort_values('deal_score', ascending=False, na_position='last')
+    if args.output:
+        write_listings(scored, args.output)
+    columns = [c for c in ('url', 'street_address', 'postal_code', 'price', 'price_per_sqft', 'deal_score') if c in scored]
+    scored.head(args.top)[columns].to_string(sys.stdout, index=False)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# Helpers for crawling Zillow's JSON search endpoint.
+#
+# A search page's state (map bounds, region, filters) is a JSON
+# ``searchQueryState``. Sending it to GetSearchPageState.htm returns about 40
+# listings per page as JSON, with no HTML to parse. Each query is capped by
+# the site, so large areas are split into map-bounds tiles that are queried
+# separately (see zillow.geo).
+
+import json
+import re
+from urllib.parse import urlencode
+
+SEARCH_API_URL = 'https://www.zillow.com/search/GetSearchPageState.htm'
+SEARCH_API_WANTS = {'cat1': ['listResults', 'mapResults'], 'cat2': ['total']}
+
+# Filter states for the spider's listing categories
+CATEGORY_FILTERS = {
+    'buy': {},
+    'rent': {
+        'isForRent': {'value': True},
+        'isForSaleByAgent': {'value': False},
+        'isForSaleByOwner': {'value': False},
+        'isNewConstruction': {'value': False},
+        'isComingSoon': {'value': False},
+        'isAuction': {'value': False},
+        'isForSaleForeclosure': {'value': False},
+    },
+    'sold': {
+        'isRecentlySold': {'value': True},
+        'isForSaleByAgent': {'value': False},
+        'isForSaleByOwner': {'value': False},
+        'isNewConstruction': {'value': False},
+        'isComingSoon': {'value': False},
+        'isAuction': {'value': False},
+        'isForSaleForeclosure': {'value': False},
+    },
+}
+CATEGORY_FILTERS['rentals'] = CATEGORY_FILTERS['rent']
+
+NEXT_DATA_RE = re.compile(rb'<script[^>]*id="__NEXT_DATA__"[^>]*>(.*?)</script>', re.DOTALL)
+MOBILE_STORE_RE = re.compile(rb'data-zrr-shared-data-key="mobileSearchPageStore"[^>]*><!--(.*?)--></script>', re.DOTALL)
+
+
+def extract_query_state(body, loads=json.loads):
+    """Find the ``queryState`` of an HTML search page.
+
+    Current pages keep it in the ``__NEXT_DATA__`` payload; older ones in the
+    commented-out ``mobileSearchPageStore`` script.
+
+    Args:
+        body (bytes): The search page HTML.
+        loads (callable): JSON decoder.
+
+    Returns:
+        dict: The query state, or None if the page has none.
+    """
+    match = NEXT_DATA_RE.search(body)
+    if match:
+        try:
+            data = loads(match.group(1))
+        except ValueError:
+            data = None
+        query_state = (((data or {}).get('props') or {}).get('pageProps') or {}).get('searchPageState', {}).get('queryState')
+        if query_state:
+            return query_state
+
+    match = MOBILE_STORE_RE.search(body)
+    if match:
+        try:
+            return loads(match.group(1)).get('queryState') or None
+        except ValueError:
+            return None
+    return None
+
+
+def make_query_state(query_state, listing_category='buy', page=1, map_bounds=None):
+    """Return a copy of ``query_state`` for one results page of one map tile."""
+    state = dict(query_state)
+    state['pagination'] = {'currentPage': page} if page > 1 else {}
+    state['isMapVisible'] = True
+    if map_bounds is not None:
+        state['mapBounds'] = dict(map_bounds)
+    filters = CATEGORY_FILTERS.get(listing_category)
+    if filters is not None:
+        state['filterState'] = {**state.get('filterState', {}), **filters}
+    return state
+
+
+def build_search_url(query_state, request_id=1):
+    """Return the GetSearchPageState.htm URL for ``query_state``."""
+    return SEARCH_API_URL + '?' + urlencode({
+        'searchQueryState': json.dumps(query_state, separators=(',', ':')),
+        'wants': json.dumps(SEARCH_API_WANTS, separators=(',', ':')),
+        'requestId': request_id,
+    })
+
+
+def search_results(data):
+    """Return ``(listResults, totalPages, totalResultCount)`` of an API response."""
+    cat1 = data.get('cat1') or {}
+    results = (cat1.get('searchResults') or {}).get('listResults') or []
+    search_list = cat1.get('searchList') or {}
+    return results, search_list.get('totalPages') or 0, search_list.get('totalResultCount') or 0
+
+
+def map_list_result(listing, listing_category=''):
+    """Map one ``listResults`` entry onto ``ZillowItem`` fields.
+
+    Every lookup is a ``.get`` chain: listings regularly lack parts of
+    ``hdpData``, and one incomplete listing must not abort the page.
+    """
+    home_info = (listing.get('hdpData') or {}).get('homeInfo') or {}
+    lat_long = listing.get('latLong') or {}
+    zpid = home_info.get('zpid') or listing.get('zpid') or ''
+    return {
+        'zpid': str(zpid),
+        'url': listing.get('detailUrl', ''),
+        'name': listing.get('address', ''),
+        'street_address': home_info.get('streetAddress') or listing.get('addressStreet', ''),
+        'address_locality': home_info.get('city') or listing.get('addressCity', ''),
+        'address_region': home_info.get('state') or listing.get('addressState', ''),
+        'postal_code': home_info.get('zipcode') or listing.get('addressZipcode', ''),
+        'latitude': home_info.get('latitude', lat_long.get('latitude', '')),
+        'longitude': home_info.get('longitude', lat_long.get('longitude', '')),
+        'real_estate_type': home_info.get('homeType', ''),
+        'floor_size': home_info.get('livingArea', listing.get('area', '')),
+        'image_url': listing.get('imgSrc', ''),
+        'price': home_info.get('price', listing.get('unformattedPrice', '')),
+        'price_currency': home_info.get('currency', 'USD'),
+        'availability': home_info.get('homeStatus', listing.get('statusType', '')),
+        'zestimate_value': home_info.get('zestimate', listing.get('zestimate', '')),
+        'rent_zestimate': home_info.get('rentZestimate', ''),
+        'bedrooms': home_info.get('bedrooms', listing.get('beds', '')),
+        'bathrooms': home_info.get('bathrooms', listing.get('baths', '')),
+        'tax_assessed_value': home_info.get('taxAssessedValue', ''),
+        'date_sold': home_info.get('dateSold', ''),
+        'lot_area_value': home_info.get('lotAreaValue', ''),
+        'lot_area_unit': home_info.get('lotAreaUnit', ''),
+        'listing_category': listing_category,
+    }
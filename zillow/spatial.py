@@ -0,0 +1,269 @@
+# Spatial index over crawled listings.
+#
+# GridIndex buckets listings into square cells of roughly ``cell_miles``, kept
+# in NumPy arrays sorted by cell. The cells of one grid row are contiguous,
+# so a radius query costs one binary search per row it touches. The
+# candidates are then filtered with vectorized haversine distances, and
+# queries over millions of listings stay well under a millisecond.
+#
+# New and updated listings go to a small pending buffer that queries scan
+# directly. The buffer is merged into the sorted arrays once it holds
+# ``compact_every`` listings, so the index grows incrementally as items
+# arrive. Cells are plain latitude/longitude bins, and queries crossing the
+# antimeridian are not supported, which is fine for US listings.
+
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE = 69.0
+_ROW_SHIFT = 1 << 32
+
+
+def haversine_miles(lat, lon, latitudes, longitudes):
+    """Great-circle distances in miles from one point to arrays of points."""
+    lat1, lon1 = np.radians(lat), np.radians(lon)
+    lat2, lon2 = np.radians(latitudes), np.radians(longitudes)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _numbers(series):
+    return pd.to_numeric(series, errors='coerce').astype('float64')
+
+
+def to_timestamp(series):
+    """Convert dates to epoch seconds: epoch milliseconds (as in the search
+    API's dateSold), epoch seconds or date strings; NaN when unknown."""
+    numbers = None if pd.api.types.is_datetime64_any_dtype(series) else _numbers(series)
+    if numbers is not None and numbers.notna().any():
+        return np.where(numbers > 1e11, numbers / 1000, numbers)
+    dates = pd.to_datetime(series, errors='coerce', utc=True)
+    seconds = (dates - pd.Timestamp(0, tz='UTC')).dt.total_seconds()
+    return seconds.to_numpy(dtype='float64', na_value=np.nan)
+
+
+class GridIndex:
+    """Radius and nearest-neighbour queries over listing coordinates."""
+
+    def __init__(self, cell_miles=0.5, compact_every=4096):
+        """
+        Args:
+            cell_miles (float): Cell edge; about the radius of typical queries.
+            compact_every (int): Pending listings that trigger a merge into
+                the sorted arrays.
+        """
+        self.cell_deg = cell_miles / MILES_PER_DEGREE
+        self.compact_every = compact_every
+        self._keys = np.empty(0, dtype='int64')
+        self._ids = np.empty(0, dtype='int64')
+        self._lat = np.empty(0, dtype='float64')
+        self._lon = np.empty(0, dtype='float64')
+        self._times = np.empty(0, dtype='float64')
+        self._id_order = np.empty(0, dtype='int64')
+        self._pending = []
+        self._pending_arrays = None
+        # Ids whose entry in the sorted arrays is outdated by a pending one
+        self._superseded = set()
+        self._superseded_array = None
+
+    @classmethod
+    def from_frame(cls, frame, id_field='zpid', time_field='date_sold', **kwargs):
+        """Build an index from a DataFrame of exported listings.
+
+        Rows without a numeric zpid or without coordinates are skipped.
+        """
+        index = cls(**kwargs)
+        times = to_timestamp(frame[time_field]) if time_field in frame else None
+        index.add(_numbers(frame[id_field]), _numbers(frame['latitude']), _numbers(frame['longitude']), times)
+        index.compact()
+        return index
+
+    @classmethod
+    def from_items(cls, items, **kwargs):
+        """Build an index from scraped items (dicts or ``ZillowItem``)."""
+        fields = ('zpid', 'latitude', 'longitude', 'date_sold')
+        frame = pd.DataFrame([{field: item.get(field) for field in fields} for item in items], columns=fields)
+        return cls.from_frame(frame, **kwargs)
+
+    def __len__(self):
+        self.compact()
+        return len(self._ids)
+
+    def add(self, ids, latitudes, longitudes, times=None):
+        """Add or move listings.
+
+        Args:
+            ids (array-like): Integer listing ids (zpids).
+            latitudes (array-like): Degrees.
+            longitudes (array-like): Degrees.
+            times (array-like): Optional epoch seconds, e.g. the sale date,
+                used by the ``since`` filter of queries.
+        """
+        ids = np.asarray(ids, dtype='float64')
+        lat = np.asarray(latitudes, dtype='float64')
+        lon = np.asarray(longitudes, dtype='float64')
+        times = np.full(len(ids), np.nan) if times is None else np.asarray(times, dtype='float64')
+        valid = ~(np.isnan(ids) | np.isnan(lat) | np.isnan(lon))
+        if not valid.any():
+            return
+        ids = ids[valid].astype('int64')
+        self._pending.append((ids, lat[valid], lon[valid], times[valid]))
+        self._pending_arrays = None
+        self._superseded.update(ids.tolist())
+        self._superseded_array = None
+        if sum(len(chunk[0]) for chunk in self._pending) >= self.compact_every:
+            self.compact()
+
+    def add_item(self, item):
+        """Add one scraped item; ignored if it lacks a zpid or coordinates."""
+        frame = pd.DataFrame([{field: item.get(field) for field in ('zpid', 'latitude', 'longitude', 'date_sold')}])
+        self.add(_numbers(frame['zpid']), _numbers(frame['latitude']), _numbers(frame['longitude']),
+                 to_timestamp(frame['date_sold']))
+
+    def compact(self):
+        """Merge the pending listings into the sorted arrays."""
+        if not self._pending:
+            return
+        ids, lat, lon, times = self._pending_stack()
+        ids = np.concatenate([self._ids, ids])
+        lat = np.concatenate([self._lat, lat])
+        lon = np.concatenate([self._lon, lon])
+        times = np.concatenate([self._times, times])
+
+        # Keep the newest entry of every id
+        _, last = np.unique(ids[::-1], return_index=True)
+        keep = len(ids) - 1 - last
+        keys = self._cell_keys(lat[keep], lon[keep])
+        order = np.argsort(keys, kind='stable')
+        keep = keep[order]
+        self._keys = keys[order]
+        self._ids, self._lat, self._lon, self._times = ids[keep], lat[keep], lon[keep], times[keep]
+        self._id_order = np.argsort(self._ids)
+        self._pending = []
+        self._pending_arrays = None
+        self._superseded.clear()
+        self._superseded_array = None
+
+    def locate(self, listing_id):
+        """Return ``(latitude, longitude)`` of a listing, or None if unknown."""
+        listing_id = int(listing_id)
+        ids, lat, lon, _ = self._pending_stack()
+        matches = np.flatnonzero(ids == listing_id)
+        if len(matches):
+            return float(lat[matches[-1]]), float(lon[matches[-1]])
+        position = np.searchsorted(self._ids, listing_id, sorter=self._id_order)
+        if position < len(self._ids) and self._ids[self._id_order[position]] == listing_id:
+            row = self._id_order[position]
+            return float(self._lat[row]), float(self._lon[row])
+        return None
+
+    def radius(self, latitude, longitude, miles, since=None, exclude=None):
+        """Listings within ``miles`` of a point, nearest first.
+
+        Args:
+            since (float): Only listings whose time is at or after this epoch.
+            exclude (int): Leave out this id, e.g. the listing being compared.
+
+        Returns:
+            tuple: Arrays ``(ids, distances)`` in miles.
+        """
+        ids, lat, lon, times = self._candidates(latitude, longitude, miles)
+        distances = haversine_miles(latitude, longitude, lat, lon)
+        mask = distances <= miles
+        if since is not None:
+            mask &= times >= since
+        if exclude is not None:
+            mask &= ids != int(exclude)
+        ids, distances = ids[mask], distances[mask]
+        order = np.argsort(distances, kind='stable')
+        return ids[order], distances[order]
+
+    def nearest(self, latitude, longitude, k=10, max_miles=50.0, since=None, exclude=None):
+        """The ``k`` nearest listings within ``max_miles``, nearest first.
+
+        Returns:
+            tuple: Arrays ``(ids, distances)`` in miles.
+        """
+        miles = self.cell_deg * MILES_PER_DEGREE
+        while True:
+            ids, distances = self.radius(latitude, longitude, min(miles, max_miles), since, exclude)
+            # Everything within the searched radius is found, so k hits there are the k nearest
+            if len(ids) >= k or miles >= max_miles:
+                return ids[:k], distances[:k]
+            miles *= 2
+
+    def _cell_keys(self, lat, lon):
+        rows = np.floor((lat + 90.0) / self.cell_deg).astype('int64')
+        cols = np.floor((lon + 180.0) / self.cell_deg).astype('int64')
+        return rows * _ROW_SHIFT + cols
+
+    def _pending_stack(self):
+        if self._pending_arrays is None:
+            if self._pending:
+                self._pending_arrays = tuple(np.concatenate(parts) for parts in zip(*self._pending))
+            else:
+                empty = np.empty(0)
+                self._pending_arrays = (empty.astype('int64'), empty, empty, empty)
+        return self._pending_arrays
+
+    def _superseded_ids(self):
+        if self._superseded_array is None:
+            self._superseded_array = np.fromiter(self._superseded, dtype='int64', count=len(self._superseded))
+        return self._superseded_array
+
+    def _candidates(self, latitude, longitude, miles):
+        """Listings in the cells overlapping the query's bounding box."""
+        dlat = miles / MILES_PER_DEGREE
+        dlon = miles / (MILES_PER_DEGREE * max(np.cos(np.radians(latitude)), 1e-6))
+        row0, col0 = divmod(int(self._cell_keys(np.float64(latitude - dlat), np.float64(longitude - dlon))), _ROW_SHIFT)
+        row1, col1 = divmod(int(self._cell_keys(np.float64(latitude + dlat), np.float64(longitude + dlon))), _ROW_SHIFT)
+
+        rows = np.arange(row0, row1 + 1, dtype='int64') * _ROW_SHIFT
+        starts = np.searchsorted(self._keys, rows + col0, side='left')
+        ends = np.searchsorted(self._keys, rows + col1, side='right')
+        selected = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)]) \
+            if len(rows) else np.empty(0, dtype='int64')
+
+        ids = self._ids[selected]
+        parts = [(ids, self._lat[selected], self._lon[selected], self._times[selected])]
+        if self._superseded:
+            current = ~np.isin(ids, self._superseded_ids())
+            parts = [tuple(array[current] for array in parts[0])]
+        if self._pending:
+            ids, lat, lon, times = self._pending_stack()
+            # The latest pending entry of an id wins
+            _, last = np.unique(ids[::-1], return_index=True)
+            latest = len(ids) - 1 - last
+            parts.append((ids[latest], lat[latest], lon[latest], times[latest]))
+        return tuple(np.concatenate(arrays) for arrays in zip(*parts))
+
+
+def neighbourhood_mean(latitudes, longitudes, values, cell_miles=0.5):
+    """Mean of ``values`` over each point's 3 x 3 block of grid cells, itself excluded.
+
+    A fully vectorized stand-in for "the average of the comparables within
+    about ``cell_miles``", used by the deal scorer.
+
+    Returns:
+        numpy.ndarray: NaN where a point has no neighbours with a value.
+    """
+    lat = np.asarray(latitudes, dtype='float64')
+    lon = np.asarray(longitudes, dtype='float64')
+    values = np.asarray(values, dtype='float64')
+    located = ~(np.isnan(lat) | np.isnan(lon))
+    keys = GridIndex(cell_miles)._cell_keys(np.where(located, lat, 0.0), np.where(located, lon, 0.0))
+    valid = located & ~np.isnan(values)
+
+    cells = pd.Series(values[valid]).groupby(keys[valid]).agg(['sum', 'count'])
+    total = np.zeros(len(values))
+    count = np.zeros(len(values))
+    for drow in (-1, 0, 1):
+        for dcol in (-1, 0, 1):
+            neighbours = cells.reindex(keys + drow * _ROW_SHIFT + dcol)
+            total += np.nan_to_num(neighbours['sum'].to_numpy(dtype='float64'))
+            count += np.nan_to_num(neighbours['count'].to_numpy(dtype='float64'))
+    total -= np.where(valid, values, 0.0)
+    count -= valid
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(located & (count > 0), total / count, np.nan)
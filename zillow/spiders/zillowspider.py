@@ -1,23 +1,47 @@
 import scrapy
-import json
-from urllib.parse import quote
-from itemadapter import ItemAdapter
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from zillow import jsonld, parsing, search_api
+from zillow.distributed import distributed_enabled
+from zillow.enrichment import EnrichmentBuffer
+from zillow.geo import ListingMerger, QuadtreePartitioner, Tile
+from zillow.incremental import IncrementalStore
 from zillow.items import ZillowItem
+from zillow.records import ListingRecord, to_cents
+from zillow.scheduling import CrawlScheduler
+from zillow.utils import listing_key
 
 class ZillowSpider(scrapy.Spider):
     name = 'zillowspider'
     allowed_domains = ['zillow.com']
     start_urls = []
-    base_url_template = 'https://zillow.com/{}/{}'
 
-    def __init__(self, listing_category='buy', max_pages=10, city_names=None, *args, **kwargs):
+    def __init__(self, listing_category='buy', max_pages=10, city_names=None, json_backend=None, incremental=False,
+                 cities_file=None, max_requests=None, city_max_requests=None, mode='html', api_tiles=1,
+                 api_result_cap=500, api_max_depth=8, *args, **kwargs):
         """
         Constructor for initializing the web scraping spider.
 
         Args:
             listing_category (str): Type of listing to scrape, default is 'all'.
-            max_pages (int): Maximum number of pages to scrape, default is 10.
-            city_names (str): Pipe-separated list of city names to scrape.
+            max_pages (int): Maximum number of pages to scrape per city, default is 10.
+            city_names (str): Pipe-separated list of city names to scrape. A name
+                may carry a priority weight from -9 to 9, e.g. 'brooklyn ny=5'.
+            json_backend (str): JSON decoder for ld+json blocks ('orjson' or 'json'),
+                default is the fastest installed one.
+            incremental (str): If '1', skip search pages and listings whose
+                fingerprint has not changed since the previous crawl.
+            cities_file (str): File with one city name (and optional weight) per line.
+            max_requests (int): Request budget for the whole crawl.
+            city_max_requests (int): Request budget per city.
+            mode (str): 'html' parses the ld+json of search pages; 'api' reads
+                the first search page's query state and then pages through the
+                JSON search endpoint, about 40 listings per request.
+            api_tiles (int): In api mode, start from an N x N grid of tiles
+                over each city's map instead of a single query.
+            api_result_cap (int): Most results one API query returns; tiles
+                reporting more are split into quadrants and searched again.
+            api_max_depth (int): Maximum number of quadrant splits per tile.
 
         Returns:
             None
@@ -25,24 +49,100 @@ class ZillowSpider(scrapy.Spider):
         super().__init__(*args, **kwargs)
         self.max_pages = int(max_pages)
         self.listing_category = listing_category
-        self.url_template = self.get_url_template()
+        self.json_loads = jsonld.get_loads(json_backend)
+        # Parse functions may run in worker processes, which get the backend by name
+        self.json_backend = json_backend
+        self.incremental = str(incremental).lower() in ('1', 'true', 'yes')
+        self.incremental_store = None
+        if mode not in ('html', 'api'):
+            raise ValueError(f"Unknown crawl mode: {mode!r}")
+        self.mode = mode
+        self.api_tiles = max(1, int(api_tiles))
+        self.partitioner = QuadtreePartitioner(int(api_result_cap), int(api_max_depth))
+        self.merger = ListingMerger()
 
         self.city_names = city_names
-        if city_names:
-            self.start_urls = [self.url_template.format(self.parse_city_name(name)) for name in city_names.split('|')]
+        cities = CrawlScheduler.parse_cities(city_names, cities_file)
+        self.scheduler = CrawlScheduler(
+            [(self.parse_city_name(name), weight) for name, weight in cities],
+            max_pages=self.max_pages,
+            max_requests=int(max_requests) if max_requests else None,
+            city_max_requests=int(city_max_requests) if city_max_requests else None,
+        )
+
+        self.log(', '.join(self.scheduler.cities))
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        if spider.incremental:
+            spider.incremental_store = IncrementalStore.from_crawler(crawler)
+        spider.enrichment = EnrichmentBuffer(
+            max_size=crawler.settings.getint('ENRICHMENT_BUFFER_SIZE', 1000),
+            timeout=crawler.settings.getfloat('ENRICHMENT_TIMEOUT', 120),
+        )
+        spider.enrichment_requested = set()
+        # Workers of a distributed crawl may parse each other's details pages
+        spider.enrichment_in_request = crawler.settings.getbool(
+            'ENRICHMENT_IN_REQUEST', distributed_enabled(crawler.settings))
+        spider.detail_timeout = crawler.settings.getfloat('ENRICHMENT_DOWNLOAD_TIMEOUT', 30)
+        spider.parse_executor = parsing.ParseExecutor.from_crawler(crawler)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        return spider
+
+    async def start(self):
+        """
+        Yields the first search page of every city; parse() then follows each
+        city's pages within the scheduler's budgets. In api mode the first page
+        is only read for its query state, see parse_query_state().
+        """
+        for request in self.start_requests():
+            yield request
 
-        self.log(', '.join(self.start_urls) if hasattr(self, 'start_urls') else '')
-    
     def start_requests(self):
         """
-        Custom method to start requests. Overrides the base class method.
+        The requests of start(), for Scrapy versions before 2.13, which call
+        this method instead.
         """
-        city_names = getattr(self, 'city_names', None)
-        if city_names:
-            self.start_urls = [self.url_template.format(self.parse_city_name(name)) for name in city_names.split('|')]
-        self.log(', '.join(self.start_urls) if hasattr(self, 'start_urls') else '')
-        yield from super().start_requests()
-
+        if not self.scheduler.cities:
+            for url in self.start_urls:
+                yield scrapy.Request(url, dont_filter=True)
+            return
+        for city in self.scheduler.cities:
+            request = self.search_page_request(city, 1)
+            if request is not None:
+                yield request
+
+    def search_page_request(self, city, page):
+        """Return the request for page ``page`` of ``city``, or None if over budget."""
+        if not self.scheduler.reserve(city, page=page):
+            return None
+        return scrapy.Request(
+            self.get_url_template(location=city, page=page),
+            callback=self.parse_query_state if self.mode == 'api' else self.parse,
+            priority=self.scheduler.priority(city, page),
+            cb_kwargs={'city': city, 'page': page},
+            # The query state is needed even if the page did not change
+            meta={'conditional': self.mode != 'api'},
+        )
+
+    def search_api_request(self, query_state, page=1, city=None, tile=None):
+        """Return the JSON search request for page ``page`` of ``query_state`` within ``tile``, or None if over budget."""
+        if city is not None and not self.scheduler.reserve(city, page=page):
+            return None
+        if city is None and page > self.max_pages:
+            return None
+        map_bounds = tile.as_bounds() if tile is not None else None
+        return scrapy.Request(
+            search_api.build_search_url(
+                search_api.make_query_state(query_state, self.listing_category, page, map_bounds), page),
+            callback=self.parse_page_state,
+            headers={'Accept': 'application/json'},
+            priority=self.scheduler.priority(city, page) if city is not None else 0,
+            cb_kwargs={'page': page, 'query_state': query_state, 'city': city, 'tile': tile},
+            # Tiles are split and paged by the result counts in the body
+            meta={'conditional': False},
+        )
 
     def get_url_template(self, location='new-york-ny', listing_category=None, sorting='', page=1):
         """
@@ -66,115 +166,288 @@ class ZillowSpider(scrapy.Spider):
             return f"{base_url}{page}_p/"
 
 
-    def parse(self, response):
-        # Extract JSON-LD listings from the script tag
-        script_data = response.css('script[type="application/ld+json"]::text').getall()
-
-        for script_content in script_data:
-            # Load JSON content
-            try:
-                json_data = json.loads(script_content)
-            except json.JSONDecodeError:
-                self.log(f"Failed to decode JSON: {script_content}")
+    async def parse(self, response, city=None, page=1):
+        if response.meta.get('not_modified'):
+            return list(self.handle_not_modified_page(city, page))
+        # Scan the raw body for JSON-LD listings instead of building a selector tree
+        return await self.parse_executor.run(
+            parsing.search_page, (response.body, response.encoding, self.json_backend, self.incremental),
+            self.handle_search_page, url=response.url, city=city, page=page,
+        )
+
+    def handle_search_page(self, search_page, url, city=None, page=1):
+        """Follow up on a search page parsed by ``parsing.search_page``."""
+        yield from self.expired_items()
+        for script_text in search_page['errors']:
+            self.log(f"Failed to decode JSON: {script_text}")
+            self.crawler.stats.inc_value('parse/json_errors/search_page', spider=self)
+
+        # Interleave the next page with the other cities' pages
+        if city is not None and search_page['blocks']:
+            next_page_request = self.search_page_request(city, page + 1)
+            if next_page_request is not None:
+                yield next_page_request
+
+        # In incremental mode a page with the same listings as last time is skipped whole
+        if self.incremental and not self.incremental_store.update_page_fingerprint(url, search_page['fingerprint']):
+            self.page_unchanged(city, search_page['blocks'])
+            return
+
+        listings = new_listings = 0
+        seen_store = getattr(self.crawler, 'seen_store', None)
+        for fields, fingerprint in search_page['listings']:
+            item = ZillowItem(**fields)
+            listings += 1
+
+            if self.incremental and not self.listing_changed(item, fingerprint):
                 continue
+            if seen_store is None or listing_key(item.get('zpid'), item.get('url')) not in seen_store:
+                new_listings += 1
 
-            # Check if the JSON represents a valid real estate type
-            real_estate_type = json_data.get('@type', '')
-            if real_estate_type:
-                item = ZillowItem()
-
-                # Extract relevant information
-                item['real_estate_type'] = real_estate_type
-                item['property_name'] = json_data.get('name', '')
-                item['floor_size'] = json_data.get('floorSize', {}).get('value', '')
-                item['street_address'] = json_data.get('address', {}).get('streetAddress', '')
-                item['locality'] = json_data.get('address', {}).get('addressLocality', '')
-                item['region'] = json_data.get('address', {}).get('addressRegion', '')
-                item['postal_code'] = json_data.get('address', {}).get('postalCode', '')
-                item['latitude'] = json_data.get('geo', {}).get('latitude', '')
-                item['longitude'] = json_data.get('geo', {}).get('longitude', '')
-                item['url'] = json_data.get('url', '')
-
-                # Yield the item for further processing in pipelines
-                yield item
-                yield scrapy.Request(item['url'], callback=self.parse_home_details)
-
-    def parse_home_details(self, response):
-        # Extract details from the home details page
-        zestimate_script = response.css('div[data-testid="home-details-chip-container"] script::text').get()
-
-        if zestimate_script:
-            # Parse the script content
-            try:
-                zestimate_data = json.loads(zestimate_script)
-            except json.JSONDecodeError:
-                self.log(f"Failed to decode JSON: {zestimate_script}")
-                return
-
-            # Extract the desired information from the script
-            zestimate_value = zestimate_data.get('homeValue', {}).get('amount', '')
-            if zestimate_value:
-                self.log(f"Zestimate Value: {zestimate_value}")
-                # You can process or store this information as needed
+            # The item goes to the pipelines once its details are merged in
+            yield from self.enrich(item, city, page)
 
+        if city is not None:
+            self.scheduler.record_page(city, listings, new_listings)
+
+    def handle_not_modified_page(self, city=None, page=1):
+        """Follow up on a search page that answered 304 Not Modified.
+
+        Its listings are the ones fingerprinted last time, so they are
+        skipped, but the next page is requested as for any unchanged page.
         """
-        Parse the response and extract encoded query search terms. If found, create a results URL and yield a request to parse the page state. Log any errors encountered during parsing.
-        Parameters:
-            - response: the response object to parse
-        Return:
-            - None
+        yield from self.expired_items()
+        if city is not None:
+            next_page_request = self.search_page_request(city, page + 1)
+            if next_page_request is not None:
+                yield next_page_request
+        self.page_unchanged(city, 0)
+
+    def page_unchanged(self, city, listings):
+        self.crawler.stats.inc_value('incremental/pages_unchanged', spider=self)
+        if city is not None:
+            # Nothing new on it, but the city's later pages may have changed
+            self.scheduler.record_page(city, listings, 0, exhausts_city=False)
+
+    def listing_changed(self, item, fingerprint):
+        """Record the search card fingerprint of ``item`` and report whether it changed.
+
+        The card's ld+json payload carries the listing's price, Zestimate and
+        status, so an identical payload means the details page is unchanged too.
         """
-        """try:
-            encodedQuerySearchTerms = response.css('script[data-zrr-shared-data-key="mobileSearchPageStore"]::text').re_first(r'^<!--(.*)-->$')
-            if encodedQuerySearchTerms:
-                queryState = json.loads(encodedQuerySearchTerms).get('queryState', {})
-                results_url = self.base_url_template.format(quote(json.dumps(queryState)))
-                yield response.follow(results_url, callback=self.parse_page_state, cb_kwargs={'query_state': queryState})
-        except json.JSONDecodeError as e:
-            self.log(f"Error during parsing JSON: {str(e)}")
+        key = listing_key(item.get('zpid'), item.get('url'))
+        changed = self.incremental_store.add(key, fingerprint)
+        self.crawler.stats.inc_value('incremental/changed' if changed else 'incremental/skipped', spider=self)
+        return changed
+
+    def enrich(self, item, city=None, page=1):
+        """Hold ``item`` and request its details page, or yield its record right away.
+
+        Held items are kept as compact ``ListingRecord``s, in the buffer or,
+        with ENRICHMENT_IN_REQUEST, in the details request itself. A listing's
+        details are requested once per crawl; cards repeated on later pages
+        are dropped. Without a budget for the details request the record is
+        yielded without its details.
         """
+        key = listing_key(item.get('zpid'), item.get('url'))
+        if key in self.enrichment_requested:
+            self.crawler.stats.inc_value('enrichment/duplicates', spider=self)
+            return
+        record = ListingRecord.from_item(item)
+        if city is None:
+            priority = -1
+        elif self.scheduler.reserve(city):
+            priority = self.scheduler.priority(city, page) - 1
+        else:
+            yield record
+            return
+
+        self.enrichment_requested.add(key)
+        meta = {'enrichment_key': key, 'download_timeout': self.detail_timeout}
+        if city is not None:
+            meta['shard'] = city
+        if self.enrichment_in_request:
+            meta['enrichment_item'] = record
+        else:
+            for evicted in self.enrichment.add(key, record):
+                self.crawler.stats.inc_value('enrichment/evicted', spider=self)
+                yield evicted
+        yield scrapy.Request(
+            item['url'],
+            callback=self.parse_home_details,
+            errback=self.home_details_failed,
+            priority=priority,
+            meta=meta,
+        )
+
+    def expired_items(self):
+        """Yield the buffered items whose details took too long."""
+        for item in self.enrichment.expired():
+            self.crawler.stats.inc_value('enrichment/timed_out', spider=self)
+            yield item
+
+    def held_item(self, request):
+        """Take the item waiting for the details ``request``, or None."""
+        item = request.meta.pop('enrichment_item', None)
+        if item is None:
+            item = self.enrichment.pop(request.meta.get('enrichment_key'))
+        return item
+
+    def peek_item(self, request):
+        """Return the item waiting for the details ``request`` without taking it, or None."""
+        item = request.meta.get('enrichment_item')
+        if item is None:
+            item = self.enrichment.get(request.meta.get('enrichment_key'))
+        return item
+
+    def release_item(self, request):
+        """Return the item held for a details ``request`` without its details,
+        e.g. when a middleware drops the request; None if nothing is held."""
+        item = self.held_item(request)
+        if item is not None:
+            self.crawler.stats.inc_value('enrichment/released', spider=self)
+        return item
+
+    async def parse_home_details(self, response):
+        item = self.held_item(response.request)
+        if response.meta.get('not_modified'):
+            # Nothing to merge; the item goes on with its search card fields
+            return [item] if item is not None else []
+        # Extract details from the home details page
+        return await self.parse_executor.run(
+            parsing.home_details, (response.body, response.encoding, self.json_backend),
+            self.handle_home_details, fallback=lambda: [item] if item is not None else [], item=item,
+        )
+
+    def handle_home_details(self, details, item):
+        """Merge the details parsed by ``parsing.home_details`` into the held item."""
+        yield from self.expired_items()
+        if details['error'] is not None:
+            self.log(f"Failed to decode JSON: {details['error']}")
+            self.crawler.stats.inc_value('parse/json_errors/home_details', spider=self)
+
+        if item is None:
+            # The item already left the buffer on a timeout
+            return
+        if details['zestimate']:
+            item.zestimate_cents = to_cents(details['zestimate'])
+            self.crawler.stats.inc_value('enrichment/merged', spider=self)
+        yield item
+
+    def home_details_failed(self, failure):
+        """Yield the buffered item without its details when the details page fails."""
+        self.crawler.stats.inc_value('enrichment/failed', spider=self)
+        item = self.held_item(failure.request)
+        if item is not None:
+            yield item
+
+    def spider_idle(self, spider):
+        # Items still held once nothing is in flight lost their details request
+        # (e.g. to the dupefilter); hand them to the item pipelines directly.
+        # A request to flush them could be leased to another worker of a
+        # distributed crawl, or dropped as a cache miss when reparsing
+        if spider is self and len(self.enrichment):
+            self.flush_items()
+            raise DontCloseSpider
+
+    def flush_items(self):
+        scraper = self.crawler.engine.scraper
+        for item in self.enrichment.drain():
+            self.crawler.stats.inc_value('enrichment/flushed', spider=self)
+            if hasattr(scraper, 'start_itemproc'):
+                scraper.start_itemproc(item, response=None)
+            else:
+                # Scrapy < 2.11
+                scraper._process_spidermw_output(item, None, None, self)
+
+    async def parse_query_state(self, response, city=None, page=1):
+        """Read the query state of a search page and start paging the JSON search endpoint.
+
+        The query state's map bounds are the root of a quadtree of tiles, see
+        parse_page_state(). Tiles are requested independently, so Scrapy
+        searches them concurrently.
+        """
+        return await self.parse_executor.run(
+            parsing.query_state, (response.body, self.json_backend),
+            self.handle_query_state, url=response.url, city=city,
+        )
+
+    def handle_query_state(self, query_state, url, city=None):
+        """Request the first results page of every tile of a parsed query state."""
+        if not query_state:
+            self.log(f"No query state found on {url}")
+            self.crawler.stats.inc_value('search_api/no_query_state', spider=self)
+            return
+
+        map_bounds = query_state.get('mapBounds')
+        if not map_bounds:
+            tiles = [None]
+        elif self.api_tiles > 1:
+            tiles = Tile.from_bounds(map_bounds).grid(self.api_tiles)
+        else:
+            tiles = [Tile.from_bounds(map_bounds)]
+
+        for tile in tiles:
+            request = self.search_api_request(query_state, 1, city, tile)
+            if request is not None:
+                yield request
 
-    def parse_page_state(self, response, page=1, query_state=None):
+    async def parse_page_state(self, response, page=1, query_state=None, city=None, tile=None):
+        """Yield the listings of one JSON search results page and request the next one.
+
+        A tile whose first page reports more results than one query returns
+        is split into quadrants instead of being paginated. Listings are merged
+        by zpid across tiles, and each is only taken from the tile that
+        contains its coordinates.
+        """
         self.log('Parsing page ' + str(page))
+        return await self.parse_executor.run(
+            parsing.search_results_page,
+            (response.body, response.url, self.listing_category, self.json_backend, self.incremental),
+            self.handle_page_state, url=response.url, page=page, query_state=query_state, city=city, tile=tile,
+        )
+
+    def handle_page_state(self, results_page, url, page=1, query_state=None, city=None, tile=None):
+        """Follow up on a results page parsed by ``parsing.search_results_page``."""
+        if results_page['error']:
+            self.log(f"Failed to decode search results JSON from {url}")
+            self.crawler.stats.inc_value('parse/json_errors/search_api', spider=self)
+            return
+        search_results = results_page['listings']
+        total_pages, total_results = results_page['total_pages'], results_page['total_results']
+
+        if tile is not None and page == 1 and self.partitioner.should_split(tile, total_results):
+            self.crawler.stats.inc_value('search_api/tiles_split', spider=self)
+            for quadrant in tile.split():
+                request = self.search_api_request(query_state, 1, city, quadrant)
+                if request is not None:
+                    yield request
+        elif query_state is not None and search_results and page < total_pages:
+            # A tile is done once it runs out of pages; the city's other tiles go on
+            next_page_request = self.search_api_request(query_state, page + 1, city, tile)
+            if next_page_request is not None:
+                yield next_page_request
+
+        listings = new_listings = 0
+        seen_store = getattr(self.crawler, 'seen_store', None)
+        for fields, fingerprint in search_results:
+            item = ZillowItem(**fields)
+            if not self.merger.accept(item, tile):
+                continue
+            listings += 1
 
-        data = response.json()
-        search_results = data.get('cat1', {}).get('searchResults', {}).get('listResults', [])
-
-        for listing in search_results:
-            adapter = ItemAdapter({
-                'zpid': listing['hdpData']['homeInfo']['zpid'],
-                'streetAddress': listing['hdpData']['homeInfo']['streetAddress'],
-                'zipcode': listing['hdpData']['homeInfo']['zipcode'],
-                'city': listing['hdpData']['homeInfo']['city'],
-                'state': listing['hdpData']['homeInfo']['state'],
-                'latitude': listing['hdpData']['homeInfo']['latitude'],
-                'longitude': listing['hdpData']['homeInfo']['longitude'],
-                'price': listing['hdpData']['homeInfo']['price'],
-                'dateSold': listing['hdpData']['homeInfo']['dateSold'],
-                'bathrooms': listing['hdpData']['homeInfo']['bathrooms'],
-                'bedrooms': listing['hdpData']['homeInfo']['bedrooms'],
-                'livingArea': listing['hdpData']['homeInfo']['livingArea'],
-                'homeType': listing['hdpData']['homeInfo']['homeType'],
-                'taxAssessedValue': listing['hdpData']['homeInfo']['taxAssessedValue'],
-                'lotAreaValue': listing['hdpData']['homeInfo']['lotAreaValue'],
-                'lotAreaUnit': listing['hdpData']['homeInfo']['lotAreaUnit'],
-                'listing_category': self.listing_category
-            })
-
-            # Extract monthly Zestimate for unsold homes listed as "for_sale"
-            if self.listing_category == 'for_sale':
-                adapter['monthlyZestimate'] = listing.get('zestimate', {}).get('valuationRange', {}).get('low', '')
-
-             # Print the item to the console
-            print(adapter.asdict())
-
-
-        if next_page := data.get('cat1', {}).get('searchList', {}).get('totalPages') and next_page <= self.max_pages:
-            next_query_state = query_state.copy() if query_state else {}
-            next_query_state.update({"pagination": {"currentPage": page + 1}})
-            next_page_url = self.get_url_template(page=page + 1)
-
-            yield scrapy.Request(next_page_url, callback=self.parse_page_state, cb_kwargs={'page': page + 1, 'query_state': next_query_state})
+            if self.incremental and not self.listing_changed(item, fingerprint):
+                continue
+            if seen_store is None or listing_key(item.get('zpid'), item.get('url')) not in seen_store:
+                new_listings += 1
+            yield ListingRecord.from_item(item)
+
+        self.crawler.stats.inc_value('search_api/pages', spider=self)
+        self.crawler.stats.inc_value('search_api/listings', listings, spider=self)
+        self.crawler.stats.set_value('search_api/duplicates', self.merger.duplicates, spider=self)
+        if city is not None:
+            # Count every result: cards merged into neighbouring tiles are not a sign the city ran out
+            self.scheduler.record_page(city, len(search_results), new_listings, exhausts_city=False)
 
     @staticmethod
     def parse_city_name(city_name):
@@ -0,0 +1,41 @@
+# Small helpers shared by the spider, middlewares and pipelines.
+
+import re
+
+ZPID_RE = re.compile(r'/(\d+)_zpid')
+NUMBER_RE = re.compile(r'-?\d+(?:\.\d+)?')
+
+
+def zpid_from_url(url):
+    """Extract the Zillow property id from a home details URL.
+
+    Args:
+        url (str): A URL such as ``https://www.zillow.com/homedetails/.../12345_zpid/``.
+
+    Returns:
+        str: The zpid, or an empty string if the URL does not carry one.
+    """
+    match = ZPID_RE.search(url or '')
+    return match.group(1) if match else ''
+
+
+def listing_key(zpid='', url=''):
+    """Return the key identifying a listing across crawls: its zpid, else its URL."""
+    return str(zpid) if zpid else (zpid_from_url(url) or url)
+
+
+def parse_number(value):
+    """Convert a scraped number such as ``'$1,250,000'`` or ``'1,204 sqft'`` to float.
+
+    Args:
+        value: A number, a string containing one, or None.
+
+    Returns:
+        float: The value, or None if it holds no number.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = NUMBER_RE.search(str(value).replace(',', ''))
+    return float(match.group()) if match else None